@@ -16,9 +16,14 @@
 # along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
 
 # This module defines interface for data decorator
+import os
+import tempfile
 
 class DataDecorator:
     """This is an interface for data decoration."""
+    # bytes read from input at a time when streaming
+    STREAM_BUFFER = 65536
+
     def __init__(self, DEBUG=False):
         self.DEBUG = DEBUG
 
@@ -63,3 +68,60 @@ Returns:
     None
 """
         raise NotImplementedError("Undecorate file should be implemented more specific")
+
+    def decorate_stream(self, ifname):
+        """Decorate data from file as it is consumed.
+Decorators not streaming decorate to a temporary file first.
+Params:
+    ifname: input file path.
+
+Returns:
+    Iterator of decorated chunks. Throws IOError while iterating if
+    decoration fails.
+"""
+        (fd, tmp_path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.decorate_file(ifname, tmp_path)
+            for data in self._file_chunks(tmp_path):
+                yield data
+        finally:
+            os.unlink(tmp_path)
+
+    def undecorate_stream(self, chunks):
+        """Undecorate data as it arrives.
+Decorators not streaming collect it in a temporary file first.
+Params:
+    chunks: iterable of decorated chunks.
+
+Returns:
+    Iterator of undecorated chunks. Throws IOError while iterating if
+    undecoration fails.
+"""
+        (fd, in_path) = tempfile.mkstemp()
+        (out_fd, out_path) = tempfile.mkstemp()
+        os.close(out_fd)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                for data in chunks:
+                    f.write(data)
+            finally:
+                f.close()
+            self.undecorate_file(in_path, out_path)
+            for data in self._file_chunks(out_path):
+                yield data
+        finally:
+            os.unlink(in_path)
+            os.unlink(out_path)
+
+    def _file_chunks(self, path):
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(DataDecorator.STREAM_BUFFER)
+                if not len(data):
+                    break
+                yield data
+        finally:
+            f.close()
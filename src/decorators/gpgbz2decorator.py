@@ -20,11 +20,14 @@ import bz2
 import gnupg
 import hashlib
 import os
+import subprocess
+import tempfile
+import threading
 
 import datadecorator
 
 class GPGBZ2Decorator(datadecorator.DataDecorator):
-    def __init__(self, gpghome, gpgkeys, compresslevel=5, compressed=True, encrypted=True, DEBUG=False):
+    def __init__(self, gpghome, gpgkeys, compresslevel=5, compressed=True, encrypted=True, tmpdir=None, DEBUG=False):
         # this function takes home directory for gnupg encryption library
         # and key files
         # if key file does not exist yet, export key to that file
@@ -44,10 +47,13 @@ class GPGBZ2Decorator(datadecorator.DataDecorator):
                 f.write(ascii_armored_private_keys)
 
         self.gpg = gpg
+        self.gpghome = gpghome
         self.key = key.fingerprints
         self.compresslevel = compresslevel
         self.compressed = compressed
         self.encrypted  = encrypted
+        # intermediate files are kept out of the destination directory
+        self.tmpdir = tmpdir
 
     # encrypt with public key
     def decorate(self, data):
@@ -109,12 +115,121 @@ class GPGBZ2Decorator(datadecorator.DataDecorator):
         if not com_tmp == ofname:
             os.unlink(com_tmp)
 
+    # compress and encrypt as the output is read, nothing is written to
+    # disk, each stage waits for the next one to consume
+    def decorate_stream(self, ifname):
+        chunks = self._compress_stream(self._file_chunks(ifname))
+        if self.encrypted:
+            args = ['--encrypt', '--armor']
+            for fingerprint in self.key:
+                args.extend(['--recipient', fingerprint])
+            chunks = self._gpg_stream(args, chunks)
+        try:
+            for data in chunks:
+                yield data
+        finally:
+            chunks.close()
+
+    # decrypt and decompress as the input arrives
+    def undecorate_stream(self, chunks):
+        if self.encrypted:
+            chunks = self._gpg_stream(['--decrypt'], chunks)
+        chunks = self._decompress_stream(chunks)
+        try:
+            for data in chunks:
+                yield data
+        finally:
+            chunks.close()
+
+    def _compress_stream(self, chunks):
+        if not self.compressed:
+            for data in chunks:
+                yield data
+            return
+
+        compressor = bz2.BZ2Compressor(self.compresslevel)
+        for data in chunks:
+            data = compressor.compress(data)
+            if len(data):
+                yield data
+        yield compressor.flush()
+
+    def _decompress_stream(self, chunks):
+        if not self.compressed:
+            for data in chunks:
+                yield data
+            return
+
+        decompressor = bz2.BZ2Decompressor()
+        for data in chunks:
+            data = decompressor.decompress(data)
+            if len(data):
+                yield data
+
+    # pipe chunks through a gpg process, a thread feeds its input while
+    # its output is handed out
+    def _gpg_stream(self, args, chunks):
+        args = [getattr(self.gpg, 'gpgbinary', 'gpg'), '--no-tty', \
+            '--batch', '--homedir', self.gpghome] + args
+        errors = tempfile.TemporaryFile()
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, \
+            stdout=subprocess.PIPE, stderr=errors)
+        failure = []
+
+        def feed():
+            try:
+                for data in chunks:
+                    try:
+                        proc.stdin.write(data)
+                    except IOError:
+                        # gpg exited, its own error tells why
+                        break
+            except Exception as e:
+                # input failed, gpg got it truncated
+                failure.append(e)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        try:
+            while True:
+                data = proc.stdout.read(self.STREAM_BUFFER)
+                if not len(data):
+                    break
+                yield data
+
+            feeder.join()
+            if len(failure):
+                raise failure[0]
+            if proc.wait():
+                errors.seek(0)
+                raise IOError("gpg failed: %s" % errors.read().strip())
+        finally:
+            if proc.poll() is None:
+                # consumer gave up, stop the pipeline
+                proc.kill()
+                proc.wait()
+            feeder.join()
+            proc.stdout.close()
+            errors.close()
+
     def undecorate_file(self, ifname, ofname):
         buffer_size = 512
 
         output = open(ofname, 'w')
         if self.compressed:
-            decrypted_file = ofname + '.bz2'
+            if self.tmpdir:
+                (fd, decrypted_file) = tempfile.mkstemp('.bz2', \
+                    dir=self.tmpdir)
+                os.close(fd)
+            else:
+                decrypted_file = ofname + '.bz2'
         else:
             decrypted_file = ifname
             
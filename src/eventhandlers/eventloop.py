@@ -0,0 +1,160 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements the main event loop of the daemon.
+#
+# The loop sleeps in epoll until a watched descriptor becomes readable,
+# a timer expires, or a worker thread posts a completion through the
+# wakeup pipe. All callbacks run on the loop thread one after another,
+# so local commits and remote syncs never interleave. An error raised by
+# a callback is logged, the loop keeps running.
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import select
+import time
+import traceback
+
+class EventLoop:
+    """Single threaded dispatcher over epoll, timers and a wakeup pipe."""
+
+    def __init__(self, DEBUG=False):
+        EventLoop.DEBUG = DEBUG
+        self.epoll   = select.epoll()
+        # fd -> (callback, args)
+        self.readers = {}
+        # heap of [deadline, sequence, callback, args], callback is set to
+        # None when cancelled
+        self.timers  = []
+        self.seq     = 0
+        # callbacks posted by other threads
+        self.posted  = collections.deque()
+        self.running = False
+
+        # wakeup channel for worker threads
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.add_reader(self.wakeup_r, self._drain_wakeup)
+
+    def add_reader(self, fd, callback, *args):
+        """Call callback(*args) whenever fd becomes readable.
+Params:
+    fd: file descriptor to watch;
+    callback: callable to invoke on the loop."""
+        self.readers[fd] = (callback, args)
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        """Stop watching fd."""
+        del self.readers[fd]
+        self.epoll.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) on the loop after delay seconds.
+
+Return:
+    A timer handle for cancel()."""
+        self.seq = self.seq + 1
+        timer = [time.time() + delay, self.seq, callback, args]
+        heapq.heappush(self.timers, timer)
+
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer returned by call_later."""
+        timer[2] = None
+
+    def post(self, callback, *args):
+        """Call callback(*args) on the loop as soon as possible.
+This is the only method which can be called from other threads."""
+        self.posted.append((callback, args))
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError as e:
+            # pipe full, the loop is awake anyway
+            if not e.errno == errno.EAGAIN:
+                raise
+
+    def run(self):
+        """Dispatch events until stop() is called."""
+        self.running = True
+        while self.running:
+            timeout = self._next_timeout()
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for (fd, mask) in events:
+                if fd in self.readers:
+                    (callback, args) = self.readers[fd]
+                    self._dispatch(callback, args)
+
+            self._run_posted()
+            self._run_timers()
+
+    def stop(self):
+        """Leave run() after current callback."""
+        self.running = False
+        # wake up the loop if called from another thread
+        self.post(lambda: None)
+
+    def _next_timeout(self):
+        # drop cancelled timers
+        while len(self.timers) and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+
+        if len(self.posted):
+            return 0
+        elif len(self.timers):
+            return max(0, self.timers[0][0] - time.time())
+        else:
+            # block until something happens
+            return -1
+
+    def _run_timers(self):
+        now = time.time()
+        while len(self.timers) and self.timers[0][0] <= now:
+            (deadline, seq, callback, args) = heapq.heappop(self.timers)
+            if callback:
+                self._dispatch(callback, args)
+
+    def _run_posted(self):
+        while len(self.posted):
+            (callback, args) = self.posted.popleft()
+            self._dispatch(callback, args)
+
+    def _dispatch(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            # one failed callback must not stop the daemon
+            traceback.print_exc()
+
+    def _drain_wakeup(self):
+        try:
+            while len(os.read(self.wakeup_r, 4096)):
+                pass
+        except OSError as e:
+            if not e.errno == errno.EAGAIN:
+                raise
@@ -0,0 +1,269 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements an event source over fanotify.
+#
+# One filesystem mark reports changes on the whole mount holding the
+# monitored directory, so neither startup time nor kernel memory depend
+# on the number of directories. Events carry the handle of the parent
+# directory and the entry name (FAN_REPORT_DFID_NAME, Linux 5.9), the
+# directory is resolved to a path with open_by_handle_at. Events outside
+# the monitored directory are dropped, the rest are turned into
+# pyinotify-like events and fed to NetDiskEventHandler.
+#
+# fanotify_init requires CAP_SYS_ADMIN, OSError is raised without it so
+# that the caller can fall back to inotify.
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import os
+import struct
+
+import pyinotify
+
+# flags of fanotify_init, see linux/fanotify.h
+FAN_CLASS_NOTIF      = 0x00000000
+FAN_CLOEXEC          = 0x00000001
+FAN_NONBLOCK         = 0x00000002
+FAN_REPORT_FID       = 0x00000200
+FAN_REPORT_DIR_FID   = 0x00000400
+FAN_REPORT_NAME      = 0x00000800
+FAN_REPORT_DFID_NAME = FAN_REPORT_DIR_FID | FAN_REPORT_NAME
+
+# flags of fanotify_mark
+FAN_MARK_ADD         = 0x00000001
+FAN_MARK_FILESYSTEM  = 0x00000100
+
+# events
+FAN_CLOSE_WRITE      = 0x00000008
+FAN_MOVED_FROM       = 0x00000040
+FAN_MOVED_TO         = 0x00000080
+FAN_CREATE           = 0x00000100
+FAN_DELETE           = 0x00000200
+FAN_Q_OVERFLOW       = 0x00004000
+FAN_RENAME           = 0x10000000
+FAN_ONDIR            = 0x40000000
+
+# types of information records
+FAN_EVENT_INFO_TYPE_DFID_NAME     = 2
+FAN_EVENT_INFO_TYPE_OLD_DFID_NAME = 10
+FAN_EVENT_INFO_TYPE_NEW_DFID_NAME = 12
+
+FAN_NOFD = -1
+O_PATH   = 0o10000000
+
+# struct fanotify_event_metadata
+METADATA = struct.Struct("=IBBHQii")
+# struct fanotify_event_info_header
+INFO_HEADER = struct.Struct("=BBH")
+# fsid, handle_bytes and handle_type of struct fanotify_event_info_fid
+INFO_FID = struct.Struct("=8sIi")
+
+# fanotify events in the order they are dispatched when merged, paired
+# with inotify events the handler understands
+EVENT_MAP = ((FAN_CREATE,      pyinotify.IN_CREATE),
+             (FAN_MOVED_TO,    pyinotify.IN_MOVED_TO),
+             (FAN_CLOSE_WRITE, pyinotify.IN_CLOSE_WRITE),
+             (FAN_MOVED_FROM,  pyinotify.IN_MOVED_FROM),
+             (FAN_DELETE,      pyinotify.IN_DELETE))
+# events meaning the entry exists afterwards
+EXIST_EVENTS = FAN_CREATE | FAN_MOVED_TO | FAN_CLOSE_WRITE
+
+class FanEvent:
+    """A change record shaped like pyinotify.Event."""
+    def __init__(self, mask, path, name, cookie=0):
+        self.mask     = mask
+        self.path     = path
+        self.name     = name
+        self.pathname = os.path.join(path, name)
+        self.dir      = bool(mask & pyinotify.IN_ISDIR)
+        self.cookie   = cookie
+        self.wd       = -1
+
+class FanotifyNotifier:
+    """Feed changes under a directory, found by a fanotify filesystem
+mark, to an event handler."""
+    BUFSIZE = 65536
+
+    def __init__(self, rootpath, handler, DEBUG=False):
+        """Params:
+    rootpath: absolute path of the monitored directory;
+    handler: NetDiskEventHandler receiving the events."""
+        FanotifyNotifier.DEBUG = DEBUG
+        # resolved paths are reported relative to rootpath as configured
+        self.srcdir   = rootpath.rstrip(os.path.sep)
+        self.rootpath = os.path.realpath(rootpath)
+        self.handler  = handler
+        self.buffered = ""
+        # rename events pair both names in one record, give them a cookie
+        self.cookies  = itertools.count(1)
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), \
+                                use_errno=True)
+        self.libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, \
+            ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+        self.fd = self.libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC | \
+            FAN_NONBLOCK | FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        if self.fd < 0:
+            _raise_errno("fanotify_init")
+        # handles are resolved relative to the monitored mount
+        self.mount_fd = os.open(self.rootpath, os.O_RDONLY)
+
+        try:
+            mask = FAN_CREATE | FAN_DELETE | FAN_CLOSE_WRITE | FAN_ONDIR
+            try:
+                # both names of a rename in one event, Linux 5.17
+                self._mark(mask | FAN_RENAME)
+            except OSError as e:
+                if not e.errno == errno.EINVAL:
+                    raise
+                self._mark(mask | FAN_MOVED_FROM | FAN_MOVED_TO)
+        except OSError:
+            self.stop()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """Read queued events, they are kept until process_events."""
+        self.buffered = ""
+        while True:
+            try:
+                data = os.read(self.fd, FanotifyNotifier.BUFSIZE)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not len(data):
+                break
+            self.buffered = self.buffered + data
+
+    def process_events(self):
+        """Dispatch events read by read_events to the handler."""
+        data = self.buffered
+        self.buffered = ""
+        offset = 0
+        while offset + METADATA.size <= len(data):
+            (event_len, vers, reserved, metadata_len, mask, fd, pid) = \
+                METADATA.unpack_from(data, offset)
+            if not fd == FAN_NOFD:
+                os.close(fd)
+            self._dispatch(mask, \
+                data[offset + metadata_len:offset + event_len])
+            offset = offset + event_len
+
+    def stop(self):
+        """Close the fanotify group."""
+        for fd in (self.fd, getattr(self, "mount_fd", -1)):
+            if fd >= 0:
+                os.close(fd)
+        self.fd = -1
+
+    def _mark(self, mask):
+        if self.libc.fanotify_mark(self.fd, FAN_MARK_ADD | \
+                FAN_MARK_FILESYSTEM, mask, -1, self.rootpath) < 0:
+            _raise_errno("fanotify_mark")
+
+    def _dispatch(self, mask, info):
+        if mask & FAN_Q_OVERFLOW:
+            self.handler(FanEvent(pyinotify.IN_Q_OVERFLOW, "", ""))
+            return
+
+        records = self._parse_info(info)
+        isdir   = pyinotify.IN_ISDIR if mask & FAN_ONDIR else 0
+
+        if mask & FAN_RENAME:
+            old = records.get(FAN_EVENT_INFO_TYPE_OLD_DFID_NAME)
+            new = records.get(FAN_EVENT_INFO_TYPE_NEW_DFID_NAME)
+            cookie = self.cookies.next()
+            if old:
+                self.handler(FanEvent(pyinotify.IN_MOVED_FROM | isdir, \
+                    old[0], old[1], cookie))
+            if new:
+                self.handler(FanEvent(pyinotify.IN_MOVED_TO | isdir, \
+                    new[0], new[1], cookie))
+            return
+
+        record = records.get(FAN_EVENT_INFO_TYPE_DFID_NAME)
+        if not record:
+            return
+        (path, name) = record
+
+        # merged events are reduced to the state of the entry now
+        if os.path.lexists(os.path.join(path, name)):
+            mask = mask & ~(FAN_MOVED_FROM | FAN_DELETE)
+        elif mask & (FAN_CREATE | FAN_MOVED_TO):
+            # appeared and vanished since last read, nothing to commit
+            return
+        else:
+            mask = mask & ~EXIST_EVENTS
+        for (fan_mask, in_mask) in EVENT_MAP:
+            if mask & fan_mask:
+                # moves without rename records are never paired
+                self.handler(FanEvent(in_mask | isdir, path, name, \
+                    self.cookies.next()))
+
+    # parse information records into {type: (directory path, name)}
+    def _parse_info(self, info):
+        records = {}
+        offset  = 0
+        while offset + INFO_HEADER.size <= len(info):
+            (info_type, pad, length) = INFO_HEADER.unpack_from(info, offset)
+            if not length:
+                break
+            body = info[offset + INFO_HEADER.size:offset + length]
+            offset = offset + length
+
+            (fsid, handle_bytes, handle_type) = INFO_FID.unpack_from(body)
+            handle = body[INFO_FID.size:INFO_FID.size + handle_bytes]
+            name   = body[INFO_FID.size + handle_bytes:].split("\0", 1)[0]
+            path   = self._resolve(handle_bytes, handle_type, handle)
+            if path:
+                # outside the monitored directory otherwise
+                records[info_type] = (path, name)
+
+        return records
+
+    # path of a directory given its file handle, None if gone or not
+    # under the monitored directory
+    def _resolve(self, handle_bytes, handle_type, handle):
+        fh = ctypes.create_string_buffer( \
+            struct.pack("=Ii", handle_bytes, handle_type) + handle)
+        fd = self.libc.open_by_handle_at(self.mount_fd, fh, O_PATH)
+        if fd < 0:
+            # removed, or on another file system
+            return None
+        try:
+            path = os.readlink("/proc/self/fd/%d" % fd)
+        finally:
+            os.close(fd)
+        if path.endswith(" (deleted)"):
+            return None
+
+        if path == self.rootpath:
+            return self.srcdir
+        elif path.startswith(self.rootpath + os.path.sep):
+            return self.srcdir + path[len(self.rootpath):]
+        else:
+            return None
+
+def _raise_errno(func):
+    e = ctypes.get_errno()
+    raise OSError(e, "%s: %s" % (func, os.strerror(e)))
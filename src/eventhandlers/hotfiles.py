@@ -0,0 +1,137 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements hot file detection for the event handler.
+#
+# A file written more than HOT_WRITES times within HOT_WINDOW seconds is
+# hot, e.g. a database, a log or a virtual machine image. A hot file is
+# uploaded at most once per QUIET_PERIOD: writes in between only arm a
+# timer, which uploads whatever the file holds when it fires, thus the
+# latest version is always sent.
+import collections
+import time
+
+class HotFileTracker:
+    """Track write frequency per path and defer uploads of hot files."""
+    # default tunables, overridden by global configuration
+    HOT_WINDOW   = 60               # seconds of write history kept
+    HOT_WRITES   = 3                # writes within window to be hot
+    QUIET_PERIOD = 300              # seconds between uploads of hot files
+
+    def __init__(self, loop, configure, DEBUG=False):
+        """Params:
+    loop: event loop running deferred uploads;
+    configure: system-wise configuration."""
+        HotFileTracker.DEBUG = DEBUG
+        self.loop   = loop
+        self.window = int(configure.get("HOT_WINDOW", \
+            HotFileTracker.HOT_WINDOW))
+        self.writes = int(configure.get("HOT_WRITES", \
+            HotFileTracker.HOT_WRITES))
+        self.quiet  = int(configure.get("QUIET_PERIOD", \
+            HotFileTracker.QUIET_PERIOD))
+        # callback(path, name) uploading a file, set by the owner
+        self.callback = None
+
+        # path -> deque of write timestamps
+        self.history  = {}
+        # path -> time of last upload
+        self.uploaded = {}
+        # path -> timer of deferred upload
+        self.deferred = {}
+
+        self.stats = collections.OrderedDict()
+        for key in ("writes", "uploads", "deferred", "coalesced", \
+                    "hot_files"):
+            self.stats[key] = 0
+
+    def written(self, path, name):
+        """Record a write to a file.
+Params:
+    path: directory of the file;
+    name: file name.
+
+Return:
+    True if the file should be uploaded now, False if deferred."""
+        now   = time.time()
+        fpath = (path, name)
+        self.stats["writes"] = self.stats["writes"] + 1
+
+        history = self.history.setdefault(fpath, collections.deque())
+        history.append(now)
+        while history[0] < now - self.window:
+            history.popleft()
+
+        if fpath in self.deferred:
+            # upload pending already, it picks up this version
+            self.stats["coalesced"] = self.stats["coalesced"] + 1
+            return False
+
+        last = self.uploaded.get(fpath, 0)
+        if len(history) <= self.writes or now - last >= self.quiet:
+            self._uploading(fpath, now)
+            return True
+
+        # hot and uploaded recently, wait for the quiet period to pass
+        self.stats["deferred"] = self.stats["deferred"] + 1
+        self.deferred[fpath] = self.loop.call_later( \
+            last + self.quiet - now, self._fire, fpath)
+        if HotFileTracker.DEBUG:
+            print "[DEBUG] Hot file deferred:", path, name
+
+        return False
+
+    def forget(self, path, name):
+        """Stop tracking a removed file."""
+        fpath = (path, name)
+        timer = self.deferred.pop(fpath, None)
+        if timer:
+            self.loop.cancel(timer)
+        self.history.pop(fpath, None)
+        self.uploaded.pop(fpath, None)
+        self._count_hot()
+
+    def dump(self, fname):
+        """Write statistics to a file as `key=value' lines."""
+        f = open(fname, "w")
+        for (key, value) in self.stats.items():
+            f.write("%s=%d\n" % (key, value))
+        f.close()
+
+    def _fire(self, fpath):
+        del self.deferred[fpath]
+        self._uploading(fpath, time.time())
+        self.callback(*fpath)
+
+    def _uploading(self, fpath, now):
+        self.stats["uploads"] = self.stats["uploads"] + 1
+        self.uploaded[fpath] = now
+        self._expire(now)
+
+    # drop files idle for longer than both window and quiet period
+    def _expire(self, now):
+        idle = now - max(self.window, self.quiet)
+        stale = [fpath for (fpath, history) in self.history.items() \
+                 if history[-1] < idle and not fpath in self.deferred]
+        for fpath in stale:
+            del self.history[fpath]
+            self.uploaded.pop(fpath, None)
+        self._count_hot()
+
+    def _count_hot(self):
+        self.stats["hot_files"] = len([h for h in self.history.values() \
+            if len(h) > self.writes])
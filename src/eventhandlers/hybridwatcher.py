@@ -0,0 +1,215 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements a two-tier directory watcher for huge trees.
+#
+# Recently active directories (hot) hold a non-recursive inotify watch,
+# while all the other directories (cold) are covered by a throttled
+# background scan comparing modification times. Directories are promoted
+# once activity is detected and demoted after being idle for a while, so
+# the number of inotify watches no longer grows with the size of the tree.
+import os
+import stat
+import time
+
+class HybridWatcher:
+    """Watch hot directories with inotify and scan cold ones by mtime."""
+    # default tunables, overridden by global configuration
+    HOT_DIR_LIMIT = 8192          # maximum number of inotify watches
+    HOT_DIR_TTL   = 3600          # idle seconds before a watch is dropped
+    COLD_SCAN_INTERVAL = 300      # upper bound of cold detection latency
+    COLD_SCAN_RATE     = 2000     # minimum directory entries stat-ed per second
+
+    def __init__(self, wm, rootpath, mask, localfs, configure, DEBUG=False):
+        """Params:
+    wm: pyinotify watch manager;
+    rootpath: absolute path of the monitored directory;
+    mask: inotify event mask of hot directories;
+    localfs: local HDDFS instance, used for exclude patterns;
+    configure: system-wise configuration."""
+        HybridWatcher.DEBUG = DEBUG
+        self.wm       = wm
+        self.rootpath = rootpath
+        self.mask     = mask
+        self.localfs  = localfs
+        # directory rescan callback, called as callback(path, since)
+        self.callback = None
+
+        self.hot_limit = int(configure.get("HOT_DIR_LIMIT", \
+                                           HybridWatcher.HOT_DIR_LIMIT))
+        self.hot_ttl   = int(configure.get("HOT_DIR_TTL", \
+                                           HybridWatcher.HOT_DIR_TTL))
+        self.interval  = int(configure.get("COLD_SCAN_INTERVAL", \
+                                           HybridWatcher.COLD_SCAN_INTERVAL))
+        self.min_rate  = int(configure.get("COLD_SCAN_RATE", \
+                                           HybridWatcher.COLD_SCAN_RATE))
+
+        # hot directories, path -> [watch descriptor, last activity]
+        self.hot  = {}
+        # cold directories, path -> directory mtime seen by last scan
+        self.cold = {}
+
+        # state of the running scan round
+        self.round_stack  = []
+        self.round_start  = 0
+        # entries visited by current round and the whole last round
+        self.round_visits = 0
+        self.last_visits  = 0
+        # changes newer than this timestamp are reported by current round
+        self.since     = time.time()
+        self.last_step = time.time()
+
+    def start(self):
+        """Register the root watch and begin the first scan round."""
+        # root of the tree is always kept hot
+        self.promote(self.rootpath)
+        self._new_round()
+
+    def activity(self, path):
+        """Record an inotify event observed in a hot directory.
+Params:
+    path: absolute path of the watched directory."""
+        try:
+            self.hot[path][1] = time.time()
+        except KeyError:
+            # event of a watch already demoted
+            pass
+
+    def promote(self, path):
+        """Put a watch on given directory.
+Params:
+    path: absolute path of the directory to watch.
+
+Return:
+    None. Silently ignored if the directory vanished."""
+        if path in self.hot:
+            self.hot[path][1] = time.time()
+            return
+
+        if len(self.hot) >= self.hot_limit:
+            self._evict(1)
+
+        wdd = self.wm.add_watch(path, self.mask, rec=False, auto_add=False)
+        wd  = wdd.get(path, -1)
+        if wd < 0:
+            # directory has been removed meanwhile
+            return
+
+        if HybridWatcher.DEBUG:
+            print "[DEBUG] Promote hot directory:", path
+
+        self.hot[path] = [wd, time.time()]
+        self.cold.pop(path, None)
+
+    def demote(self, path):
+        """Drop the watch of given directory, the scan covers it from now on.
+Params:
+    path: absolute path of the watched directory."""
+        if path == self.rootpath:
+            return
+
+        (wd, ignored) = self.hot.pop(path)
+        self.wm.rm_watch(wd, quiet=True)
+        if HybridWatcher.DEBUG:
+            print "[DEBUG] Demote cold directory:", path
+
+        try:
+            self.cold[path] = os.lstat(path).st_mtime
+        except OSError:
+            # directory removed, its parent will notice
+            pass
+
+    def tick(self):
+        """Expire idle watches and advance the cold scan.
+
+Should be called periodically by the main loop. The number of entries
+stat-ed is limited in proportion to the time elapsed since last call."""
+        now = time.time()
+        for path in [p for p in self.hot \
+                     if now - self.hot[p][1] > self.hot_ttl]:
+            self.demote(path)
+
+        # scan fast enough that one round finishes within the interval
+        rate = max(self.min_rate, self.last_visits / max(self.interval, 1))
+        budget = int((now - self.last_step) * rate) + 1
+        self.last_step = now
+        self._scan(budget)
+
+    def _scan(self, budget):
+        while budget > 0:
+            if not len(self.round_stack):
+                self._new_round()
+                return
+
+            path = self.round_stack.pop()
+            try:
+                names = os.listdir(path)
+                dir_mtime = os.lstat(path).st_mtime
+            except OSError:
+                # vanished, the parent directory reports the change
+                self.cold.pop(path, None)
+                continue
+
+            changed = False
+            for name in names:
+                if self.localfs.is_omitted(name):
+                    continue
+                abspath = os.path.join(path, name)
+                try:
+                    st = os.lstat(abspath)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    self.round_stack.append(abspath)
+                elif max(st.st_mtime, st.st_ctime) >= self.since:
+                    # content of a file modified in place
+                    changed = True
+            budget = budget - len(names) - 1
+            self.round_visits = self.round_visits + len(names) + 1
+
+            if path in self.hot:
+                # covered by inotify
+                continue
+
+            try:
+                # entries created, removed or renamed
+                changed = changed or not self.cold[path] == dir_mtime
+            except KeyError:
+                # first visit, content up to date with initial backup
+                pass
+            self.cold[path] = dir_mtime
+
+            if changed:
+                self.promote(path)
+                if self.callback:
+                    self.callback(path, self.since)
+
+    def _new_round(self):
+        # report changes since previous round start, the stat above may
+        # race with writers, thus we overlap rounds slightly
+        self.since = self.round_start or self.since
+        self.round_start  = time.time()
+        self.last_visits  = self.round_visits
+        self.round_visits = 0
+        self.round_stack  = [self.rootpath]
+
+    def _evict(self, count):
+        # demote least recently active directories
+        lru = sorted([p for p in self.hot if not p == self.rootpath], \
+                     key=lambda p: self.hot[p][1])
+        for path in lru[:count]:
+            self.demote(path)
@@ -0,0 +1,345 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements on-demand hydration of restored files.
+#
+# In hydration mode remote files are restored as placeholders: sparse
+# files of the right size carrying their object id in an extended
+# attribute, thus they take no disk blocks. Each placeholder inode gets a
+# fanotify FAN_OPEN_PERM mark. The first open of a placeholder blocks
+# until a worker has downloaded the object and written it into the very
+# inode being opened, then the attribute and the mark are removed.
+# Writes through fanotify descriptors raise no events, so hydration is
+# never mistaken for a local change.
+#
+# Placeholders are also hydrated in background within a byte budget,
+# siblings of recently opened files first, then shallow and small files.
+#
+# Permission events require CAP_SYS_ADMIN, OSError is raised without it
+# so that the caller can restore files in full instead.
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import os
+import Queue
+import random
+import struct
+import threading
+import traceback
+
+import eventhandlers.fanotifier
+
+# shared with the notification group
+METADATA          = eventhandlers.fanotifier.METADATA
+FAN_CLOEXEC       = eventhandlers.fanotifier.FAN_CLOEXEC
+FAN_MARK_ADD      = eventhandlers.fanotifier.FAN_MARK_ADD
+FAN_NOFD          = eventhandlers.fanotifier.FAN_NOFD
+
+# flags of fanotify_init and fanotify_mark, see linux/fanotify.h
+FAN_CLASS_CONTENT = 0x00000004
+FAN_MARK_REMOVE   = 0x00000002
+FAN_OPEN_PERM     = 0x00010000
+
+# struct fanotify_response
+RESPONSE  = struct.Struct("=iI")
+FAN_ALLOW = 0x01
+FAN_DENY  = 0x02
+
+AT_FDCWD  = -100
+
+class Hydrator:
+    """Restore files as placeholders and fill them on first open."""
+    XATTR      = "user.rosycloud.obj_id"    # attribute holding object id
+    BUFSIZE    = 4096
+    TMP_PREFIX = ".rosycloud-"              # prefix of temporary files
+    # default tunables, overridden by global configuration
+    THREADS        = 4                  # concurrent hydrations on open
+    PREFETCH_LIMIT = 1073741824         # bytes hydrated in background
+
+    def __init__(self, target, repo_fs, configure, DEBUG=False):
+        """Params:
+    target: HDDFS holding the placeholders;
+    repo_fs: BackupFileSystem to download from;
+    configure: system-wise configuration."""
+        Hydrator.DEBUG = DEBUG
+        self.target   = target
+        self.repo_fs  = repo_fs
+        self.threads  = int(configure.get("HYDRATE_THREADS", \
+            Hydrator.THREADS))
+        # bytes left to prefetch
+        self.budget   = int(configure.get("HYDRATE_PREFETCH", \
+            Hydrator.PREFETCH_LIMIT))
+
+        self.lock     = threading.Condition()
+        # placeholders not hydrated yet
+        # path -> [obj_id, fsize, depth, boosted]
+        self.pending  = {}
+        # directory -> set of pending paths in it
+        self.dirs     = {}
+        # heap of (key, path), stale if key differs from pending
+        self.prefetch = []
+        # (dev, inode) of files being hydrated on open
+        self.inflight = set()
+        # permission events waiting for workers
+        self.events   = Queue.Queue()
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), \
+                                use_errno=True)
+        self.libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, \
+            ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        self.fd = self.libc.fanotify_init(FAN_CLASS_CONTENT | FAN_CLOEXEC, \
+            os.O_RDWR | os.O_LARGEFILE)
+        if self.fd < 0:
+            _raise_errno("fanotify_init")
+
+    def start(self):
+        """Start serving opens and prefetching."""
+        for target in [self._read] + [self._work] * self.threads + \
+                [self._prefetch]:
+            worker = threading.Thread(target=target)
+            worker.daemon = True
+            worker.start()
+
+    def place(self, entry, path):
+        """Make a placeholder of a file, to be renamed into place.
+Params:
+    entry: DirEntry of the file;
+    path: path of the placeholder.
+
+Return:
+    True if done, False if it cannot be watched and the file should be
+    restored in full."""
+        f = open(path, "wb")
+        f.truncate(entry.fsize)
+        f.close()
+        try:
+            self._setxattr(path, entry.obj_id)
+            self._mark(FAN_MARK_ADD, AT_FDCWD, path)
+        except OSError as e:
+            os.unlink(path)
+            if e.errno in (errno.ENOSPC, errno.ENOTSUP):
+                # out of marks, or no user attributes on file system
+                return False
+            raise
+        return True
+
+    def watch(self, abspath, obj_id, fsize, mark=True):
+        """Queue a placeholder for prefetch.
+Params:
+    abspath: absolute path of the placeholder;
+    obj_id: object id it carries;
+    fsize: size of the file;
+    mark: False if placed by place(), True if left by a former run and
+          its mark is to be set again."""
+        if mark:
+            try:
+                self._mark(FAN_MARK_ADD, AT_FDCWD, abspath)
+            except OSError as e:
+                if not e.errno == errno.ENOSPC:
+                    raise
+                # out of marks, an unwatched placeholder must not be read
+                self._hydrate_path(abspath, obj_id, fsize)
+                return
+        self.lock.acquire()
+        self.pending[abspath] = [obj_id, fsize, \
+            abspath.count(os.path.sep), False]
+        self.dirs.setdefault(os.path.dirname(abspath), set()).add(abspath)
+        heapq.heappush(self.prefetch, (self._key(abspath), abspath))
+        self.lock.notify()
+        self.lock.release()
+
+    def placeholder_id(self, abspath):
+        """Object id of a placeholder, None if abspath is a regular file."""
+        buf = ctypes.create_string_buffer(64)
+        size = self.libc.getxattr(abspath, Hydrator.XATTR, buf, len(buf))
+        if size < 0:
+            return None
+        return buf.raw[:size]
+
+    # read permission events, they are answered by workers
+    def _read(self):
+        while True:
+            try:
+                data = os.read(self.fd, Hydrator.BUFSIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset + METADATA.size <= len(data):
+                (event_len, vers, reserved, metadata_len, mask, fd, pid) = \
+                    METADATA.unpack_from(data, offset)
+                offset = offset + event_len
+                if mask & FAN_OPEN_PERM and not fd == FAN_NOFD:
+                    self.events.put(fd)
+
+    def _work(self):
+        while True:
+            fd = self.events.get()
+            response = FAN_DENY
+            try:
+                self._hydrate_open(fd)
+                response = FAN_ALLOW
+            except Exception:
+                # opener fails rather than reading zeros
+                traceback.print_exc()
+            finally:
+                os.write(self.fd, RESPONSE.pack(fd, response))
+                os.close(fd)
+
+    # fill the inode being opened
+    def _hydrate_open(self, fd):
+        st  = os.fstat(fd)
+        key = (st.st_dev, st.st_ino)
+        self.lock.acquire()
+        while key in self.inflight:
+            # opened again while hydrating, wait for the first one
+            self.lock.wait()
+        obj_id = self._fgetxattr(fd)
+        if obj_id:
+            self.inflight.add(key)
+        self.lock.release()
+        if not obj_id:
+            return
+
+        path = os.readlink("/proc/self/fd/%d" % fd)
+        try:
+            if Hydrator.DEBUG:
+                print "[DEBUG] Hydrate on open:", path
+            self._fill(fd, obj_id)
+            self._fremovexattr(fd)
+            self._mark(FAN_MARK_REMOVE, fd, None)
+            # content written is the object, no upload on next scan
+            self.target.cache_stat(os.fstat(fd), os.path.basename(path), \
+                obj_id, st.st_size)
+        finally:
+            self.lock.acquire()
+            self.inflight.discard(key)
+            self._boost(path)
+            self.lock.notify_all()
+            self.lock.release()
+
+    # download an object and write it through a descriptor as it arrives,
+    # a failure leaves the placeholder marked, thus filled again later
+    def _fill(self, fd, obj_id):
+        os.lseek(fd, 0, os.SEEK_SET)
+        for cont in self.repo_fs.open_read(obj_id):
+            while len(cont):
+                cont = cont[os.write(fd, cont):]
+
+    # files in the directory of an opened file are likely opened next
+    def _boost(self, path):
+        self._forget(path)
+        for sibling in self.dirs.get(os.path.dirname(path), ()):
+            if not self.pending[sibling][3]:
+                self.pending[sibling][3] = True
+                heapq.heappush(self.prefetch, (self._key(sibling), sibling))
+
+    def _forget(self, path):
+        if self.pending.pop(path, None):
+            siblings = self.dirs[os.path.dirname(path)]
+            siblings.discard(path)
+            if not len(siblings):
+                del self.dirs[os.path.dirname(path)]
+
+    def _key(self, path):
+        (obj_id, fsize, depth, boosted) = self.pending[path]
+        return (not boosted, depth, fsize)
+
+    # hydrate placeholders in background while budget lasts
+    def _prefetch(self):
+        while True:
+            self.lock.acquire()
+            while not len(self.prefetch):
+                self.lock.wait()
+            (key, path) = heapq.heappop(self.prefetch)
+            if not path in self.pending or not key == self._key(path) or \
+                    self.pending[path][1] > self.budget:
+                # hydrated, queued again or too large
+                self.lock.release()
+                continue
+            (obj_id, fsize, depth, boosted) = self.pending[path]
+            self._forget(path)
+            self.budget = self.budget - fsize
+            self.lock.release()
+
+            try:
+                self._hydrate_path(path, obj_id, fsize)
+            except Exception:
+                # still hydrated on open
+                traceback.print_exc()
+
+    # replace a placeholder by a full copy
+    def _hydrate_path(self, path, obj_id, fsize):
+        # compared again right before the placeholder is replaced
+        st = os.lstat(path)
+        if not self.placeholder_id(path) == obj_id:
+            # hydrated on open, or replaced meanwhile
+            return
+        if Hydrator.DEBUG:
+            print "[DEBUG] Prefetch:", path
+
+        (dirname, fname) = os.path.split(path)
+        tmp_path = os.path.join(dirname, Hydrator.TMP_PREFIX + \
+            "%016x-" % random.getrandbits(64) + fname)
+        # expected before it exists, its events are not local changes
+        self.target.expect_write(tmp_path, fsize)
+        try:
+            self.repo_fs.retrieve_to_file(obj_id, tmp_path)
+            os.chmod(tmp_path, st.st_mode & 07777)
+            cur = os.lstat(path)
+            if not (cur.st_ino, cur.st_size, cur.st_mtime) == \
+                    (st.st_ino, st.st_size, st.st_mtime):
+                # hydrated on open or modified by user while downloading
+                return
+            self.target.expect_write(path, fsize)
+            try:
+                os.rename(tmp_path, path)
+            finally:
+                self.target.settle_write(path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            # events of the name wait for the write to settle
+            self.target.settle_write(tmp_path)
+        self.target.cache_stat(os.stat(path), fname, obj_id, fsize)
+
+    def _mark(self, flags, dirfd, path):
+        if self.libc.fanotify_mark(self.fd, flags, FAN_OPEN_PERM, dirfd, \
+                path) < 0:
+            _raise_errno("fanotify_mark")
+
+    def _setxattr(self, path, obj_id):
+        if self.libc.setxattr(path, Hydrator.XATTR, obj_id, len(obj_id), \
+                0) < 0:
+            _raise_errno("setxattr")
+
+    def _fgetxattr(self, fd):
+        buf = ctypes.create_string_buffer(64)
+        size = self.libc.fgetxattr(fd, Hydrator.XATTR, buf, len(buf))
+        if size < 0:
+            return None
+        return buf.raw[:size]
+
+    def _fremovexattr(self, fd):
+        if self.libc.fremovexattr(fd, Hydrator.XATTR) < 0:
+            _raise_errno("fremovexattr")
+
+def _raise_errno(func):
+    e = ctypes.get_errno()
+    raise OSError(e, "%s: %s" % (func, os.strerror(e)))
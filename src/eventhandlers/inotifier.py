@@ -16,16 +16,30 @@
 # along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
 
 # this file implements event handler with inotify mechanism
+import collections
 import copy
 import fnmatch
 import os
 import pyinotify
+import stat
 import time
+import traceback
 
 import rosycloud
 import fs.meta.dir
+import fs.staging
 
 class NetDiskEventHandler(pyinotify.ProcessEvent):
+    # seconds to wait for the `move to' half of a rename
+    MOVE_PAIR_TIMEOUT = 60
+    # on queue overflow, watched directories and directories active this
+    # many seconds before it are rescanned, after the burst settled for
+    # OVERFLOW_SETTLE seconds
+    OVERFLOW_WINDOW = 10
+    OVERFLOW_SETTLE = 1
+    # seconds between checks of a remote write its events wait for
+    SELF_WRITE_RETRY = 0.5
+
     def __init__(self, localfs, remotefs, omit_patterns, conf, DEBUG = False):
         super(pyinotify.ProcessEvent, self).__init__()
 
@@ -35,25 +49,77 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
         # patterns should be omitted
         self.omits   = omit_patterns
         self.configure = conf
-        # distinct different move operation
-        self.move_cookie    = 0
-        # dir entry object of the moved file/directory
-        self.move_src_entry = None
-        self.move_from = ""
+        # unpaired `move from' events keyed on cookie
+        # (dir entry, source name, snapshot committed, timestamp)
+        self.pending_moves = {}
+        # uploads read local files through staging area
+        self.staging   = fs.staging.StagingArea(conf["SYS_TMP"], \
+            int(conf.get("STAGE_COPY_LIMIT", \
+                         fs.staging.StagingArea.COPY_LIMIT)), DEBUG)
+        # hybrid watcher, if set, is told about directory activities
+        self.watcher   = None
+        # event loop, if set, large uploads run in background
+        self.loop      = None
+        # hot file tracker, if set, throttles uploads of churny files
+        self.hotfiles  = None
+        # watch manager, if set, lists watched directories on overflow
+        self.wm        = None
+        # directory -> time of its last event, least recent first, kept
+        # for OVERFLOW_WINDOW seconds
+        self.active_dirs = collections.OrderedDict()
+        # start of the window to repair after a queue overflow
+        self.overflow  = None
+        # path -> events, in order, waiting for a remote write to settle
+        self.parked    = {}
+        # local changes held while a restore is in progress, as
+        # (function, args) in order, None if not holding
+        self.held      = None
 
         self.UPDATE_LOG = open("UPDATE_LOG", "a+")
+
+    def __call__(self, event):
+        if not event.mask & pyinotify.IN_Q_OVERFLOW and \
+                not self.localfs.is_subscribed(event.pathname, event.dir):
+            # not kept on this device, committed entries are carried
+            return None
+
+        if self.loop and not event.mask & pyinotify.IN_Q_OVERFLOW and \
+                (event.pathname in self.parked or \
+                 self.localfs.is_write_pending(event.pathname)):
+            # remote sync still writing, later events of the path keep
+            # their order behind the parked ones
+            if not event.pathname in self.parked:
+                self.parked[event.pathname] = []
+                self.loop.call_later(NetDiskEventHandler.SELF_WRITE_RETRY, \
+                    self._unpark, event.pathname)
+            self.parked[event.pathname].append(event)
+            return None
+
+        if self.held is not None:
+            # writes of the restore are filtered out while expected
+            if event.mask & pyinotify.IN_Q_OVERFLOW or \
+                    not self._is_self_write(event):
+                self.held.append((self.__call__, (event,)))
+            return None
+
+        if not event.mask & pyinotify.IN_Q_OVERFLOW:
+            self._touch_dir(event.path)
+            if self.watcher:
+                self.watcher.activity(event.path)
+
+        return pyinotify.ProcessEvent.__call__(self, event)
     
     # create a new dir node
     def process_IN_CREATE(self, event):
+        local = not self._is_self_write(event)
         if self.DEBUG:
             print "[DEBUG] Inotify event: IN_CREATE"
-            if self.localfs.source:
+            if local:
                 print "[DEBUG] Modify filesystem directly."
             else:
                 print "[DEBUG] Sync from cloud, filter out."
 
-        if not self._is_file_omitted(event.name) and \
-                self.localfs.source:
+        if not self._is_file_omitted(event.name) and local:
             if event.dir:
                 # create an empty dir reference
                 entry = fs.meta.dir.DirEntry()
@@ -69,7 +135,8 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
                 self.localfs.fs_hierachy = \
                     fs.filesystem.hierachy( \
                         self.localfs.get_snapshot(root).root, \
-                        self.remotfs, self.localfs)
+                        self.remotfs, self.localfs, \
+                        self.localfs.subscription)
     
                 path_stk = self.localfs.find( \
                     self.localfs.native_path(event.path), \
@@ -77,24 +144,28 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
                 # there must be at least one component, the root entry
                 assert(len(path_stk))
                 self._update_dir(path_stk, entry)
-            else:
-                # create a hard link when writing
-                tmp_file = self._get_tmp_file_name(event.name)
-                os.link(event.pathname, tmp_file)
+                if self.watcher:
+                    # a new directory is likely to be filled soon
+                    self.watcher.promote(event.pathname)
+            # a new file is staged when closed after writing
                     
             # clean up
             self._clear_mv_pair()
 
     # delete a new dir node
     def process_IN_DELETE(self, event):
+        local = not self._is_self_write(event)
         if self.DEBUG:
             print "[DEBUG] Inotify event: IN_DELETE"
-            if self.localfs.source:
+            if local:
                 print "[DEBUG] Modify filesystem directly."
             else:
                 print "[DEBUG] Sync from cloud, filter out."
 
-        if not self._is_file_omitted(event.name) and self.localfs.source:
+        if not self._is_file_omitted(event.name) and local:
+            if self.hotfiles and not event.dir:
+                self.hotfiles.forget(event.path, event.name)
+
             root, local_snapshots = \
                 fs.filesystem.tree_snapshot(self.localfs)
             assert(len(root) == 1)
@@ -102,7 +173,8 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
             self.localfs.fs_hierachy = \
                 fs.filesystem.hierachy( \
                     self.localfs.get_snapshot(root).root, \
-                    self.remotfs, self.localfs)
+                    self.remotfs, self.localfs, \
+                    self.localfs.subscription)
 
             path_stk  = self.localfs.find( \
                 self.localfs.native_path(event.path), \
@@ -114,145 +186,453 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
 
             path_stk.append(dup_dir)
             self._update_dir(path_stk, None)
-            tmp_file =  self._get_tmp_file_name(event.name)
-            if os.path.exists(tmp_file):
-                # file not been linked yet
-                os.unlink(tmp_file)
 
             # clean up
             self._clear_mv_pair()
 
     # if writed, upload files onto the cloud
     def process_IN_CLOSE_WRITE(self, event):
+        local = not self._is_self_write(event)
         if self.DEBUG:
             print "[DEBUG] Inotify event: IN_CLOSE_WRITE"
-            if self.localfs.source:
+            if local:
                 print "[DEBUG] Modify filesystem directly."
             else:
                 print "[DEBUG] Sync from cloud, filter out."
 
-        if not (self._is_file_omitted(event.name) or event.dir) and \
-                self.localfs.source:
-            tmp_file = self._get_tmp_file_name(event.name)
-            if not os.path.exists(tmp_file):
-                # file not been linked yet
-                os.link(event.pathname, tmp_file)
-
-            root, local_snapshots = \
-                fs.filesystem.tree_snapshot(self.localfs)
-            assert(len(root) == 1)
-            root = root[0]
-            self.localfs.fs_hierachy = \
-                fs.filesystem.hierachy( \
-                    self.localfs.get_snapshot(root).root, \
-                    self.remotfs, self.localfs)
-
-            path_stk  = self.localfs.find( \
-                self.localfs.native_path(event.path), \
-                self.localfs.fs_hierachy)
-
-            md5  = self.remotfs.store_from_file(tmp_file)
-            new_entry = fs.meta.dir.DirEntry()
-            new_entry.fname  = event.name
-            new_entry.obj_id = md5
-            # get file size
-            new_entry.fsize  = os.stat(tmp_file).st_size
-
-            self._update_dir(path_stk, new_entry)
-            # os.unlink(tmp_file)
-            # clean up
-            self._clear_mv_pair()
+        if not (self._is_file_omitted(event.name) or event.dir) and local:
+            if self.hotfiles and \
+                    not self.hotfiles.written(event.path, event.name):
+                # rewritten frequently, uploaded after a quiet period
+                return
+
+            self.store_file(event.path, event.name)
+
+    def store_file(self, path, name):
+        """Upload a local file and commit it into a new snapshot.
+Params:
+    path: absolute path of the parent directory;
+    name: file name."""
+        if self._hold(self.store_file, path, name):
+            return
+        try:
+            # stage content observed at close
+            staged = self.staging.stage(os.path.join(path, name))
+        except (IOError, OSError):
+            # removed already, its delete event follows
+            return
+
+        scheduler = self.remotfs.scheduler
+        if self.loop and scheduler and \
+                staged.st.st_size > scheduler.small_limit:
+            # large file, upload in background and commit on the loop
+            scheduler.submit(self._upload, (staged,), self.loop, \
+                self._commit_upload, (path, name, staged))
+            return
+
+        md5 = self._upload(staged)
+        self._commit_upload(md5, path, name, staged)
+
+    # upload staged content, return object id or None if not intact
+    def _upload(self, staged):
+        try:
+            md5 = self.remotfs.store_from_file(staged.path)
+            intact = self.staging.intact(staged)
+        finally:
+            self.staging.release(staged)
+        if not intact:
+            # written again while uploading, the next close event
+            # uploads the final content
+            return None
+
+        return md5
+
+    # commit an uploaded file into local snapshot
+    def _commit_upload(self, md5, path, name, staged):
+        if md5 is None or \
+                self._hold(self._commit_upload, md5, path, name, staged):
+            return
+        # stat taken before reading, later writes invalidate it
+        st = staged.st
+        try:
+            now = os.stat(os.path.join(path, name))
+        except OSError:
+            # removed while uploading
+            return
+        if not (now.st_ino, now.st_size, now.st_mtime) == \
+                (st.st_ino, st.st_size, st.st_mtime):
+            # replaced or modified while uploading, a later event
+            # commits the final content
+            return
+
+        self._refresh_hierachy()
+        path_stk = self._find_dir(self.localfs.native_path(path))
+        if path_stk is None:
+            # parent directory moved away while uploading
+            return
+
+        new_entry = fs.meta.dir.DirEntry()
+        new_entry.fname  = name
+        new_entry.obj_id = md5
+        # get file size
+        new_entry.fsize  = st.st_size
+        self.localfs.cache_stat(st, name, md5, new_entry.fsize)
+
+        self._update_dir(path_stk, new_entry)
+        # clean up
+        self._clear_mv_pair()
 
     def process_IN_MOVED_FROM(self, event):
+        local = not self._is_self_write(event)
         if self.DEBUG:
             print "[DEBUG] Inotify event: IN_MOVED_FROM"
-            if self.localfs.source:
+            if local:
                 print "[DEBUG] Modify filesystem directly."
             else:
                 print "[DEBUG] Sync from cloud, filter out."
 
-        if not self._is_file_omitted(event.name) and self.localfs.source:
-            self.move_from = event.name
-
-            root, local_snapshots = \
-                fs.filesystem.tree_snapshot(self.localfs)
-            assert(len(root) == 1)
-            root = root[0]
-            self.localfs.fs_hierachy = \
-                fs.filesystem.hierachy( \
-                    self.localfs.get_snapshot(root).root, \
-                    self.remotfs, self.localfs)
+        if not self._is_file_omitted(event.name) and local:
+            self._refresh_hierachy()
 
             path_stk  = self.localfs.find( \
                 self.localfs.native_path(event.path), \
                 self.localfs.fs_hierachy)
             old_dir = path_stk.pop()
-            # store move information for `move to' to pair
-            self.move_cookie    = event.cookie
-            self.move_src_entry = old_dir.dir_entries[event.name]
+            try:
+                src_entry = old_dir.dir_entries[event.name]
+            except KeyError:
+                # never committed, nothing to remove or to pair
+                return
             new_dir = copy.deepcopy(old_dir)
             del new_dir.dir_entries[event.name]
             path_stk.append(new_dir)
 
             self._update_dir(path_stk, None)
+            # store move information for `move to' to pair, other events
+            # may come in between
+            self.pending_moves[event.cookie] = (copy.deepcopy(src_entry), \
+                event.name, self.localfs.get_root_snapshot_id(), time.time())
 
     # only care files moved into the watched directory
     def process_IN_MOVED_TO(self, event):
+        local = not self._is_self_write(event)
         if self.DEBUG:
             print "[DEBUG] Inotify event: IN_MOVED_TO"
-            if self.localfs.source:
+            if local:
                 print "[DEBUG] Modify filesystem directly."
             else:
                 print "[DEBUG] Sync from cloud, filter out."
 
-        if not self._is_file_omitted(event.name) and self.localfs.source:
+        if not self._is_file_omitted(event.name) and local:
             self.UPDATE_LOG.flush()
 
-            root, local_snapshots = \
-                fs.filesystem.tree_snapshot(self.localfs)
-            assert(len(root) == 1)
-            root = root[0]
-            self.localfs.fs_hierachy = \
-                fs.filesystem.hierachy( \
-                    self.localfs.get_snapshot(root).root, \
-                    self.remotfs, self.localfs)
-
+            self._refresh_hierachy()
             path_stk  = self.localfs.find( \
                 self.localfs.native_path(event.path), \
                 self.localfs.fs_hierachy)
-            # store data first
-            old_dir = path_stk[-1]
-            if self.move_cookie == event.cookie:
+            try:
+                st = os.stat(event.pathname)
+            except OSError:
+                # moved away again, its `move from' handles it
+                return
+
+            move_from = event.name
+            remove_current_ss = False
+            try:
                 # move matched
-                entry = self.move_src_entry
-                # entry name may be changed
-                entry.fname = event.name
-                # current snapshot is an intermediate one
-                remove_current_ss = True
+                (entry, move_from, move_ss, ignore) = \
+                    self.pending_moves.pop(event.cookie)
+                # current snapshot is an intermediate one if no other
+                # commit happened between the pair
+                remove_current_ss = \
+                    move_ss == self.localfs.get_root_snapshot_id()
+            except KeyError:
+                # moved from outside, or the pair has been lost
+                entry = self._find_moved_entry(st, event.dir)
+
+            if entry:
+                # reuse stored object, directory content is not visited
+                if self.DEBUG:
+                    print "[DEBUG] Reuse object of", move_from, ":", \
+                        entry.obj_id
             else:
                 # the same function is for initial sync
-                # (md5, size) = self.localfs.backup_files(event.path, event.name)
-                (md5, size) = self.localfs.backup_files(tmp_path, event.name)
+                (md5, size) = self.localfs.backup_files(event.path, \
+                    event.name)
                 entry = fs.meta.dir.DirEntry()
                 if event.dir:
                     entry.mode = fs.meta.dir.DirEntry.DE_ATTR_DIR
-                entry.fname  = event.name
                 entry.obj_id = md5
                 entry.fsize  = size
-                # current snapshot is a new one
-                remove_current_ss = False
+            # entry name may be changed
+            entry.fname  = event.name
+            # rename changes ctime, keep stat cache hit
+            self.localfs.cache_stat(st, entry.fname, entry.obj_id, \
+                entry.fsize)
 
             self._update_dir(path_stk, entry, remove_current_ss)
-            tmp_from = self._get_tmp_file_name(self.move_from)
-            tmp_to   = self._get_tmp_file_name(event.name)
-            if os.path.exists(tmp_from):
-                # file not been linked yet
-                os.rename(tmp_from, tmp_to)
-            elif not os.path.exists(tmp_to):
-                os.link(event.pathname, tmp_to)
             # clean up
             self._clear_mv_pair()
 
+    # find object of a file or directory moved in by its inode
+    def _find_moved_entry(self, st, isdir):
+        if not self.localfs.stat_cache:
+            return None
+
+        # records of directories follow their latest objects, see
+        # _update_dir, thus a known subtree is not visited again
+        entry = self.localfs.stat_cache.lookup_inode(st)
+        if not entry or not bool(entry.isdir()) == bool(isdir):
+            return None
+
+        return entry
+
+    # reconcile directory content with the hierachy
+    # used when events of the directory are not delivered by inotify
+    def rescan_dir(self, path, since):
+        """Commit changes in a directory not reported by inotify.
+Params:
+    path: absolute path of the directory;
+    since: files modified after this timestamp are re-uploaded."""
+        if not self.localfs.source or \
+                self._hold(self.rescan_dir, path, since):
+            return
+
+        if self.DEBUG:
+            print "[DEBUG] Rescan directory:", path
+
+        self._refresh_hierachy()
+        path_stk = self._find_dir(self.localfs.native_path(path))
+        if path_stk is None:
+            # directory itself is new, rescan its parent instead
+            self.rescan_dir(os.path.dirname(path), since)
+            return
+
+        new_dir = self._rescan_entries(path, path_stk.pop(), since)
+        if new_dir:
+            path_stk.append(new_dir)
+            self._update_dir(path_stk, None)
+
+    # record an event in a directory, forget directories idle longer than
+    # the window unless a repair still needs them
+    def _touch_dir(self, path):
+        now = time.time()
+        self.active_dirs.pop(path, None)
+        self.active_dirs[path] = now
+        if self.overflow is None:
+            while self.active_dirs.itervalues().next() < \
+                    now - NetDiskEventHandler.OVERFLOW_WINDOW:
+                self.active_dirs.popitem(False)
+
+    # events were dropped by the kernel, watched directories are rescanned
+    # once the burst settles
+    def process_IN_Q_OVERFLOW(self, event):
+        if self.DEBUG:
+            print "[DEBUG] Inotify event: IN_Q_OVERFLOW"
+
+        if self.overflow is None:
+            self.overflow = time.time() - NetDiskEventHandler.OVERFLOW_WINDOW
+            if self.loop:
+                self.loop.call_later(NetDiskEventHandler.OVERFLOW_SETTLE, \
+                    self._repair_overflow)
+            else:
+                self._repair_overflow()
+
+    # rescan directories which may have missed events since overflow,
+    # commit all the changes found as one snapshot
+    def _repair_overflow(self):
+        if self._hold(self._repair_overflow):
+            return
+        since = self.overflow
+        self.overflow = None
+        if not self.localfs.source:
+            return
+
+        # directories with events shortly before or after the overflow
+        suspects = [path for (path, last) in self.active_dirs.items() \
+                    if last >= since]
+        # a dropped write in place changes no directory, every watched
+        # directory is rescanned, files known to the stat cache are not
+        # read
+        if self.wm:
+            suspects.extend([watch.path for watch in \
+                self.wm.watches.values()])
+
+        if self.DEBUG:
+            print "[DEBUG] Repair overflow, suspects:", len(set(suspects))
+
+        self._refresh_hierachy()
+        changed = {}
+        visited = set()
+        while len(suspects):
+            path = suspects.pop()
+            if path in visited or self._is_file_omitted(path):
+                continue
+            visited.add(path)
+
+            native   = self.localfs.native_path(path)
+            path_stk = self._find_dir(native)
+            if path_stk is None:
+                # new directory, stored by rescanning its parent
+                suspects.append(os.path.dirname(path))
+                continue
+
+            new_dir = self._rescan_entries(path, path_stk.pop(), since)
+            if new_dir:
+                changed[native] = new_dir
+
+        if len(changed):
+            self._commit_dirs(changed)
+
+    # find directory objects down to native path in current hierachy,
+    # None if the directory is not in the hierachy
+    def _find_dir(self, native):
+        path_stk = self.localfs.find(native, self.localfs.fs_hierachy)
+        if not native == self.localfs.ROOT and \
+                not len(path_stk) == len(native.split(os.path.sep)):
+            return None
+
+        return path_stk
+
+    # compare directory content with its dir object
+    # return the updated dir object, None if unchanged
+    def _rescan_entries(self, path, old_dir, since):
+        new_dir = copy.deepcopy(old_dir)
+        try:
+            names = [f for f in os.listdir(path) \
+                     if not self.localfs.is_omitted(f)]
+        except OSError:
+            # removed meanwhile, parent directory will be rescanned
+            return None
+
+        # entries not kept on this device are carried as they are
+        names = [f for f in names if self.localfs.is_subscribed( \
+            os.path.join(path, f), os.path.isdir(os.path.join(path, f)))]
+        native = self.localfs.native_path(path)
+        kept = lambda name: self.localfs.subscription.child(native, name, \
+            old_dir.dir_entries[name].isdir())
+
+        changed = False
+        for name in old_dir.dir_entries.keys():
+            if not name == fs.meta.dir.Dir.SELF_REF and name not in names \
+                    and kept(name):
+                del new_dir.dir_entries[name]
+                changed = True
+
+        for name in names:
+            abspath = os.path.join(path, name)
+            try:
+                st = os.lstat(abspath)
+            except OSError:
+                continue
+            isdir = stat.S_ISDIR(st.st_mode)
+            entry = new_dir.dir_entries.get(name)
+            if entry and bool(entry.isdir()) == isdir and \
+                    (isdir or self._is_unchanged(entry, st, since)):
+                continue
+
+            new_entry = fs.meta.dir.DirEntry()
+            if isdir:
+                new_entry.mode = fs.meta.dir.DirEntry.DE_ATTR_DIR
+            new_entry.fname = name
+            (new_entry.obj_id, new_entry.fsize) = \
+                self.localfs.backup_files(path, name)
+            if not entry or not entry.obj_id == new_entry.obj_id:
+                new_dir.add_entry(new_entry)
+                changed = True
+
+        if changed:
+            return new_dir
+        else:
+            return None
+
+    # file content matches its entry, by stat cache if it knows the file
+    def _is_unchanged(self, entry, st, since):
+        if self.localfs.stat_cache:
+            cached = self.localfs.stat_cache.lookup(st)
+            if cached:
+                return cached.obj_id == entry.obj_id
+
+        return max(st.st_mtime, st.st_ctime) < since
+
+    # store changed dir objects bottom-up and commit one snapshot
+    # changed maps native path to the new dir object
+    def _commit_dirs(self, changed):
+        depth = lambda native: \
+            0 if native == self.localfs.ROOT else native.count(os.path.sep)
+        while True:
+            native  = max(changed.keys(), key=depth)
+            new_obj = changed.pop(native)
+            data    = str(new_obj)
+            md5     = self.remotfs.store(data)
+            self.localfs.store_cache(md5, data)
+            rosycloud.fs_hier_lock.acquire()
+            self.localfs.fs_hierachy[md5] = new_obj
+            rosycloud.fs_hier_lock.release()
+            if native == self.localfs.ROOT:
+                break
+
+            entry = copy.deepcopy(new_obj.dir_entries[fs.meta.dir.Dir.SELF_REF])
+            entry.obj_id = md5
+            parent = os.path.dirname(native)
+            if parent not in changed:
+                changed[parent] = copy.deepcopy(self._find_dir(parent)[-1])
+            changed[parent].dir_entries[entry.fname] = entry
+
+        self._commit_snapshot(md5)
+
+    def hold(self):
+        """Hold local changes while a restore applies remote ones.
+Events are still read, the local tree is committed once the restore
+switched to the remote snapshot, see release."""
+        if self.held is None:
+            self.held = []
+
+    def release(self):
+        """Commit local changes held since hold, in order."""
+        (held, self.held) = (self.held or [], None)
+        for (func, args) in held:
+            try:
+                func(*args)
+            except Exception:
+                # one failed change does not drop the others
+                traceback.print_exc()
+
+    # hold a call until release, return True if held
+    def _hold(self, func, *args):
+        if self.held is None:
+            return False
+
+        self.held.append((func, args))
+        return True
+
+    # handle events parked on a path once its remote write settled
+    def _unpark(self, pathname):
+        if self.localfs.is_write_pending(pathname):
+            self.loop.call_later(NetDiskEventHandler.SELF_WRITE_RETRY, \
+                self._unpark, pathname)
+            return
+
+        for event in self.parked.pop(pathname):
+            self(event)
+
+    # event caused by remote sync writing local files
+    def _is_self_write(self, event):
+        return not self.localfs.source or \
+            self.localfs.is_self_write(event.pathname, event.mask)
+
+    # reload file system hierachy from latest snapshot
+    def _refresh_hierachy(self):
+        root, local_snapshots = \
+            fs.filesystem.tree_snapshot(self.localfs)
+        assert(len(root) == 1)
+        root = root[0]
+        self.localfs.fs_hierachy = \
+            fs.filesystem.hierachy( \
+                self.localfs.get_snapshot(root).root, \
+                self.remotfs, self.localfs, \
+                self.localfs.subscription)
+
     def _is_file_omitted(self, path):
         omitted = False
         relpath = os.path.relpath(path, self.localfs.rootpath)
@@ -287,12 +667,14 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
             self.localfs.fs_hierachy[md5] = dir_obj
             rosycloud.fs_hier_lock.release()
         else:
+            paths = self._dir_paths(path_stk)
             if not new_entry:
                 new_obj = path_stk.pop()
                 data    = str(new_obj)
                 # cache inode info
                 md5     = self.remotfs.store(data)
                 self.localfs.store_cache(md5, data)
+                self._cache_dir(paths.pop(), md5)
                 entry   = copy.deepcopy(new_obj.dir_entries[fs.meta.dir.Dir.SELF_REF])
                 entry.obj_id = md5
 
@@ -315,9 +697,36 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
                 rosycloud.fs_hier_lock.acquire()
                 self.localfs.fs_hierachy[md5] = par_dir
                 rosycloud.fs_hier_lock.release()
+                self._cache_dir(paths.pop(), md5)
                 entry = par_dir[fs.meta.dir.Dir.SELF_REF]
 
+        self._commit_snapshot(md5, rm_current_ss)
+
+    # absolute paths of the directories in a path stack
+    def _dir_paths(self, path_stk):
+        paths = [self.localfs.rootpath]
+        for dir_obj in path_stk[1:]:
+            paths.append(os.path.join(paths[-1], \
+                dir_obj.dir_entries[fs.meta.dir.Dir.SELF_REF].fname))
+
+        return paths
+
+    # point the stat cache record of a directory to its new object, so a
+    # directory moved away and back in is matched by inode
+    def _cache_dir(self, path, obj_id):
+        try:
+            st = os.stat(path)
+        except OSError:
+            # moved away meanwhile, its events follow
+            return
+        if stat.S_ISDIR(st.st_mode):
+            self.localfs.cache_stat(st, os.path.basename(path), obj_id, 0)
+
+    # commit a new snapshot with root directory object md5
+    def _commit_snapshot(self, md5, rm_current_ss=False):
+        removed = None
         if rm_current_ss:
+            removed    = self.localfs.get_root_snapshot_id()
             parents_ss = self.localfs.get_snapshot( \
                          self.localfs.get_root_snapshot_id()).parents
             self.remotfs.remove_snapshot(\
@@ -334,13 +743,13 @@ class NetDiskEventHandler(pyinotify.ProcessEvent):
 
         md5 = self.localfs.append_snapshot(ss_data)
         self.remotfs.append_snapshot(ss_data, md5)
+        self.remotfs.advance_head(md5, snapshot.parents, removed)
 
     # clear src information for move
+    # `move from' never paired within MOVE_PAIR_TIMEOUT is a move out
     def _clear_mv_pair(self):
-        self.move_cookie  = 0
-        self.move_src_md5 = None
-        self.move_from    = ""
-
-    # get temporary file path name
-    def _get_tmp_file_name(self, filename):
-        return os.path.join(self.configure["SYS_TMP"], filename)
+        now = time.time()
+        for cookie in self.pending_moves.keys():
+            if now - self.pending_moves[cookie][3] > \
+                    NetDiskEventHandler.MOVE_PAIR_TIMEOUT:
+                del self.pending_moves[cookie]
@@ -0,0 +1,150 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This file implements the periodic synchronization with clouds.
+#
+# Each cloud is polled by its own long lived worker thread, so a slow
+# cloud never holds back the others, while the changes fetched are
+# applied on the event loop one cloud at a time.
+#
+# The interval of a cloud adapts to its activity: it drops to
+# SYNC_MIN_INTERVAL as soon as a poll finds new snapshots, and grows by
+# SYNC_BACKOFF after each idle or failed poll up to INTERVAL. Every delay
+# is spread by SYNC_JITTER, thus clients started together do not poll in
+# lockstep.
+import Queue
+import random
+import threading
+import traceback
+
+class SyncScheduler:
+    """Poll clouds concurrently at adaptive intervals."""
+    # default tunables, overridden by global configuration
+    MIN_INTERVAL = 30               # seconds between polls when active
+    INTERVAL     = 900              # seconds between polls when idle
+    BACKOFF      = 2.0              # interval growth after an idle poll
+    JITTER       = 0.1              # relative random spread of delays
+
+    def __init__(self, loop, configure, DEBUG=False):
+        """Params:
+    loop: event loop applying the changes;
+    configure: system-wise configuration."""
+        SyncScheduler.DEBUG = DEBUG
+        self.loop = loop
+        self.max_interval = float(configure.get("INTERVAL", \
+            SyncScheduler.INTERVAL))
+        self.min_interval = min(float(configure.get("SYNC_MIN_INTERVAL", \
+            SyncScheduler.MIN_INTERVAL)), self.max_interval)
+        self.backoff = max(float(configure.get("SYNC_BACKOFF", \
+            SyncScheduler.BACKOFF)), 1.0)
+        self.jitter  = float(configure.get("SYNC_JITTER", \
+            SyncScheduler.JITTER))
+
+        # callbacks set by the owner
+        # prepare(cloud) on the loop, returns arguments of poll
+        self.prepare = None
+        # poll(cloud, *args) on a worker, returns the changes fetched
+        self.poll    = None
+        # apply(cloud, changes) on the loop, True if the cloud changed
+        self.apply   = None
+
+        # clouds in order of add()
+        self.clouds    = []
+        # cloud -> current interval
+        self.intervals = {}
+        # cloud -> job queue of its worker
+        self.jobs      = {}
+
+    def add(self, cloud):
+        """Start polling a cloud."""
+        self.clouds.append(cloud)
+        self.intervals[cloud] = self.min_interval
+        self.jobs[cloud] = Queue.Queue()
+
+        worker = threading.Thread(target=self._work, args=(cloud,))
+        worker.daemon = True
+        worker.start()
+
+    def sync_all(self):
+        """Poll all clouds at once and apply their changes, blocking.
+Errors of any poll are raised after the others are applied. Errors of
+an apply are logged, the cloud is synced again by its periodic poll."""
+        results = Queue.Queue()
+        for cloud in self.clouds:
+            self.jobs[cloud].put((self.prepare(cloud), \
+                lambda *result: results.put(result)))
+
+        error = None
+        for i in range(len(self.clouds)):
+            # applied in order of completion
+            (cloud, changes, failure) = results.get()
+            if failure:
+                error = error or failure
+                continue
+            try:
+                self.apply(cloud, changes)
+            except Exception:
+                traceback.print_exc()
+        if error:
+            raise error
+
+    def start(self):
+        """Schedule periodic polls, after sync_all()."""
+        for cloud in self.clouds:
+            self._schedule(cloud)
+
+    def _schedule(self, cloud):
+        interval = self.intervals[cloud]
+        delay = interval * (1 + random.uniform(-self.jitter, self.jitter))
+        if SyncScheduler.DEBUG:
+            print "[DEBUG] Next sync with", cloud.ID, "in %.1fs" % delay
+        self.loop.call_later(delay, self._start, cloud)
+
+    def _start(self, cloud):
+        self.jobs[cloud].put((self.prepare(cloud), self._done))
+
+    # poll finished, called on the worker
+    def _done(self, cloud, changes, failure):
+        self.loop.post(self._polled, cloud, changes, failure)
+
+    def _polled(self, cloud, changes, failure):
+        active = False
+        try:
+            if not failure:
+                active = self.apply(cloud, changes)
+        except Exception:
+            # backed off like a failed poll, retried later
+            traceback.print_exc()
+
+        if active:
+            self.intervals[cloud] = self.min_interval
+        else:
+            self.intervals[cloud] = min(self.max_interval, \
+                self.intervals[cloud] * self.backoff)
+        self._schedule(cloud)
+
+    def _work(self, cloud):
+        while True:
+            (args, done) = self.jobs[cloud].get()
+            try:
+                changes = self.poll(cloud, *args)
+            except Exception as e:
+                # cloud unreachable, retried later
+                traceback.print_exc()
+                done(cloud, None, e)
+                continue
+            done(cloud, changes, None)
@@ -16,14 +16,20 @@
 # along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
 
 # This is the file system module for Azure Blob Storage
+import calendar
+import httplib
 import os
 import hashlib
+import socket
+import tempfile
+import time
 
 import azure
 import azure.storage
 
 import filesystem
 import bakfilesystem
+import scheduler
 
 import meta.snapshot
 import meta.dir
@@ -34,6 +40,12 @@ class AzureFS(bakfilesystem.BackupFileSystem):
     BLOB_TYPE = "BlockBlob"
     SEPERATOR = "/"
     TRIALS    = 3
+    # seconds of a day
+    DAY = 86400
+    # seconds a lease on the head object lasts, 15 at least
+    LEASE_DURATION = 15
+    # bytes of a blob got per request when streaming
+    READ_RANGE = 4 << 20
 
     def __init__(self, configure, decorator, DEBUG = False):
         # super
@@ -59,7 +71,12 @@ class AzureFS(bakfilesystem.BackupFileSystem):
             # container not specified
             sys.exit(-2)
 
-        containers = self.blob_service.list_containers()
+        try:
+            containers = self.blob_service.list_containers()
+        except (socket.error, httplib.HTTPException) as e:
+            # writes are queued until reachable again
+            print "Cannot reach azure storage (%s), work offline." % e
+            return
         created    = False
         for container in containers.containers:
             # specified container already exists?
@@ -93,12 +110,57 @@ class AzureFS(bakfilesystem.BackupFileSystem):
         if AzureFS.DEBUG:
             print "[DEBUG] List snapshots."
 
-        results = self.blob_service.list_blobs(AzureFS.CONTAINER, self.ss_folder)
+        results = self._list_blobs(self.ss_folder)
         for blob in results:
             ss_dict[blob.name[len(self.ss_folder):]] = blob.properties.last_modified
 
         return ss_dict
 
+    def list_snapshot_etags(self):
+        etags = {}
+        for blob in self._list_blobs(self.ss_folder):
+            etags[blob.name[len(self.ss_folder):]] = blob.properties.etag
+
+        return etags
+
+    # markers of blob listings are opaque, list the journal of each day
+    # from the marker on instead
+    def list_snapshots_since(self, marker):
+        journal = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER
+        start   = self._journal_start(marker)
+        # clocks ahead of ours may have written tomorrow already
+        last    = self._journal_day(time.time() + AzureFS.DAY)
+        day     = calendar.timegm(time.strptime(start[:8], "%Y%m%d"))
+        ss_list = []
+        while self._journal_day(day) <= last:
+            prefix = journal + self._journal_day(day) + "/"
+            for blob in self._list_blobs(prefix):
+                key = blob.name[len(journal):]
+                if key >= start:
+                    ss_list.append(self._journal_id(key))
+                    marker = max(marker, key)
+            day = day + AzureFS.DAY
+
+        return (ss_list, marker)
+
+    def _journal_day(self, timestamp):
+        return self._journal_time(timestamp).split("/")[0]
+
+    # list all blobs with given prefix, following continuation markers
+    def _list_blobs(self, prefix, delimiter=None):
+        blobs  = []
+        marker = None
+        while True:
+            results = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.blob_service.list_blobs, AzureFS.CONTAINER, prefix, \
+                marker=marker, delimiter=delimiter)
+            blobs.extend(results)
+            marker = results.next_marker
+            if not marker:
+                break
+
+        return blobs
+
     def get_snapshot(self, ss_id):
         """Get snapshot content."""
         obj_id = self._join(self.ss_folder, ss_id)
@@ -125,8 +187,10 @@ class AzureFS(bakfilesystem.BackupFileSystem):
             print "[DEBUG] Append snapshot:", obj_id
         data = self.decorator.decorate(data)
         # a snapshot cannot be empty, put data directly
-        self.blob_service.put_blob(AzureFS.CONTAINER, obj_id, data, \
+        self._transfer(scheduler.TransferScheduler.LANE_META, len(data), \
+            self.blob_service.put_blob, AzureFS.CONTAINER, obj_id, data, \
             x_ms_blob_type=AzureFS.BLOB_TYPE)
+        self._append_journal(ss_id)
 
         return ss_id
 
@@ -183,31 +247,50 @@ class AzureFS(bakfilesystem.BackupFileSystem):
             # ignore, ensure the invariant after the operation
             pass
 
-    # can be implemented with block list for concurrent download
     def retrieve_to_file(self, obj_id, path):
         if AzureFS.DEBUG:
             print "[DEBUG] Get object:", obj_id, "to", path
 
+        self._save_chunks(self.open_read(obj_id), path)
+
+    # a blob is got range by range, one range is held in memory at a time
+    def open_read(self, obj_id):
         if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            # empty file, touch and truncate
-            file(path, 'w')
-        else:
-            tmp_path = self.configure["SYS_DIR"] + "/tmp"
-            data = self.blob_service.get_blob(AzureFS.CONTAINER, obj_id)
-            f = file(tmp_path, 'wb')
-            f.write(data)
-            f.close()
+            return
 
-            self.decorator.undecorate_file(tmp_path, path)
-            # remove temporary file
-            os.unlink(tmp_path)
+        try:
+            props = self._transfer(scheduler.TransferScheduler.LANE_META, \
+                0, self.blob_service.get_blob_properties, \
+                AzureFS.CONTAINER, obj_id)
+        except azure.WindowsAzureMissingResourceError:
+            raise IOError(obj_id)
+
+        for data in self.decorator.undecorate_stream( \
+                self._get_ranges(obj_id, int(props["content-length"]))):
+            yield data
+
+    def _get_ranges(self, obj_id, size):
+        for offset in range(0, size, AzureFS.READ_RANGE):
+            last = min(offset + AzureFS.READ_RANGE, size) - 1
+            try:
+                yield self._transfer( \
+                    scheduler.TransferScheduler.LANE_SMALL, \
+                    last - offset + 1, self.blob_service.get_blob, \
+                    AzureFS.CONTAINER, obj_id, \
+                    x_ms_range="bytes=%d-%d" % (offset, last))
+            except azure.WindowsAzureMissingResourceError:
+                # removed while read
+                raise IOError(obj_id)
 
     def store_from_file(self, path, id=""):
         obj_id = \
             bakfilesystem.BackupFileSystem.store_from_file(self, \
                 path, id)
 
-        tmp_path = self.configure["SYS_DIR"] + "/tmp"
+        # unique name, transfers may run concurrently
+        (fd, tmp_path) = \
+            tempfile.mkstemp(dir=self.configure["SYS_DIR"] + "/tmp")
+        os.close(fd)
         self.decorator.decorate_file(path, tmp_path)
 
         if AzureFS.DEBUG:
@@ -216,7 +299,9 @@ class AzureFS(bakfilesystem.BackupFileSystem):
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
             f    = file(tmp_path, 'rb')
             data = f.read()
-            self.blob_service.put_blob(AzureFS.CONTAINER, \
+            f.close()
+            self._transfer(self._file_lane(os.path.getsize(path)), \
+                len(data), self.blob_service.put_blob, AzureFS.CONTAINER, \
                 obj_id, data, x_ms_blob_type=AzureFS.BLOB_TYPE)
 
         # remove temporary file
@@ -231,7 +316,8 @@ class AzureFS(bakfilesystem.BackupFileSystem):
 
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
             data = self.decorator.decorate(data)
-            self.blob_service.put_blob(AzureFS.CONTAINER, \
+            self._transfer(scheduler.TransferScheduler.LANE_META, len(data), \
+                self.blob_service.put_blob, AzureFS.CONTAINER, \
                 obj_id, data, x_ms_blob_type=AzureFS.BLOB_TYPE)
 
         return obj_id
@@ -244,7 +330,9 @@ class AzureFS(bakfilesystem.BackupFileSystem):
             data = ""
         else:
             try:
-                data = self.blob_service.get_blob(AzureFS.CONTAINER, obj_id)
+                data = self._transfer( \
+                    scheduler.TransferScheduler.LANE_META, 0, \
+                    self.blob_service.get_blob, AzureFS.CONTAINER, obj_id)
                 data = self.decorator.undecorate(data)
             except azure.WindowsAzureMissingResourceError:
                 raise IOError(obj_id)
@@ -257,6 +345,128 @@ class AzureFS(bakfilesystem.BackupFileSystem):
 
         self.blob_service.delete_blob(AzureFS.CONTAINER, obj_id)
 
+    def get_head(self, etag=None):
+        obj_id = bakfilesystem.BackupFileSystem.HEAD_OBJECT
+        try:
+            props = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.blob_service.get_blob_properties, AzureFS.CONTAINER, \
+                obj_id)
+            if props["etag"] == etag:
+                return (None, etag)
+            data = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.blob_service.get_blob, AzureFS.CONTAINER, obj_id)
+        except azure.WindowsAzureMissingResourceError:
+            raise IOError("Head")
+
+        # a newer version read with an older etag is fetched again later
+        return (self._parse_head(data), props["etag"])
+
+    # blobs have no conditional put here, compare versions under a lease
+    def put_head(self, heads, etag):
+        obj_id = bakfilesystem.BackupFileSystem.HEAD_OBJECT
+        data   = self._head_data(heads)
+        if not etag:
+            try:
+                self.blob_service.get_blob_properties(AzureFS.CONTAINER, \
+                    obj_id)
+                # created by someone else
+                return None
+            except azure.WindowsAzureMissingResourceError:
+                self._transfer( \
+                    scheduler.TransferScheduler.LANE_META, len(data), \
+                    self.blob_service.put_blob, AzureFS.CONTAINER, obj_id, \
+                    data, x_ms_blob_type=AzureFS.BLOB_TYPE)
+                return self.blob_service.get_blob_properties( \
+                    AzureFS.CONTAINER, obj_id)["etag"]
+
+        try:
+            lease = self.blob_service.lease_blob(AzureFS.CONTAINER, obj_id, \
+                "acquire", x_ms_lease_duration=AzureFS.LEASE_DURATION)
+        except (azure.WindowsAzureConflictError, \
+                azure.WindowsAzureMissingResourceError):
+            # another writer holds the lease, or head removed
+            return None
+        lease_id = lease["x-ms-lease-id"]
+        try:
+            props = self.blob_service.get_blob_properties( \
+                AzureFS.CONTAINER, obj_id, x_ms_lease_id=lease_id)
+            if not props["etag"] == etag:
+                return None
+            self._transfer(scheduler.TransferScheduler.LANE_META, len(data), \
+                self.blob_service.put_blob, AzureFS.CONTAINER, obj_id, \
+                data, x_ms_blob_type=AzureFS.BLOB_TYPE, \
+                x_ms_lease_id=lease_id)
+
+            return self.blob_service.get_blob_properties( \
+                AzureFS.CONTAINER, obj_id, x_ms_lease_id=lease_id)["etag"]
+        finally:
+            self.blob_service.lease_blob(AzureFS.CONTAINER, obj_id, \
+                "release", x_ms_lease_id=lease_id)
+
+    def list_raw(self, kind):
+        prefix = self._raw_key(kind, "")
+        # objects lie at top level, folders are not descended
+        return [blob.name[len(prefix):] for blob in \
+            self._list_blobs(prefix, AzureFS.SEPERATOR) \
+            if not blob.name == bakfilesystem.BackupFileSystem.HEAD_OBJECT]
+
+    def get_raw(self, kind, name, path):
+        key = self._raw_key(kind, name)
+        if AzureFS.DEBUG:
+            print "[DEBUG] Get raw:", key
+        try:
+            data = self._transfer(scheduler.TransferScheduler.LANE_SMALL, \
+                0, self.blob_service.get_blob, AzureFS.CONTAINER, key)
+        except azure.WindowsAzureMissingResourceError:
+            raise IOError(key)
+        f = file(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def put_raw(self, kind, name, path):
+        key = self._raw_key(kind, name)
+        if AzureFS.DEBUG:
+            print "[DEBUG] Put raw:", key
+        f    = file(path, 'rb')
+        data = f.read()
+        f.close()
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            lane = self._file_lane(len(data))
+        else:
+            lane = scheduler.TransferScheduler.LANE_META
+        self._transfer(lane, len(data), self.blob_service.put_blob, \
+            AzureFS.CONTAINER, key, data, x_ms_blob_type=AzureFS.BLOB_TYPE)
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            self._append_journal(name)
+
+    # record the append of a snapshot in journal
+    def _append_journal(self, ss_id):
+        self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+            self.blob_service.put_blob, AzureFS.CONTAINER, \
+            bakfilesystem.BackupFileSystem.JOURNAL_FOLDER + \
+            self._journal_key(ss_id), "", x_ms_blob_type=AzureFS.BLOB_TYPE)
+
+    def _journal_keys(self):
+        journal = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER
+        return [blob.name[len(journal):] for blob in self._list_blobs(journal)]
+
+    def _remove_journal(self, key):
+        try:
+            self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.blob_service.delete_blob, AzureFS.CONTAINER, \
+                bakfilesystem.BackupFileSystem.JOURNAL_FOLDER + key)
+        except azure.WindowsAzureMissingResourceError:
+            # pruned by someone else
+            pass
+
+    def _raw_key(self, kind, name):
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            return self._join(self.ss_folder, name)
+        elif kind == bakfilesystem.BackupFileSystem.RAW_TAG:
+            return self._join(self.tag_folder, name)
+        else:
+            return name
+
     def get_empty_data_md5(self):
         md5 = hashlib.md5()
         md5.update(self.decorator.decorate(""))
@@ -21,16 +21,45 @@
 # Also, we don't constraint the media as cloud only
 
 # system module
+import calendar
 import hashlib
+import httplib
+import os
+import socket
+import tempfile
+import time
 
 # user defined module
 import filesystem
+import scheduler
+import couldnotconnectserverexception
 
 class BackupFileSystem(filesystem.FileSystem):
     """Interfaces for backup media"""
+    # name of the object holding head snapshot ids
+    HEAD_OBJECT = "heads"
+    # attempts of a conditional head update
+    HEAD_TRIALS = 5
+    # journal of appended snapshots, keyed on time of append
+    JOURNAL_FOLDER = "ssj/"
+    JOURNAL_TIME   = "%Y%m%d/%H%M%S"
+    # appends by devices with clocks behind up to this many seconds are
+    # still found by incremental listings
+    JOURNAL_SKEW   = 600
+    # seconds journal entries are kept, older ones are pruned and listings
+    # from markers as old are full ones
+    JOURNAL_RETENTION = 7 * 86400
+    # kinds of keys accessed raw, see list_raw
+    RAW_OBJECT     = "object"       # file and directory objects
+    RAW_SNAPSHOT   = "snapshot"
+    RAW_TAG        = "tag"
 
     def __init__(self, DEBUG=False):
         BackupFileSystem.DEBUG = DEBUG
+        # transfer scheduler shared by all backup media, if any
+        self.scheduler = None
+        # directory of temporary files, system default if None
+        self.tmpdir    = None
 
     def list_snapshots(self):
         """List all available snapshots on this media.
@@ -134,7 +163,25 @@ Params:
 Return:
     None if succeeds. TBD if fails"""
         raise NotImplementedError("Retrieve to file should be implemented more specific")
-        
+
+    def open_read(self, obj_id):
+        """Read an object as it is downloaded, in constant memory.
+Media not streaming their objects download to a temporary file first.
+Params:
+    obj_id: id of object to read
+
+Return:
+    Iterator of undecorated chunks of the object. Throws IOError while
+    iterating if the object is missing."""
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+        os.close(fd)
+        try:
+            self.retrieve_to_file(obj_id, tmp_path)
+            for data in self._read_chunks(open(tmp_path, 'rb')):
+                yield data
+        finally:
+            os.unlink(tmp_path)
+
     def store_from_file(self, path, id = ""):
         """Store specified file on cloud, md5 MAC is calculated as object ID
 Params:
@@ -208,3 +255,279 @@ Returns:
     MD5 checksum of empty data after decoration.
 """
         raise NotImplementedError("Empty data md5 should be implemented more specific")
+
+    def list_snapshot_etags(self):
+        """List all snapshots on this media with their versions.
+
+Return:
+    Dict mapping snapshot id to its ETag, an empty string if unknown."""
+        return dict.fromkeys(self.list_snapshots(), "")
+
+    def list_snapshots_since(self, marker):
+        """List snapshots appended after a marker.
+Params:
+    marker: marker returned by an earlier listing or journal_marker.
+
+Return:
+    (ss_ids, marker): ids of snapshots appended since the marker, some
+    listed before may be included, and the marker for next listing.
+    Throws NotImplementedError if the media keeps no journal or it was
+    pruned past the marker."""
+        raise NotImplementedError("Journal should be implemented more specific")
+
+    def journal_marker(self):
+        """Marker of snapshots appended from now on."""
+        return self._journal_time(time.time())
+
+    def prune_journal(self, removed=[]):
+        """Delete journal entries of removed snapshots and those older than
+JOURNAL_RETENTION. Media keeping no journal is left as it is.
+Params:
+    removed: ids of snapshots removed from this media."""
+        try:
+            keys = self._journal_keys()
+        except NotImplementedError:
+            return
+
+        removed = set(removed)
+        oldest  = self._journal_time(time.time() - \
+            BackupFileSystem.JOURNAL_RETENTION)
+        for key in keys:
+            if key < oldest or self._journal_id(key) in removed:
+                self._remove_journal(key)
+
+    def probe(self):
+        """Check the media is reachable.
+Raise CouldNotConnectServerException if it is not."""
+        try:
+            self.get_head()
+        except (socket.error, httplib.HTTPException) as e:
+            raise couldnotconnectserverexception. \
+                CouldNotConnectServerException(e)
+        except (IOError, NotImplementedError):
+            # reachable, no head object or no support for it
+            pass
+
+    def list_raw(self, kind):
+        """List keys of one kind stored on this media.
+Params:
+    kind: RAW_OBJECT, RAW_SNAPSHOT or RAW_TAG.
+
+Return:
+    A list of object ids, snapshot ids or tag names."""
+        raise NotImplementedError("Raw access should be implemented more specific")
+
+    def get_raw(self, kind, name, path):
+        """Download a key as stored, without undecoration.
+Params:
+    kind: kind of the key, see list_raw;
+    name: object id, snapshot id or tag name;
+    path: destination on local filesystem.
+
+Return:
+    None if succeeds. Throws IOError otherwise."""
+        raise NotImplementedError("Raw access should be implemented more specific")
+
+    def put_raw(self, kind, name, path):
+        """Upload a key got by get_raw of any media, without decoration.
+A snapshot is recorded in the journal as by append_snapshot.
+Params:
+    kind: kind of the key, see list_raw;
+    name: object id, snapshot id or tag name;
+    path: local file holding the stored content.
+
+Return:
+    None if succeeds. Throws IOError otherwise."""
+        raise NotImplementedError("Raw access should be implemented more specific")
+
+    def get_head(self, etag=None):
+        """Get head snapshots, the snapshots no other snapshot derives from.
+Params:
+    etag: version of the head object known by the caller, if any.
+
+Return:
+    (heads, etag): list of head snapshot ids and version of the head
+    object. heads is None if the version is still the given etag.
+    Throws IOError if there is no head object, NotImplementedError if
+    the media does not support conditional writes."""
+        raise NotImplementedError("Head should be implemented more specific")
+
+    def put_head(self, heads, etag):
+        """Replace the head object only if it is still of given version.
+Params:
+    heads: list of head snapshot ids;
+    etag: expected version, None if the object should not exist yet.
+
+Return:
+    New version of the head object, None if the version mismatched."""
+        raise NotImplementedError("Head should be implemented more specific")
+
+    def advance_head(self, ss_id, parents, removed=None):
+        """Make a newly appended snapshot a head in place of its parents.
+Params:
+    ss_id: id of the new snapshot;
+    parents: ids of its parent snapshots;
+    removed: id of a snapshot replaced by the new one, if any.
+
+Return:
+    New version of the head object, None if not updated."""
+        for trial in range(BackupFileSystem.HEAD_TRIALS):
+            try:
+                (heads, etag) = self.get_head()
+            except IOError:
+                # first head of this media
+                (heads, etag) = ([], None)
+            except NotImplementedError:
+                return None
+
+            heads = [h for h in heads \
+                     if h not in parents and not h == removed]
+            if not ss_id in heads:
+                heads.append(ss_id)
+            etag = self.put_head(heads, etag)
+            if etag:
+                return etag
+
+        # heads are repaired by the next full listing
+        if BackupFileSystem.DEBUG:
+            print "[DEBUG] Cannot advance head to", ss_id
+
+        return None
+
+    def merge_heads(self, heads):
+        """Add head snapshots copied from another media to current ones.
+Params:
+    heads: list of head snapshot ids.
+
+Return:
+    New version of the head object, None if not updated."""
+        for trial in range(BackupFileSystem.HEAD_TRIALS):
+            try:
+                (current, etag) = self.get_head()
+            except IOError:
+                (current, etag) = ([], None)
+            except NotImplementedError:
+                return None
+
+            missing = [h for h in heads if not h in current]
+            if not len(missing):
+                return etag
+            etag = self.put_head(current + missing, etag)
+            if etag:
+                return etag
+
+        return None
+
+    def reset_head(self, heads):
+        """Replace head snapshots regardless of current ones.
+Params:
+    heads: list of head snapshot ids.
+
+Return:
+    New version of the head object, None if not updated."""
+        for trial in range(BackupFileSystem.HEAD_TRIALS):
+            try:
+                (current, etag) = self.get_head()
+            except IOError:
+                etag = None
+            except NotImplementedError:
+                return None
+
+            etag = self.put_head(heads, etag)
+            if etag:
+                return etag
+
+        return None
+
+    def _journal_key(self, ss_id):
+        """Journal key recording a snapshot appended now.
+Keys sort by time of append, thus a listing can start from the last key
+seen instead of listing all snapshots."""
+        now = time.time()
+        return "%s.%06d-%s" % (self._journal_time(now), \
+            int(now % 1 * 1000000), ss_id)
+
+    def _journal_start(self, marker):
+        """Smallest journal key to list for a marker, moved back by
+JOURNAL_SKEW to cover devices whose clocks are behind.
+Throws NotImplementedError if entries after the marker may be pruned."""
+        timestamp = calendar.timegm(time.strptime( \
+            marker[:len("YYYYmmdd/HHMMSS")], BackupFileSystem.JOURNAL_TIME))
+        if timestamp < time.time() - BackupFileSystem.JOURNAL_RETENTION + \
+                BackupFileSystem.JOURNAL_SKEW:
+            raise NotImplementedError("Journal pruned past " + marker)
+
+        return self._journal_time(timestamp - BackupFileSystem.JOURNAL_SKEW)
+
+    def _journal_time(self, timestamp):
+        return time.strftime(BackupFileSystem.JOURNAL_TIME, \
+            time.gmtime(timestamp))
+
+    def _journal_id(self, key):
+        """Snapshot id recorded by a journal key."""
+        return key.split("-", 1)[1]
+
+    def _journal_keys(self):
+        """All journal keys, relative to JOURNAL_FOLDER.
+Throws NotImplementedError if the media keeps no journal."""
+        raise NotImplementedError("Journal should be implemented more specific")
+
+    def _remove_journal(self, key):
+        """Delete a journal key, a key already deleted is ignored."""
+        raise NotImplementedError("Journal should be implemented more specific")
+
+    def _head_data(self, heads):
+        """Serialize head snapshot ids."""
+        return "".join([h + "\n" for h in heads])
+
+    def _parse_head(self, data):
+        """Parse serialized head snapshot ids."""
+        return [h for h in data.split("\n") if len(h)]
+
+    def _transfer(self, lane, nbytes, func, *args, **kwargs):
+        """Perform a transfer through the transfer scheduler.
+Params:
+    lane: scheduler lane, see TransferScheduler;
+    nbytes: bytes to transfer;
+    func: callable performing the transfer.
+
+Return:
+    Result of func(*args, **kwargs).
+
+Raise CouldNotConnectServerException if the media is unreachable, thus
+callers tell it from a missing key, which raises IOError."""
+        try:
+            if self.scheduler:
+                return self.scheduler.transfer(lane, nbytes, func, \
+                    *args, **kwargs)
+            else:
+                return func(*args, **kwargs)
+        except (socket.error, httplib.HTTPException) as e:
+            raise couldnotconnectserverexception. \
+                CouldNotConnectServerException(e)
+
+    def _transfer_chunks(self, chunks):
+        """Chunks of a download read after _transfer returned, errors are
+raised as by _transfer."""
+        try:
+            for data in chunks:
+                yield data
+        except (socket.error, httplib.HTTPException) as e:
+            raise couldnotconnectserverexception. \
+                CouldNotConnectServerException(e)
+
+    def _save_chunks(self, chunks, path):
+        """Write chunks got by open_read to a file."""
+        f = open(path, 'wb')
+        try:
+            for data in chunks:
+                f.write(data)
+        finally:
+            f.close()
+
+    def _file_lane(self, nbytes):
+        """Scheduler lane for a file object of given size."""
+        if self.scheduler:
+            return self.scheduler.lane_of(nbytes)
+        else:
+            return scheduler.TransferScheduler.LANE_SMALL
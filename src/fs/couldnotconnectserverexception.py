@@ -17,5 +17,8 @@
 
 # raised when can not connect to server
 class CouldNotConnectServerException(Exception):
-    def __init__(self):
-        Exception.__init__(self)
+    def __init__(self, reason=None):
+        """Params:
+    reason: underlying socket or protocol error, if any."""
+        Exception.__init__(self, "Could not connect to server: %s" % reason)
+        self.reason = reason
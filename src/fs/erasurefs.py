@@ -0,0 +1,453 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module stripes objects across clouds with an erasure code.
+#
+# An object is decorated once, then cut in stripes of k shards each and
+# Reed-Solomon encoded into k data and m parity fragments, fragment i
+# being the concatenation of shard i of all stripes. Each fragment is
+# stored as is under the object id on a different cloud, starting at a
+# cloud chosen by the object id so that data fragments spread evenly.
+# Any k fragments rebuild the object, thus upload and storage cost
+# (k + m) / k times the object rather than once per cloud.
+#
+# A read asks every cloud for its fragment and decodes from the first k
+# answers, slow clouds are not waited for. A key stored whole, e.g.
+# before striping was configured, is undecorated as is.
+#
+# Snapshots, tags and heads are small and needed to find anything else,
+# they are written to every cloud in full and read from the first one
+# holding them.
+import os
+import struct
+import tempfile
+import threading
+import traceback
+
+import bakfilesystem
+import couldnotconnectserverexception
+import filesystem
+import util.reedsolomon
+
+BackupFileSystem = bakfilesystem.BackupFileSystem
+CouldNotConnectServerException = \
+    couldnotconnectserverexception.CouldNotConnectServerException
+
+class Fetch:
+    """Fragments of one object asked from all clouds."""
+    def __init__(self, clouds):
+        self.cond      = threading.Condition()
+        self.running   = clouds
+        # fragment index -> path of fragments got
+        self.fragments = {}
+        # header of fragments got, (k, m, stripe size, object size)
+        self.header    = None
+        # path of the object if a cloud holds it whole
+        self.whole     = None
+        self.error     = None
+        # fragments got from now on are not needed
+        self.done      = False
+
+class ErasureFS(bakfilesystem.BackupFileSystem):
+    """Store objects as erasure coded fragments on several clouds."""
+    ID = "erasure"
+    # fragment header: magic, k, m, index, stripe size, object size
+    MAGIC  = "RSF1"
+    HEADER = ">4sBBBIQ"
+    # default bytes of a shard, a stripe is k shards
+    SHARD_SIZE = 1 << 20
+
+    def __init__(self, clouds, configure, DEBUG=False):
+        """Params:
+    clouds: BackupFileSystem objects of CLOUDS sharing a decorator,
+            the first one serves snapshot listings;
+    configure: system-wise configuration, ERASURE gives k:m."""
+        bakfilesystem.BackupFileSystem.__init__(self, DEBUG)
+
+        ErasureFS.DEBUG = DEBUG
+        (k, m) = [int(n) for n in configure["ERASURE"].split(":")]
+        if k + m > len(clouds):
+            raise ValueError("%d fragments on %d clouds" % \
+                (k + m, len(clouds)))
+
+        self.clouds    = clouds
+        self.scheduler = clouds[0].scheduler
+        self.decorator = clouds[0].decorator
+        self.tmpdir    = configure["SYS_TMP"]
+        self.shard     = int(configure.get("ERASURE_SHARD_SIZE", \
+            ErasureFS.SHARD_SIZE))
+        self.k = k
+        self.m = m
+
+        self.lock   = threading.Lock()
+        # (k, m) -> codec, objects keep the code they were written with
+        self.codecs = {}
+
+    # objects are striped
+
+    def store_from_file(self, path, id=""):
+        obj_id = BackupFileSystem.store_from_file(self, path, id)
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return obj_id
+
+        tmp_path = self._mkstemp()
+        try:
+            self.decorator.decorate_file(path, tmp_path)
+            self._put(obj_id, tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+        return obj_id
+
+    def store(self, data, id=""):
+        obj_id = BackupFileSystem.store(self, data, id)
+
+        tmp_path = self._mkstemp()
+        try:
+            f = open(tmp_path, "wb")
+            f.write(self.decorator.decorate(data))
+            f.close()
+            self._put(obj_id, tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+        return obj_id
+
+    def retrieve_to_file(self, obj_id, path):
+        self._save_chunks(self.open_read(obj_id), path)
+
+    # the object is rebuilt in a temporary file, then undecorated as read
+    def open_read(self, obj_id):
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return
+
+        tmp_path = self._get(obj_id)
+        try:
+            for data in self.decorator.undecorate_stream( \
+                    self._read_chunks(open(tmp_path, "rb"))):
+                yield data
+        finally:
+            os.unlink(tmp_path)
+
+    def retrieve(self, obj_id):
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return ""
+
+        tmp_path = self._get(obj_id)
+        try:
+            f = open(tmp_path, "rb")
+            data = f.read()
+            f.close()
+        finally:
+            os.unlink(tmp_path)
+
+        return self.decorator.undecorate(data)
+
+    def remove(self, obj_id):
+        for cloud in self.clouds:
+            try:
+                cloud.remove(obj_id)
+            except (IOError, OSError):
+                # no fragment on this cloud
+                pass
+
+    def list_objects(self):
+        objects = set()
+        for cloud in self.clouds:
+            objects.update(cloud.list_objects())
+
+        return list(objects)
+
+    def get_data_checksum(self, data):
+        return self.clouds[0].get_data_checksum(data)
+
+    def get_empty_data_md5(self):
+        return self.clouds[0].get_empty_data_md5()
+
+    # snapshots, tags and heads are written to all clouds
+
+    def append_snapshot(self, ss, ss_id=""):
+        return self._all("append_snapshot", ss, ss_id)
+
+    def remove_snapshot(self, ss_id):
+        return self._all("remove_snapshot", ss_id)
+
+    def prune_journal(self, removed=[]):
+        return self._all("prune_journal", removed)
+
+    def tag_snapshot(self, tag_id, tag_obj):
+        return self._all("tag_snapshot", tag_id, tag_obj)
+
+    def remove_tag(self, tag_id):
+        return self._all("remove_tag", tag_id)
+
+    def advance_head(self, ss_id, parents, removed=None):
+        return self._all("advance_head", ss_id, parents, removed)
+
+    def list_snapshots(self):
+        return self.clouds[0].list_snapshots()
+
+    def get_snapshot(self, ss_id):
+        return self._first("get_snapshot", ss_id)
+
+    def get_snapshot_timestamp(self, ss_id):
+        return self._first("get_snapshot_timestamp", ss_id)
+
+    def list_snapshot_etags(self):
+        return self.clouds[0].list_snapshot_etags()
+
+    def list_snapshots_since(self, marker):
+        return self.clouds[0].list_snapshots_since(marker)
+
+    def journal_marker(self):
+        return self.clouds[0].journal_marker()
+
+    def list_tags(self):
+        return self.clouds[0].list_tags()
+
+    def get_tagged_snapshot(self, tag_id):
+        return self._first("get_tagged_snapshot", tag_id)
+
+    def get_head(self, etag=None):
+        return self.clouds[0].get_head(etag)
+
+    # call a method on every cloud at once, raise if any failed
+    def _all(self, method, *args):
+        results = [None] * len(self.clouds)
+        errors  = []
+        def call(index):
+            try:
+                results[index] = getattr(self.clouds[index], method)(*args)
+            except Exception as e:
+                traceback.print_exc()
+                errors.append(e)
+
+        self._run_all(call, range(len(self.clouds)))
+        if len(errors):
+            # unreachable clouds are told first, writes may be queued
+            raise ([e for e in errors \
+                    if isinstance(e, CouldNotConnectServerException)] + \
+                   errors)[0]
+
+        return results[0]
+
+    # call a method on clouds in order until one succeeds
+    def _first(self, method, *args):
+        for cloud in self.clouds[:-1]:
+            try:
+                return getattr(cloud, method)(*args)
+            except IOError:
+                continue
+
+        return getattr(self.clouds[-1], method)(*args)
+
+    def _run_all(self, func, args):
+        workers = []
+        for arg in args:
+            worker = threading.Thread(target=func, args=(arg,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+    def _codec(self, k, m):
+        self.lock.acquire()
+        try:
+            if not (k, m) in self.codecs:
+                self.codecs[(k, m)] = util.reedsolomon.ReedSolomon(k, m)
+            return self.codecs[(k, m)]
+        finally:
+            self.lock.release()
+
+    def _mkstemp(self):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+        os.close(fd)
+
+        return tmp_path
+
+    # cloud indexes holding fragments of an object, by fragment index
+    def _placement(self, obj_id):
+        start = int(obj_id[:8], 16) % len(self.clouds)
+        return [(start + i) % len(self.clouds) \
+                for i in range(self.k + self.m)]
+
+    # encode a decorated object and store a fragment on each cloud
+    def _put(self, obj_id, path):
+        paths = self._encode(path)
+        errors = []
+        placement = self._placement(obj_id)
+        def put(index):
+            cloud = self.clouds[placement[index]]
+            try:
+                cloud.put_raw(BackupFileSystem.RAW_OBJECT, obj_id, \
+                    paths[index])
+            except Exception as e:
+                traceback.print_exc()
+                errors.append(e)
+
+        try:
+            if ErasureFS.DEBUG:
+                print "[DEBUG] Store fragments of", obj_id, "on", \
+                    [self.clouds[i].ID for i in placement]
+            self._run_all(put, range(len(paths)))
+        finally:
+            for fragment in paths:
+                os.unlink(fragment)
+        unreachable = [e for e in errors \
+                       if isinstance(e, CouldNotConnectServerException)]
+        if len(unreachable):
+            raise unreachable[0]
+        if len(errors):
+            raise IOError("%d fragments of %s not stored: %s" % \
+                (len(errors), obj_id, errors[0]))
+
+    def _encode(self, path):
+        (k, m) = (self.k, self.m)
+        codec = self._codec(k, m)
+        size  = os.path.getsize(path)
+        paths = [self._mkstemp() for i in range(k + m)]
+        outs  = [open(p, "wb") for p in paths]
+        f = open(path, "rb")
+        try:
+            for (index, out) in enumerate(outs):
+                out.write(struct.pack(ErasureFS.HEADER, ErasureFS.MAGIC, \
+                    k, m, index, self.shard, size))
+            block = f.read(k * self.shard)
+            while len(block):
+                # the last stripe has shorter shards, zero padded
+                shard  = (len(block) + k - 1) / k
+                block  = block.ljust(shard * k, '\0')
+                shards = [block[i * shard:(i + 1) * shard] \
+                          for i in range(k)]
+                for (out, data) in zip(outs, shards + codec.encode(shards)):
+                    out.write(data)
+                block = f.read(k * self.shard)
+        finally:
+            f.close()
+            for out in outs:
+                out.close()
+
+        return paths
+
+    # path of the decorated object rebuilt from the first k fragments
+    def _get(self, obj_id):
+        fetch = Fetch(len(self.clouds))
+        for cloud in self.clouds:
+            worker = threading.Thread(target=self._fetch, \
+                args=(fetch, cloud, obj_id))
+            worker.daemon = True
+            worker.start()
+
+        fetch.cond.acquire()
+        try:
+            while not fetch.whole and fetch.running and \
+                    (fetch.header is None or \
+                     len(fetch.fragments) < fetch.header[0]):
+                fetch.cond.wait()
+            fetch.done = True
+            whole = fetch.whole
+            fragments = dict(fetch.fragments)
+            header = fetch.header
+        finally:
+            fetch.cond.release()
+
+        try:
+            if whole:
+                return whole
+            if header is None or len(fragments) < header[0]:
+                raise IOError("Object %s not rebuilt, %d fragments got: %s" \
+                    % (obj_id, len(fragments), fetch.error))
+            if ErasureFS.DEBUG:
+                print "[DEBUG] Rebuild", obj_id, "from fragments", \
+                    sorted(fragments)
+            return self._decode(header, fragments)
+        finally:
+            for fragment in fragments.values():
+                os.unlink(fragment)
+
+    def _fetch(self, fetch, cloud, obj_id):
+        tmp_path = self._mkstemp()
+        header = None
+        try:
+            cloud.get_raw(BackupFileSystem.RAW_OBJECT, obj_id, tmp_path)
+            f = open(tmp_path, "rb")
+            data = f.read(struct.calcsize(ErasureFS.HEADER))
+            f.close()
+            if len(data) == struct.calcsize(ErasureFS.HEADER) and \
+                    data.startswith(ErasureFS.MAGIC):
+                header = struct.unpack(ErasureFS.HEADER, data)[1:]
+        except Exception as e:
+            if not isinstance(e, IOError):
+                traceback.print_exc()
+            os.unlink(tmp_path)
+            fetch.cond.acquire()
+            fetch.running = fetch.running - 1
+            fetch.error   = e
+            fetch.cond.notify_all()
+            fetch.cond.release()
+            return
+
+        fetch.cond.acquire()
+        fetch.running = fetch.running - 1
+        used = not fetch.done
+        if used and header is None:
+            fetch.whole = tmp_path
+        elif used:
+            (k, m, index, shard, size) = header
+            fetch.header = fetch.header or (k, m, shard, size)
+            used = not index in fetch.fragments
+            if used:
+                fetch.fragments[index] = tmp_path
+        fetch.cond.notify_all()
+        fetch.cond.release()
+        if not used:
+            # answered late, or a copy of a fragment got already
+            os.unlink(tmp_path)
+
+    def _decode(self, header, fragments):
+        (k, m, shard_size, size) = header
+        codec = self._codec(k, m)
+        indexes = sorted(fragments)[:k]
+        files = {}
+        for i in indexes:
+            files[i] = open(fragments[i], "rb")
+            files[i].seek(struct.calcsize(ErasureFS.HEADER))
+        tmp_path = self._mkstemp()
+        out = open(tmp_path, "wb")
+        try:
+            remaining = size
+            while remaining:
+                length = min(remaining, k * shard_size)
+                shard  = (length + k - 1) / k
+                shards = {}
+                for i in indexes:
+                    shards[i] = files[i].read(shard)
+                    if not len(shards[i]) == shard:
+                        raise IOError("Fragment %d truncated" % i)
+                out.write("".join(codec.decode(shards))[:length])
+                remaining = remaining - length
+        except:
+            out.close()
+            os.unlink(tmp_path)
+            raise
+        finally:
+            for f in files.values():
+                f.close()
+        out.close()
+
+        return tmp_path
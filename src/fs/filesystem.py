@@ -17,6 +17,7 @@
 
 # interface of file system
 import hashlib
+import os
 import StringIO
 
 import meta.snapshot
@@ -47,14 +48,15 @@ def tree_snapshot(fs):
 # construct file system hierachy from a sourcing root dir
 # and a backing file system for missing meta
 # missing metadata will be cached locally
-def hierachy(root_obj_entry, remotefs, localfs):
+# if subscription given, directories it does not visit are left out
+def hierachy(root_obj_entry, remotefs, localfs, subscription=None):
     # also use a dictionary object to store fs hierachy
     empty_dir = meta.dir.empty_dir(meta.dir.Dir.ROOT_DIR)
     fs_hierachy = {empty_dir[meta.dir.Dir.SELF_REF].obj_id:empty_dir}
-    # queue of dir's for later retrieving
-    q_obj = [root_obj_entry]
+    # queue of dir's for later retrieving, with their paths
+    q_obj = [(root_obj_entry, FileSystem.COMMON_SEPERATOR)]
     while len(q_obj):
-        dir_entry = q_obj.pop()
+        (dir_entry, path) = q_obj.pop()
         dir_id    = dir_entry.obj_id
         try:
             dir_content = localfs.retrieve(dir_id)
@@ -69,8 +71,9 @@ def hierachy(root_obj_entry, remotefs, localfs):
         for obj in folder.dir_entries:
             if not obj == meta.dir.Dir.SELF_REF:
                 entry = folder.dir_entries[obj]
-                if entry.isdir() and not entry.obj_id in q_obj:
-                    q_obj.append(entry)
+                if entry.isdir() and (not subscription or \
+                        subscription.child(path, obj, True)):
+                    q_obj.append((entry, os.path.join(path, obj)))
 
     return fs_hierachy
 
@@ -79,6 +82,8 @@ class FileSystem:
     COMMON_SEPERATOR = "/"
     # too large buffer will not introduce noticable imporvement
     BUFFER_SIZE = 4096
+    # chunks handed out by open_read
+    STREAM_BUFFER = 65536
 
     m = hashlib.md5()
     m.update("")
@@ -122,6 +127,22 @@ class FileSystem:
     def retrieve(self, obj_id):
         """Get content of file given its md5 object id"""
         raise NotImplementedError("Retrieve should be implemented more specific")
+
+    def open_read(self, obj_id):
+        """Iterator of chunks of file content given its md5 object id"""
+        raise NotImplementedError("Open read should be implemented more specific")
+
+    def _read_chunks(self, f):
+        """Chunks read from a file-like object until its end, it is closed
+afterwards."""
+        try:
+            while True:
+                data = f.read(FileSystem.STREAM_BUFFER)
+                if not len(data):
+                    break
+                yield data
+        finally:
+            f.close()
         
     def store(self, data):
         """
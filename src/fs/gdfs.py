@@ -19,7 +19,10 @@
 import io
 import sys
 import os
+import calendar
 import hashlib
+import tempfile
+import time
 
 import httplib2
 
@@ -33,7 +36,9 @@ import oauth2client.tools
 # user defined modules
 import filesystem
 import bakfilesystem
+import scheduler
 import meta.snapshot
+import meta.dir
 
 class GDFSErrorCode:
     pass
@@ -49,6 +54,10 @@ class GDFS(bakfilesystem.BackupFileSystem):
 
     # service related constants
     SCOPE = "https://www.googleapis.com/auth/drive"
+    # modification times, without fraction and time zone
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+    # bytes downloaded per request when streaming
+    READ_CHUNK  = 4 << 20
 
     # constructor
     def __init__(self, configure, decorator, DEBUG=False):
@@ -97,9 +106,9 @@ class GDFS(bakfilesystem.BackupFileSystem):
         ss_dict = {}
         try:
             # in case the folder is empty
-            res = self._find("'%s' in parents" % self.ss_folder)
+            items = self._find_all("'%s' in parents" % self.ss_folder)
             # for each record in result construct the id timestamp mapping
-            for record in res[GDFSJSONKey.ITEMS]:
+            for record in items:
                 ss_dict[record['title']] = record['modifiedDate']
 
         except apiclient.errors.HttpError:
@@ -156,8 +165,10 @@ class GDFS(bakfilesystem.BackupFileSystem):
         # use in memory stream
         media_body = apiclient.http.MediaInMemoryUpload(data)
         # upload file onto cloud
-        self.service.files().insert(body=body, \
-            media_body=media_body).execute()
+        request = self.service.files().insert(body=body, \
+            media_body=media_body)
+        self._transfer(scheduler.TransferScheduler.LANE_META, len(data), \
+            request.execute)
 
         return ss_id
 
@@ -241,25 +252,36 @@ class GDFS(bakfilesystem.BackupFileSystem):
         if GDFS.DEBUG:
             print "[DEBUG] Get object:", obj_id, "to", path
 
+        self._save_chunks(self.open_read(obj_id), path)
+
+    # a file is downloaded chunk by chunk, one chunk is held in memory at
+    # a time
+    def open_read(self, obj_id):
         if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            # empty file, touch and truncate
-            file(path, 'w')
-        else:
-            tmp_path = self.configure["SYS_DIR"] + "/tmp"
-            resource = self._find("title='%s'" % obj_id)
-            url      = resource['items'][0]['downloadUrl']
-            # construct an HttpRequest object from scratch
-            request  = apiclient.http.HttpRequest(self.http, None, url, headers={})
-            fh       = io.FileIO(tmp_path, 'wb')
-            dloader  = apiclient.http.MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = dloader.next_chunk()
-            fh.close()
-
-            self.decorator.undecorate_file(tmp_path, path)
-            # remove temporary file
-            os.unlink(tmp_path)
+            return
+
+        resource = self._find("title='%s'" % obj_id)
+        if not len(resource['items']):
+            raise IOError(obj_id)
+        url      = resource['items'][0]['downloadUrl']
+        # construct an HttpRequest object from scratch
+        request  = apiclient.http.HttpRequest(self.http, None, url, headers={})
+        for data in self.decorator.undecorate_stream( \
+                self._download_chunks(request)):
+            yield data
+
+    def _download_chunks(self, request):
+        fh      = io.BytesIO()
+        dloader = apiclient.http.MediaIoBaseDownload(fh, request, \
+            chunksize=GDFS.READ_CHUNK)
+        done    = False
+        while not done:
+            (status, done) = self._transfer( \
+                scheduler.TransferScheduler.LANE_SMALL, 0, \
+                dloader.next_chunk)
+            yield fh.getvalue()
+            fh.seek(0)
+            fh.truncate()
 
     def store_from_file(self, path, id=""):
         """Upload file onto cloud."""
@@ -268,7 +290,10 @@ class GDFS(bakfilesystem.BackupFileSystem):
             bakfilesystem.BackupFileSystem.store_from_file(self, \
                 path, id)
 
-        tmp_path = self.configure["SYS_DIR"] + "/tmp"
+        # unique name, transfers may run concurrently
+        (fd, tmp_path) = \
+            tempfile.mkstemp(dir=self.configure["SYS_DIR"] + "/tmp")
+        os.close(fd)
         self.decorator.decorate_file(path, tmp_path)
 
         if GDFS.DEBUG:
@@ -279,7 +304,9 @@ class GDFS(bakfilesystem.BackupFileSystem):
             media = apiclient.http.MediaFileUpload(tmp_path, \
                 mimetype="application/octet-stream")
             body  = self._get_http_body(obj_id)
-            self.service.files().insert(body=body, media_body=media).execute()
+            request = self.service.files().insert(body=body, media_body=media)
+            self._transfer(self._file_lane(os.path.getsize(path)), \
+                os.path.getsize(tmp_path), request.execute)
 
             # remove temporary file
             os.unlink(tmp_path)
@@ -297,7 +324,9 @@ class GDFS(bakfilesystem.BackupFileSystem):
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
             body  = self._get_http_body(obj_id)
             media = apiclient.http.MediaInMemoryUpload(data)
-            self.service.files().insert(body=body, media_body=media).execute()
+            request = self.service.files().insert(body=body, media_body=media)
+            self._transfer(scheduler.TransferScheduler.LANE_META, len(data), \
+            request.execute)
 
         return obj_id
 
@@ -314,7 +343,8 @@ class GDFS(bakfilesystem.BackupFileSystem):
             except KeyError:
                 print "error!!!"
                 return
-            (response, data) = self.http.request(url)
+            (response, data) = self._transfer( \
+                scheduler.TransferScheduler.LANE_META, 0, self.http.request, url)
         # undecorate data
         data = self.decorator.undecorate(data)
 
@@ -330,6 +360,114 @@ class GDFS(bakfilesystem.BackupFileSystem):
         # remove specified snapshot
         self.service.files().delete(oid).execute()
 
+    def list_snapshot_etags(self):
+        etags = {}
+        for record in self._find_all("'%s' in parents" % self.ss_folder):
+            etags[record['title']] = record.get('etag', "")
+
+        return etags
+
+    # files are searched by modification time, no journal is kept
+    # markers are RFC 3339 timestamps
+    def list_snapshots_since(self, marker):
+        timestamp = calendar.timegm(time.strptime(marker[:19], \
+            GDFS.TIME_FORMAT)) - bakfilesystem.BackupFileSystem.JOURNAL_SKEW
+        ss_list = []
+        for record in self._find_all("'%s' in parents and modifiedDate > '%s'" \
+                % (self.ss_folder, self._rfc3339(timestamp))):
+            ss_list.append(record['title'])
+            marker = max(marker, record['modifiedDate'])
+
+        return (ss_list, marker)
+
+    def journal_marker(self):
+        return self._rfc3339(time.time())
+
+    def _rfc3339(self, timestamp):
+        return time.strftime(GDFS.TIME_FORMAT, time.gmtime(timestamp)) + \
+            ".000Z"
+
+    # all the files found, following page tokens
+    def _find_all(self, query_condition):
+        items = []
+        token = None
+        while True:
+            request = self.service.files().list(q="%s" % query_condition, \
+                pageToken=token)
+            res   = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                request.execute)
+            items.extend(res[GDFSJSONKey.ITEMS])
+            token = res.get('nextPageToken')
+            if not token:
+                break
+
+        return items
+
+    def list_raw(self, kind):
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            # objects are put into no folder
+            return [record['title'] for record in \
+                self._find_all("'root' in parents") \
+                if len(record['title']) == meta.dir.DirEntry.DE_LEN_CHKSM]
+        else:
+            return [record['title'] for record in \
+                self._find_all("'%s' in parents" % self._raw_folder(kind))]
+
+    def get_raw(self, kind, name, path):
+        if GDFS.DEBUG:
+            print "[DEBUG] Get raw:", name
+
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            resource = self._find("title='%s'" % name)
+        else:
+            resource = self._find("title='%s' and '%s' in parents" % \
+                (name, self._raw_folder(kind)))
+        if not len(resource[GDFSJSONKey.ITEMS]):
+            raise IOError(name)
+        url     = resource[GDFSJSONKey.ITEMS][0]['downloadUrl']
+        request = apiclient.http.HttpRequest(self.http, None, url, headers={})
+        fh      = io.FileIO(path, 'wb')
+        dloader = apiclient.http.MediaIoBaseDownload(fh, request)
+        self._transfer(scheduler.TransferScheduler.LANE_SMALL, 0, \
+            self._download, dloader)
+        fh.close()
+
+    def put_raw(self, kind, name, path):
+        if GDFS.DEBUG:
+            print "[DEBUG] Put raw:", name
+
+        fsize = os.path.getsize(path)
+        media = apiclient.http.MediaFileUpload(path, \
+            mimetype="application/octet-stream")
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            body = self._get_http_body(name)
+            lane = self._file_lane(fsize)
+        else:
+            # snapshots are listed by modification time, no journal
+            body = self._get_http_body(name, "application/octet-stream", \
+                [self._raw_folder(kind)])
+            lane = scheduler.TransferScheduler.LANE_META
+        request = self.service.files().insert(body=body, media_body=media)
+        self._transfer(lane, fsize, request.execute)
+
+    def _raw_folder(self, kind):
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            return self.ss_folder
+        else:
+            return self.tag_folder
+
+    # files on drive have no conditional update, sync lists snapshots
+    def get_head(self, etag=None):
+        raise NotImplementedError("Google Drive has no conditional write")
+
+    def put_head(self, heads, etag):
+        raise NotImplementedError("Google Drive has no conditional write")
+
+    def _download(self, dloader):
+        done = False
+        while not done:
+            status, done = dloader.next_chunk()
+
     def _get_download_url(self, obj_id):
         """Get object download URL from object id."""
         pass
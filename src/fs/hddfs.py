@@ -20,9 +20,15 @@ import os
 import sys
 import hashlib
 import shutil
+import stat
 import fnmatch
+import threading
+import time
+
+import pyinotify
 
 import filesystem
+import subscription
 import meta.dir
 
 class HDDFS(filesystem.FileSystem):
@@ -33,6 +39,10 @@ class HDDFS(filesystem.FileSystem):
 
     # literal constants
     ROOT_SNAPSHOT = "root_snapshot"
+    HEAD_ETAG     = "head_etag:"
+    SUBSCRIPTION  = "subscription"
+    # seconds to keep events of remote sync writes expected
+    SELF_WRITE_TTL = 300
     
     # root path
     def __init__(self, configure, db, omits, backup_clouds, DEBUG=False):
@@ -48,12 +58,25 @@ class HDDFS(filesystem.FileSystem):
         # This field indicates direction of inotify events
         # local when true, cloud otherwise
         self.source = True
+        # local writes performed by remote sync, their inotify events are
+        # filtered out, path -> [inode, size, mtime, deadline], inode is
+        # None until the write settles, 0 if nothing is left at the path
+        self.self_writes  = {}
+        # local trees removed by remote sync, path -> deadline
+        self.self_removes = {}
+        self.self_lock    = threading.Lock()
         self.configure  = configure
         self.bak_clouds = backup_clouds
         self.omits = omits
         # empty cache
         self.snapshots = {}
         self.fs_hierachy = {}
+        # persistent stat cache, skip unchanged files if set
+        self.stat_cache  = None
+        # subtrees kept on this device
+        self.subscription = subscription.Subscription(configure)
+        # restores placeholders hydrated on open if set
+        self.hydrator    = None
 
     def list_snapshots(self):
         snapshots = os.listdir(self.configure["SYS_DIR_SS"])
@@ -198,14 +221,24 @@ class HDDFS(filesystem.FileSystem):
     # upload local files onto cloud
     # if path to a directory specified, all files in the directory
     # will be uploaded recursively.
+    # files unchanged since last backup are not read again
     def backup_files(self, base, path):
         abspath = os.path.join(base, path)
-        if os.path.isdir(abspath):
+        st = os.stat(abspath)
+        if self.stat_cache:
+            cached = self.stat_cache.lookup(st)
+        else:
+            cached = None
+
+        if stat.S_ISDIR(st.st_mode):
             directory = meta.dir.Dir(path)
             files     = os.listdir(abspath)
-            if len(files):
-                for f in os.listdir(abspath):
-                    if not self.is_omitted(f):
+            carried   = self.unsubscribed_entries(abspath)
+            if len(files) or len(carried):
+                for f in files:
+                    fpath = os.path.join(abspath, f)
+                    if not self.is_omitted(f) and \
+                            self.is_subscribed(fpath, os.path.isdir(fpath)):
                         entry = meta.dir.DirEntry()
                         mode  = 0
                         if os.path.isdir(os.path.join(abspath, f)):
@@ -215,18 +248,49 @@ class HDDFS(filesystem.FileSystem):
                         (entry.obj_id, entry.fsize) = \
                             self.backup_files(abspath, f)
                         directory.add_entry(entry)
-
-                # store directory object, all the directory has size 0
-                return (self.bak_clouds[0].store(str(directory)), 0)
+                for entry in carried:
+                    directory.add_entry(entry)
+
+                data = str(directory)
+                md5  = hashlib.md5()
+                md5.update(data)
+                obj_id = md5.hexdigest()
+                if not cached or not cached.obj_id == obj_id:
+                    # store directory object, all the directory has size 0
+                    obj_id = self.bak_clouds[0].store(data, obj_id)
+                fsize = 0
             else:
                 # if empty directory
                 # just return required information, no need to create
                 # real dir object
-                return (filesystem.FileSystem.EMPTY_FILE_MD5, 0)
+                (obj_id, fsize) = (filesystem.FileSystem.EMPTY_FILE_MD5, 0)
+        elif self.hydrator and self.hydrator.placeholder_id(abspath):
+            # placeholder not opened yet, content is on the cloud
+            (obj_id, fsize) = (self.hydrator.placeholder_id(abspath), \
+                st.st_size)
+            self.hydrator.watch(abspath, obj_id, fsize)
+        elif cached:
+            # simply a file, not modified since last stored
+            (obj_id, fsize) = (cached.obj_id, st.st_size)
         else:
-            fsize = os.path.getsize(abspath)
             # simply a file
-            return (self.bak_clouds[0].store_from_file(abspath), fsize)
+            fsize  = st.st_size
+            obj_id = self.bak_clouds[0].store_from_file(abspath)
+
+        self.cache_stat(st, path, obj_id, fsize)
+
+        return (obj_id, fsize)
+
+    # remember the object stored for a local file or directory
+    def cache_stat(self, st, fname, obj_id, fsize):
+        if self.stat_cache:
+            entry = meta.dir.DirEntry()
+            if stat.S_ISDIR(st.st_mode):
+                entry.mode = meta.dir.DirEntry.DE_ATTR_DIR
+            entry.fname  = fname
+            entry.obj_id = obj_id
+            entry.fsize  = fsize
+            self.stat_cache.put(st, entry)
 
     def retrieve(self, path):
         abspath = self._abspath(path)
@@ -241,6 +305,16 @@ class HDDFS(filesystem.FileSystem):
             inputfile.close()
             
             return data
+
+    def open_read(self, path):
+        abspath = self._abspath(path)
+        if HDDFS.DEBUG:
+            print "[DEBUG] Read local file:", abspath
+
+        if self.isdir(path):
+            return iter([])
+        else:
+            return self._read_chunks(file(abspath, "rb"))
         
     def store(self, path, data):
         abspath = self._abspath(path)
@@ -285,6 +359,126 @@ class HDDFS(filesystem.FileSystem):
         if os.path.exists(abspath):
             shutil.rmtree(abspath)
 
+    def expect_write(self, abspath, fsize):
+        """Register a local write about to be made by remote sync.
+Params:
+    abspath: absolute path of the file or directory to be written;
+    fsize: expected size of the result.
+
+Return:
+    None."""
+        self.self_lock.acquire()
+        self.self_writes[abspath] = [None, fsize, None, \
+            time.time() + HDDFS.SELF_WRITE_TTL]
+        self.self_lock.release()
+
+    def settle_write(self, abspath):
+        """Record final state of a local write made by remote sync.
+Params:
+    abspath: absolute path passed to expect_write before.
+
+Return:
+    None."""
+        try:
+            st = os.lstat(abspath)
+            state = [st.st_ino, st.st_size, st.st_mtime]
+        except OSError:
+            # renamed away or never written, no inode 0 is left behind
+            state = [0, None, None]
+
+        self.self_lock.acquire()
+        self.self_writes[abspath] = state + \
+            [time.time() + HDDFS.SELF_WRITE_TTL]
+        self.self_lock.release()
+
+    def is_write_pending(self, abspath):
+        """Check whether remote sync is still writing a path.
+Events of such a path are told apart from user changes only once the
+write settles, thus they should be deferred rather than checked.
+Params:
+    abspath: path name of an event."""
+        self.self_lock.acquire()
+        try:
+            self._expire_self_writes()
+            return abspath in self.self_writes and \
+                self.self_writes[abspath][0] is None
+        finally:
+            self.self_lock.release()
+
+    def expect_remove(self, abspath):
+        """Register a local tree about to be removed by remote sync.
+Params:
+    abspath: absolute path of the file or directory to be removed."""
+        self.self_lock.acquire()
+        self.self_removes[abspath] = time.time() + HDDFS.SELF_WRITE_TTL
+        self.self_lock.release()
+
+    def is_self_write(self, abspath, mask):
+        """Check whether an inotify event is caused by remote sync.
+Events matching an expected write are consumed, any later change on the
+same path is a genuine local modification.
+Params:
+    abspath: path name of the event;
+    mask: inotify event mask.
+
+Return:
+    True if the event should be ignored."""
+        self.self_lock.acquire()
+        try:
+            self._expire_self_writes()
+            if mask & pyinotify.IN_DELETE:
+                for path in self.self_removes:
+                    if (abspath == path or abspath.startswith(path + \
+                            os.path.sep)) and not os.path.lexists(abspath):
+                        if abspath == path:
+                            del self.self_removes[path]
+                        return True
+                return False
+
+            try:
+                (ino, fsize, mtime, deadline) = self.self_writes[abspath]
+            except KeyError:
+                return False
+            if ino is None:
+                # remote sync still writing, events deferred until the
+                # write settles never get here, see is_write_pending
+                return True
+
+            try:
+                st = os.lstat(abspath)
+            except OSError:
+                # gone already, its delete event tells
+                return True
+            if stat.S_ISDIR(st.st_mode):
+                # files restored into it change its size and mtime
+                changed = not st.st_ino == ino
+            else:
+                changed = not (st.st_ino, st.st_size, st.st_mtime) == \
+                    (ino, fsize, mtime)
+            if changed:
+                # modified by user after sync
+                del self.self_writes[abspath]
+                return False
+
+            if mask & pyinotify.IN_CLOSE_WRITE or \
+                    mask & pyinotify.IN_MOVED_TO or \
+                    (mask & pyinotify.IN_CREATE and mask & pyinotify.IN_ISDIR):
+                # last event of the write
+                del self.self_writes[abspath]
+            return True
+        finally:
+            self.self_lock.release()
+
+    def _expire_self_writes(self):
+        # expected events never delivered
+        now = time.time()
+        for path in self.self_writes.keys():
+            if self.self_writes[path][3] < now:
+                del self.self_writes[path]
+        for path in self.self_removes.keys():
+            if self.self_removes[path] < now:
+                del self.self_removes[path]
+
     def get_root_snapshot_id(self):
         try:
             return self.db[HDDFS.ROOT_SNAPSHOT]
@@ -295,6 +489,67 @@ class HDDFS(filesystem.FileSystem):
     def set_root_snapshot_id(self, value):
         self.db[HDDFS.ROOT_SNAPSHOT] = value
 
+    def get_head_etag(self, cloud_id):
+        """Version of the head object of a cloud seen by last sync."""
+        try:
+            return self.db[HDDFS.HEAD_ETAG + cloud_id]
+        except KeyError:
+            return None
+
+    def set_head_etag(self, cloud_id, etag):
+        self.db[HDDFS.HEAD_ETAG + cloud_id] = etag
+
+    def get_subscription(self):
+        """Subscription the local tree was materialized with, the whole
+tree if never recorded."""
+        try:
+            (includes, excludes) = self.db[HDDFS.SUBSCRIPTION].split( \
+                subscription.Subscription.RECORD_DELIM, 1)
+        except KeyError:
+            (includes, excludes) = ("", "")
+        return subscription.Subscription({"SUBSCRIBE": includes, \
+            "UNSUBSCRIBE": excludes})
+
+    def set_subscription(self, sub):
+        self.db[HDDFS.SUBSCRIPTION] = str(sub)
+
+    def is_subscribed(self, abspath, isdir):
+        """Check whether a local path is kept by this device.
+Params:
+    abspath: absolute path of a file or directory;
+    isdir: True if it is a directory.
+
+Return:
+    True if changes under the path are applied and committed."""
+        native = self.native_path(abspath)
+        if isdir:
+            return self.subscription.visits(native)
+        else:
+            return self.subscription.covers(native)
+
+    def unsubscribed_entries(self, abspath):
+        """Entries of a committed directory not kept by this device, they
+are carried into new versions of the directory unchanged.
+Params:
+    abspath: absolute path of the directory.
+
+Return:
+    List of DirEntry objects."""
+        if self.subscription.everything():
+            return []
+
+        native   = self.native_path(abspath)
+        path_stk = self.find(native, self.fs_hierachy)
+        if not native == HDDFS.ROOT and \
+                not len(path_stk) == len(native.split(os.path.sep)):
+            # not committed yet
+            return []
+
+        entries = path_stk.pop().dir_entries
+        return [entries[f] for f in entries \
+                if not f == meta.dir.Dir.SELF_REF and \
+                not self.subscription.child(native, f, entries[f].isdir())]
+
     # store tag object on cloud
     def tag(self, tag, path):
         """Tag current snapshot to a easy-mem name.
@@ -0,0 +1,117 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module keeps the snapshot listing of a cloud between syncs.
+#
+# The snapshots known on a cloud are cached in a file with their ETags
+# and the marker of the last incremental listing. A refresh asks the
+# cloud only for snapshots appended after the marker, so its cost follows
+# the number of new snapshots rather than the whole history. A full
+# listing replaces the cache on first use, on request for reconciliation
+# and on media keeping no journal, it also prunes journal entries older
+# than JOURNAL_RETENTION. Markers as old fall back to a full listing.
+import os
+import traceback
+
+class SnapshotListing:
+    """Persistent snapshot listing of a backup file system."""
+    RECORD_DELIM = ' '
+
+    def __init__(self, cloud, path, DEBUG=False):
+        """Params:
+    cloud: the BackupFileSystem listed;
+    path: file keeping the listing state."""
+        SnapshotListing.DEBUG = DEBUG
+        self.cloud  = cloud
+        self.path   = path
+        # marker of next incremental listing, None if a full one is due
+        self.marker = None
+        # snapshot id -> ETag
+        self.etags  = {}
+
+        self._load()
+
+    def refresh(self, full=False):
+        """Bring the listing up to date.
+Params:
+    full: reconcile with a full listing of the cloud.
+
+Return:
+    List of snapshot ids on the cloud."""
+        if not full and self.marker:
+            try:
+                (ss_list, marker) = \
+                    self.cloud.list_snapshots_since(self.marker)
+                for ss_id in ss_list:
+                    self.etags.setdefault(ss_id, "")
+                self.marker = marker
+                self._save()
+
+                return self.etags.keys()
+            except NotImplementedError:
+                pass
+
+        # take the marker first, appends during the listing are listed
+        # again next time rather than lost
+        marker = self.cloud.journal_marker()
+        etags  = self.cloud.list_snapshot_etags()
+        if SnapshotListing.DEBUG:
+            removed = [s for s in self.etags if s not in etags]
+            print "[DEBUG] Full listing of", self.cloud.ID, ":", \
+                len(etags), "snapshots,", len(removed), "removed"
+        self.etags  = etags
+        self.marker = marker
+        self._save()
+
+        # keep the journal from growing, a failed prune is retried by the
+        # next full listing
+        try:
+            self.cloud.prune_journal()
+        except Exception:
+            traceback.print_exc()
+
+        return self.etags.keys()
+
+    def forget(self, ss_id):
+        """Drop a snapshot found missing on the cloud."""
+        if ss_id in self.etags:
+            del self.etags[ss_id]
+            self._save()
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            # never listed
+            return
+        try:
+            self.marker = f.readline().rstrip(os.linesep) or None
+            for line in f:
+                (ss_id, etag) = line.rstrip(os.linesep).split( \
+                    SnapshotListing.RECORD_DELIM, 1)
+                self.etags[ss_id] = etag
+        finally:
+            f.close()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        f = open(tmp_path, "w")
+        f.write((self.marker or "") + os.linesep)
+        for (ss_id, etag) in self.etags.items():
+            f.write(ss_id + SnapshotListing.RECORD_DELIM + etag + os.linesep)
+        f.close()
+        os.rename(tmp_path, self.path)
@@ -17,6 +17,7 @@
 
 # This is an emulator module for cloud storage
 # File will be stored in $HOME/cloud/
+import fcntl
 import os
 import shutil
 import hashlib
@@ -25,6 +26,7 @@ import datetime
 
 import bakfilesystem
 import meta.snapshot
+import meta.dir
 import filesystem
 
 class LocalFS(bakfilesystem.BackupFileSystem):
@@ -65,6 +67,34 @@ class LocalFS(bakfilesystem.BackupFileSystem):
 
         return os.listdir(snapshot_path)
 
+    def list_snapshot_etags(self):
+        snapshot_path = os.path.join(self.storage, self.ss_folder)
+        etags = {}
+        for ss_id in os.listdir(snapshot_path):
+            st = os.stat(os.path.join(snapshot_path, ss_id))
+            etags[ss_id] = "%x-%x" % (st.st_size, \
+                int(round(st.st_mtime * 1000000000)))
+
+        return etags
+
+    def list_snapshots_since(self, marker):
+        journal = os.path.join(self.storage, \
+            bakfilesystem.BackupFileSystem.JOURNAL_FOLDER)
+        start   = self._journal_start(marker)
+        ss_list = []
+        if os.path.isdir(journal):
+            # one directory per day
+            for day in sorted(os.listdir(journal)):
+                if day < start[:len(day)]:
+                    continue
+                for name in os.listdir(os.path.join(journal, day)):
+                    key = day + "/" + name
+                    if key >= start:
+                        ss_list.append(self._journal_id(key))
+                        marker = max(marker, key)
+
+        return (ss_list, marker)
+
     def get_snapshot(self, ss_id):
         """Get snapshot content"""
         obj_id = self._join(self.ss_folder, ss_id)
@@ -94,6 +124,7 @@ class LocalFS(bakfilesystem.BackupFileSystem):
         f = file(obj_id, 'wb')
         f.write(data)
         f.close()
+        self._append_journal(ss_id)
 
         return ss_id
 
@@ -152,11 +183,23 @@ class LocalFS(bakfilesystem.BackupFileSystem):
         if LocalFS.DEBUG:
             print "[DEBUG] Get object:", obj_id
 
+        self._save_chunks(self.open_read(obj_id), path)
+
+    def open_read(self, obj_id):
         if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            file(path, 'w')
-        else:
-            obj_id = self._join(self.storage, obj_id)
-            self.decorator.undecorate_file(obj_id, path)
+            return
+
+        path = self._join(self.storage, obj_id)
+        if not os.path.exists(path):
+            # a directory object
+            path = self._join(self._join(self.storage, self.dir_folder), \
+                obj_id)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            raise IOError(obj_id)
+        for data in self.decorator.undecorate_stream(self._read_chunks(f)):
+            yield data
 
     def store_from_file(self, path, id=""):
         obj_id = \
@@ -166,7 +209,9 @@ class LocalFS(bakfilesystem.BackupFileSystem):
             print "[DEBUG] Store file:", path, "as", obj_id
 
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            self.decorator.decorate_file(path, obj_path)
+            fsize = os.path.getsize(path)
+            self._transfer(self._file_lane(fsize), fsize, \
+                self.decorator.decorate_file, path, obj_path)
 
         return obj_id
 
@@ -187,6 +232,9 @@ class LocalFS(bakfilesystem.BackupFileSystem):
     def retrieve(self, obj_id):
         path = self._join(self.dir_folder, obj_id)
         path = self._join(self.storage, path)
+        if not os.path.exists(path):
+            # replicated from a media keeping directories with files
+            path = self._join(self.storage, obj_id)
         if LocalFS.DEBUG:
             print "[DEBUG] Get object:", obj_id
 
@@ -208,6 +256,127 @@ class LocalFS(bakfilesystem.BackupFileSystem):
 
         os.remove(obj_id)
 
+    def list_raw(self, kind):
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            path = self._join(self.storage, self.dir_folder)
+            return self.list_objects() + [f for f in os.listdir(path) \
+                if len(f) == meta.dir.DirEntry.DE_LEN_CHKSM]
+        else:
+            return os.listdir(self._raw_path(kind, ""))
+
+    def get_raw(self, kind, name, path):
+        src = self._raw_path(kind, name)
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT and \
+                not os.path.exists(src):
+            src = self._join(self._join(self.storage, self.dir_folder), name)
+        if LocalFS.DEBUG:
+            print "[DEBUG] Get raw:", src
+
+        shutil.copyfile(src, path)
+
+    def put_raw(self, kind, name, path):
+        dst = self._raw_path(kind, name)
+        if LocalFS.DEBUG:
+            print "[DEBUG] Put raw:", dst
+
+        # never seen half written
+        shutil.copyfile(path, dst + ".tmp")
+        os.rename(dst + ".tmp", dst)
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            self._append_journal(name)
+
+    def get_head(self, etag=None):
+        path = self._join(self.storage, \
+            bakfilesystem.BackupFileSystem.HEAD_OBJECT)
+        try:
+            f = file(path)
+        except IOError:
+            raise IOError("Head")
+        try:
+            # the file is replaced by rename, its inode tells the version
+            current = self._head_etag(os.fstat(f.fileno()))
+            if current == etag:
+                return (None, etag)
+
+            return (self._parse_head(f.read()), current)
+        finally:
+            f.close()
+
+    def put_head(self, heads, etag):
+        path = self._join(self.storage, \
+            bakfilesystem.BackupFileSystem.HEAD_OBJECT)
+        lock = file(path + ".lock", 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            try:
+                current = self._head_etag(os.stat(path))
+            except OSError:
+                current = None
+            if not current == etag:
+                return None
+
+            tmp_path = path + ".tmp"
+            f = file(tmp_path, 'wb')
+            f.write(self._head_data(heads))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp_path, path)
+
+            return self._head_etag(os.stat(path))
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            lock.close()
+
+    # record the append of a snapshot in journal
+    def _append_journal(self, ss_id):
+        key = self._join(self.storage, self._join( \
+            bakfilesystem.BackupFileSystem.JOURNAL_FOLDER, \
+            self._journal_key(ss_id)))
+        if not os.path.exists(os.path.dirname(key)):
+            os.makedirs(os.path.dirname(key))
+        file(key, 'w').close()
+
+    def _journal_keys(self):
+        journal = os.path.join(self.storage, \
+            bakfilesystem.BackupFileSystem.JOURNAL_FOLDER)
+        keys = []
+        if os.path.isdir(journal):
+            for day in os.listdir(journal):
+                for name in os.listdir(os.path.join(journal, day)):
+                    keys.append(day + "/" + name)
+
+        return keys
+
+    def _remove_journal(self, key):
+        path = os.path.join(self.storage, \
+            bakfilesystem.BackupFileSystem.JOURNAL_FOLDER, key)
+        try:
+            os.remove(path)
+        except OSError:
+            # pruned by someone else
+            pass
+        try:
+            # the directory of a day goes with its last entry
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    # path of a raw key, directory objects are written with files
+    def _raw_path(self, kind, name):
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            folder = self._join(self.storage, self.ss_folder)
+        elif kind == bakfilesystem.BackupFileSystem.RAW_TAG:
+            folder = self._join(self.storage, self.tag_folder)
+        else:
+            folder = self.storage
+
+        return self._join(folder, name)
+
+    def _head_etag(self, st):
+        return "%x-%x-%d" % (st.st_ino, st.st_size, \
+            int(round(st.st_mtime * 1000000000)))
+
     def _join(self, base, relpath):
         if not base[-1] == LocalFS.SEPERATOR:
             base = base + LocalFS.SEPERATOR
@@ -30,6 +30,7 @@ import os
 import urllib
 import StringIO
 from oss_util import *
+from oss_pool import ConnectionPool
 from hashlib import sha1 as sha
         
 class OssAPI:
@@ -44,8 +45,10 @@ class OssAPI:
         self.host = host
         self.access_id = access_id
         self.secret_access_key = secret_access_key
+        # connections are kept open and shared by clients of the host
+        self.pool = ConnectionPool.of(host)
 
-    def sign_url_auth_with_expire_time(self, method, url, headers = {}, resource="/", timeout = 60):
+    def sign_url_auth_with_expire_time(self, method, url, headers=None, resource="/", timeout = 60):
         '''
         Create the authorization for OSS based on the input method, url, body and headers
         :type method: string
@@ -67,6 +70,7 @@ class OssAPI:
             signature url.
         '''
 
+        headers = dict(headers or {})
         send_time= safe_get_element('Date', headers)
         if len(send_time) == 0:
             send_time = str(int(time.time()) + timeout)
@@ -75,7 +79,7 @@ class OssAPI:
         params = {"OSSAccessKeyId":self.access_id, "Expires":str(send_time), "Signature":auth_value}
         return append_param(url, params)
 
-    def _create_sign_for_normal_auth(self, method, headers = {}, resource="/"):
+    def _create_sign_for_normal_auth(self, method, headers=None, resource="/"):
         '''
         NOT public API
         Create the authorization for OSS based on header input.
@@ -95,10 +99,10 @@ class OssAPI:
         
         '''
 
-        auth_value = "OSS " + self.access_id + ":" + get_assign(self.secret_access_key, method, headers, resource)
+        auth_value = "OSS " + self.access_id + ":" + get_assign(self.secret_access_key, method, headers or {}, resource)
         return auth_value
        
-    def bucket_operation(self, method, bucket, headers={}, params={}):
+    def bucket_operation(self, method, bucket, headers=None, params=None):
         '''
         Send bucket operation request 
 
@@ -119,6 +123,9 @@ class OssAPI:
 
         '''
 
+        # every request gets its own headers
+        headers = dict(headers or {})
+        params = dict(params or {})
         url = append_param("/" + bucket + "/", params)
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
         # Create REST header
@@ -133,11 +140,9 @@ class OssAPI:
         elif "" != self.access_id:
             headers['Authorization'] = self.access_id 
             
-        conn = httplib.HTTPConnection(self.host)
-        conn.request(method, url, "", headers)
-        return conn.getresponse()
+        return self.pool.request(method, url, "", headers)
 
-    def object_operation(self, method, bucket, object, headers = {}, data=""):
+    def object_operation(self, method, bucket, object, headers=None, data=""):
         '''
         Send Object operation request
         
@@ -168,7 +173,8 @@ class OssAPI:
         url = "/" + bucket + "/" + object
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
 
-         # Create REST header
+        # Create REST header
+        headers = dict(headers or {})
         headers['Date'] = date
         headers['Host'] = self.host
         if "" != self.secret_access_key and "" != self.access_id:
@@ -176,9 +182,7 @@ class OssAPI:
         elif "" != self.access_id:
             headers['Authorization'] = self.access_id 
 
-        conn = httplib.HTTPConnection(self.host)
-        conn.request(method, url, data, headers)
-        return conn.getresponse()
+        return self.pool.request(method, url, data, headers)
 
     def get_service(self):
         '''
@@ -204,9 +208,7 @@ class OssAPI:
         elif "" != self.access_id:
             headers['Authorization'] = self.access_id 
      
-        conn = httplib.HTTPConnection(self.host)
-        conn.request(method, url, "", headers)
-        return conn.getresponse()
+        return self.pool.request(method, url, "", headers)
 
     def get_bucket_acl(self, bucket):
         '''
@@ -223,13 +225,13 @@ class OssAPI:
         params['acl'] = ''
         return self.bucket_operation("GET", bucket, headers, params)
 
-    def get_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers = {}):
+    def get_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers=None):
         '''
         List object that in bucket
         '''
         return self.list_bucket(bucket, prefix, marker, delimiter, maxkeys, headers)
 
-    def list_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers = {}):
+    def list_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers=None):
         '''
         List object that in bucket
 
@@ -262,13 +264,13 @@ class OssAPI:
         params['max-keys'] = maxkeys
         return self.bucket_operation("GET", bucket, headers, params)
 
-    def create_bucket(self, bucket, acl='', headers = {}):
+    def create_bucket(self, bucket, acl='', headers=None):
         '''
         Create bucket
         '''
         return self.put_bucket(bucket, acl, headers)
 
-    def put_bucket(self, bucket, acl='', headers = {}):
+    def put_bucket(self, bucket, acl='', headers=None):
         '''
         Create bucket
         
@@ -285,6 +287,7 @@ class OssAPI:
             HTTP Response
         '''
 
+        headers = dict(headers or {})
         if acl != '':
             headers['x-oss-acl'] = acl
         return self.bucket_operation("PUT", bucket, headers)
@@ -302,13 +305,13 @@ class OssAPI:
 
         return self.bucket_operation("DELETE", bucket)
 
-    def put_object_with_data(self, bucket, object, input_content, content_type=DefaultContentType, headers = {}):
+    def put_object_with_data(self, bucket, object, input_content, content_type=DefaultContentType, headers=None):
         '''
         Put object into bucket, the content of object is from input_content
         '''
         return self.put_object_from_string(bucket, object, input_content, content_type, headers)
 
-    def put_object_from_string(self, bucket, object, input_content, content_type=DefaultContentType, headers = {}):
+    def put_object_from_string(self, bucket, object, input_content, content_type=DefaultContentType, headers=None):
         '''
         Put object into bucket, the content of object is from input_content
 
@@ -331,6 +334,7 @@ class OssAPI:
             HTTP Response
         '''
 
+        headers = dict(headers or {})
         headers['Content-Type'] = content_type
         headers['Content-Length'] = str(len(input_content))
         fp = StringIO.StringIO(input_content)
@@ -338,22 +342,23 @@ class OssAPI:
         fp.close()
         return res
 
-    def _open_conn_to_put_object(self, bucket, object, filesize, content_type=DefaultContentType, headers = {}):
+    def _put_object(self, bucket, object, filesize, send, content_type=DefaultContentType, headers=None):
         '''
         NOT public API
-        Open a connectioon to put object
+        Put object with content sent by a callback
 
         :type bucket: string
         :param
 
         :type filesize: int 
-        :param
+        :param: content length, None to send the content chunked
         
         :type object: string
         :param
         
-        :type input_content: string
-        :param
+        :type send: callable
+        :param: send(conn) sends the content, called again if the request
+                is retried on another connection
 
         :type content_type: string
         :param: the object content type that supported by HTTP
@@ -374,8 +379,55 @@ class OssAPI:
         url = "/" + bucket + "/" + object
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
 
+        headers = dict(headers or {})
+        headers["Content-Type"] = content_type
+        if filesize is None:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = filesize
+        headers["Date"] = date
+        headers["Host"] = self.host
+        headers["Expect"] = "100-Continue"
+        if "" != self.secret_access_key and "" != self.access_id:
+            headers["Authorization"] = self._create_sign_for_normal_auth(method, headers, resource)
+        return self.pool.request(method, url, None, headers, send)
+
+    def _open_conn_to_put_object(self, bucket, object, filesize, content_type=DefaultContentType, headers=None):
+        '''
+        NOT public API
+        Open a connectioon to put object, the connection is not pooled
+
+        :type bucket: string
+        :param
+
+        :type filesize: int 
+        :param
+        
+        :type object: string
+        :param
+        
+        :type content_type: string
+        :param: the object content type that supported by HTTP
+
+        :type headers: dict
+        :param: HTTP header
+
+        Returns:
+            HTTP Connection
+        '''
+
+        method = "PUT"
+        if isinstance(object, unicode):
+            object = object.encode('utf-8')
+        resource = "/" + bucket + "/"
+        resource = resource.encode('utf-8') + object 
+        object = urllib.quote(object)
+        url = "/" + bucket + "/" + object
+        date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
         conn = httplib.HTTPConnection(self.host)
         conn.putrequest(method, url)
+        headers = dict(headers or {})
         headers["Content-Type"] = content_type
         headers["Content-Length"] = filesize
         headers["Date"] = date
@@ -389,7 +441,7 @@ class OssAPI:
         conn.endheaders()
         return conn
 
-    def put_object_from_file(self, bucket, object, filename, content_type=DefaultContentType, headers = {}):
+    def put_object_from_file(self, bucket, object, filename, content_type=DefaultContentType, headers=None):
         '''
         put object into bucket, the content of object is read from file        
 
@@ -417,7 +469,7 @@ class OssAPI:
         fp.close()
         return res
 
-    def put_object_from_fp(self, bucket, object, fp, content_type=DefaultContentType, headers = {}):
+    def put_object_from_fp(self, bucket, object, fp, content_type=DefaultContentType, headers=None):
         '''
         Put object into bucket, the content of object is read from file pointer
 
@@ -442,16 +494,50 @@ class OssAPI:
         
         fp.seek(os.SEEK_SET, os.SEEK_END)
         filesize = fp.tell()
-        fp.seek(os.SEEK_SET)
 
-        conn = self._open_conn_to_put_object(bucket, object, filesize, content_type, headers)
-        l = fp.read(self.SendBufferSize)
-        while len(l) > 0:
-            conn.send(l)
+        def send(conn):
+            fp.seek(os.SEEK_SET)
             l = fp.read(self.SendBufferSize)
-        return conn.getresponse()
+            while len(l) > 0:
+                conn.send(l)
+                l = fp.read(self.SendBufferSize)
+        return self._put_object(bucket, object, filesize, send, content_type, headers)
+
+    def put_object_from_chunks(self, bucket, object, chunks, content_type=DefaultContentType, headers=None):
+        '''
+        Put object into bucket, the content of object is sent with chunked
+        transfer encoding as it is produced, its length need not be known
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type chunks: callable
+        :param: chunks() returns an iterable of strings, the content of
+                object; it is called again if the request is retried. An
+                error raised while iterating aborts the request, thus no
+                partial object is stored
+
+        :type content_type: string
+        :param: the object content type that supported by HTTP
+
+        :type headers: dict
+        :param: HTTP header
+
+        Returns:
+            HTTP Response
+        '''
 
-    def get_object(self, bucket, object, headers = {}):
+        def send(conn):
+            for l in chunks():
+                if len(l) > 0:
+                    conn.send("%x\r\n%s\r\n" % (len(l), l))
+            conn.send("0\r\n\r\n")
+        return self._put_object(bucket, object, None, send, content_type, headers)
+
+    def get_object(self, bucket, object, headers=None):
         '''
         Get object
 
@@ -470,7 +556,7 @@ class OssAPI:
 
         return self.object_operation("GET", bucket, object, headers)
 
-    def get_object_to_file(self, bucket, object, filename, headers = {}):
+    def get_object_to_file(self, bucket, object, filename, headers=None):
         '''
         Get object and write the content of object into a file
 
@@ -503,7 +589,7 @@ class OssAPI:
         # TODO: get object with flow
         return res
 
-    def delete_object(self, bucket, object, headers = {}):
+    def delete_object(self, bucket, object, headers=None):
         '''
         Delete object
         
@@ -522,7 +608,7 @@ class OssAPI:
 
         return self.object_operation("DELETE", bucket, object, headers)
 
-    def head_object(self, bucket, object, headers = {}):
+    def head_object(self, bucket, object, headers=None):
         '''
         Head object, to get the meta message of object without the content
         
@@ -541,7 +627,7 @@ class OssAPI:
 
         return self.object_operation("HEAD", bucket, object, headers)
 
-    def post_object_group(self, bucket, object, object_group_msg_xml, headers = {}, params = {}):
+    def post_object_group(self, bucket, object, object_group_msg_xml, headers=None, params=None):
         '''
         Post object group, merge all objects in object_group_msg_xml into one object
         :type bucket: string
@@ -572,6 +658,7 @@ class OssAPI:
         url = "/" + bucket + "/" + object + "?group"
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
         # Create REST header
+        headers = dict(headers or {})
         headers['Date'] = date
         headers['Host'] = self.host
         headers['Content-Type'] = 'text/xml'
@@ -582,11 +669,9 @@ class OssAPI:
         elif "" != self.access_id:
             headers['Authorization'] = self.access_id 
 
-        conn = httplib.HTTPConnection(self.host)
-        conn.request(method, url, object_group_msg_xml, headers)
-        return conn.getresponse()
+        return self.pool.request(method, url, object_group_msg_xml, headers)
 
-    def get_object_group_index(self, bucket, object, headers = {}):
+    def get_object_group_index(self, bucket, object, headers=None):
         '''
         Get object group_index 
 
@@ -603,11 +688,12 @@ class OssAPI:
             HTTP Response
         '''
 
+        headers = dict(headers or {})
         headers["x-oss-file-group"] = ""
         return self.object_operation("GET", bucket, object, headers)
 
 
-    def put_object_from_file_given_pos(self, bucket, object, filename, offset, partsize, content_type=DefaultContentType, headers = {}):
+    def put_object_from_file_given_pos(self, bucket, object, filename, offset, partsize, content_type=DefaultContentType, headers=None):
         '''
         Put object into bucket, the content of object is read from given posision of filename
         :type bucket: string
@@ -635,29 +721,33 @@ class OssAPI:
             HTTP Response
         '''
         fp = open(filename, 'rb')
-        if offset > os.path.getsize(filename):
-            fp.seek(os.SEEK_SET, os.SEEK_END)
-        else:
-            fp.seek(offset)
 
-        conn = self._open_conn_to_put_object(bucket, object, partsize, content_type, headers)
-
-        left_len = partsize 
-        while True:
-            if left_len <= 0:
-               break
-            elif left_len < self.SendBufferSize:
-               buffer_content = fp.read(left_len)
+        def send(conn):
+            if offset > os.path.getsize(filename):
+                fp.seek(os.SEEK_SET, os.SEEK_END)
             else:
-               buffer_content = fp.read(self.SendBufferSize)
-
-            if len(buffer_content) > 0:
-                conn.send(buffer_content)
-
-            left_len = left_len - len(buffer_content)
-
-        fp.close()
-        return conn.getresponse()
+                fp.seek(offset)
+
+            left_len = partsize 
+            while True:
+                if left_len <= 0:
+                   break
+                elif left_len < self.SendBufferSize:
+                   buffer_content = fp.read(left_len)
+                else:
+                   buffer_content = fp.read(self.SendBufferSize)
+
+                if len(buffer_content) > 0:
+                    conn.send(buffer_content)
+                else:
+                    break
+
+                left_len = left_len - len(buffer_content)
+
+        try:
+            return self._put_object(bucket, object, partsize, send, content_type, headers)
+        finally:
+            fp.close()
 
     def upload_large_file(self, bucket, object, filename, thread_num = 10, max_part_num = 1000):
         '''
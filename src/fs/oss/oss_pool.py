@@ -0,0 +1,210 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module keeps HTTP connections to a host open between requests.
+#
+# Requests are HTTP/1.1, thus the server keeps a connection open once a
+# response is read to its end. The connection then goes back to the pool
+# of its host and serves the next request, small requests do not pay
+# for connection setup. Connections idle longer than IDLE_TIMEOUT are
+# closed rather than reused, and at most MAX_CONNECTIONS connections per
+# host are open at a time, further requests wait for one to be returned.
+#
+# A server may close an idle connection at any time. A request failing
+# on a reused connection before any response arrived is sent again once
+# on a new connection.
+import httplib
+import socket
+import threading
+import time
+
+class ConnectionPool:
+    """Idle connections to one host, shared by all its clients."""
+    MAX_CONNECTIONS = 16            # connections open at a time
+    IDLE_TIMEOUT    = 30            # seconds a connection is kept idle
+
+    # host -> pool
+    pools = {}
+    pools_lock = threading.Lock()
+
+    @staticmethod
+    def of(host):
+        """Pool of a host, created on first use."""
+        ConnectionPool.pools_lock.acquire()
+        try:
+            if not host in ConnectionPool.pools:
+                ConnectionPool.pools[host] = ConnectionPool(host)
+            return ConnectionPool.pools[host]
+        finally:
+            ConnectionPool.pools_lock.release()
+
+    def __init__(self, host, max_connections=MAX_CONNECTIONS, \
+            idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.max_connections = max_connections
+        self.idle_timeout    = idle_timeout
+
+        self.cond = threading.Condition()
+        # (connection, time returned), most recently returned last
+        self.idle = []
+        # connections open, idle or not
+        self.open = 0
+
+    def get(self):
+        """Get a connection, waiting while MAX_CONNECTIONS are in use.
+
+Return:
+    (connection, reused), reused tells the connection served a request
+    already."""
+        self.cond.acquire()
+        try:
+            while True:
+                self._evict()
+                if len(self.idle):
+                    return (self.idle.pop()[0], True)
+                if self.open < self.max_connections:
+                    self.open = self.open + 1
+                    break
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+        return (httplib.HTTPConnection(self.host), False)
+
+    def put(self, conn):
+        """Return a connection whose response was read to its end."""
+        self.cond.acquire()
+        self.idle.append((conn, time.time()))
+        self.cond.notify()
+        self.cond.release()
+
+    def discard(self, conn):
+        """Close a connection which cannot serve another request."""
+        conn.close()
+        self.cond.acquire()
+        self.open = self.open - 1
+        self.cond.notify()
+        self.cond.release()
+
+    def request(self, method, url, body, headers, send=None):
+        """Send a request on a pooled connection.
+Params:
+    body: request body as a string, ignored if send is given;
+    send: send(conn) sends the body, called again on retry. An error
+          raised by it closes the connection and is passed on.
+
+Return:
+    PooledResponse, the connection is returned once it is read."""
+        for attempt in range(2):
+            (conn, reused) = self.get()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    # headers and body go in separate writes, do not let
+                    # the second wait for the ack of the first
+                    conn.sock.setsockopt(socket.IPPROTO_TCP, \
+                        socket.TCP_NODELAY, 1)
+                if send:
+                    conn.putrequest(method, url, skip_host=True, \
+                        skip_accept_encoding=True)
+                    for (k, v) in headers.items():
+                        conn.putheader(k, v)
+                    conn.endheaders()
+                    send(conn)
+                else:
+                    conn.request(method, url, body, headers)
+                res = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                self.discard(conn)
+                if reused and not attempt:
+                    # closed by the server while idle
+                    continue
+                raise
+            except:
+                # the body could not be produced, the request is cut
+                # short rather than completed
+                self.discard(conn)
+                raise
+
+            return PooledResponse(self, conn, res, method)
+
+    # close connections idle for too long, called with cond held
+    def _evict(self):
+        now = time.time()
+        while len(self.idle) and \
+                now - self.idle[0][1] > self.idle_timeout:
+            (conn, returned) = self.idle.pop(0)
+            conn.close()
+            self.open = self.open - 1
+
+class PooledResponse:
+    """HTTP response returning its connection to the pool once read."""
+    def __init__(self, pool, conn, res, method):
+        self.pool   = pool
+        self.conn   = conn
+        self.res    = res
+        self.status = res.status
+        self.reason = res.reason
+        self.msg    = res.msg
+        if not method == "GET" or not res.status == httplib.OK:
+            # no content or a short error, the connection is freed now
+            self.body = res.read()
+            self._release()
+        else:
+            self.body = None
+
+    def read(self, amt=None):
+        if self.body is not None:
+            if amt is None:
+                (data, self.body) = (self.body, "")
+            else:
+                (data, self.body) = (self.body[:amt], self.body[amt:])
+            return data
+
+        try:
+            data = self.res.read(amt)
+        except:
+            self._release(False)
+            raise
+        if self.res.isclosed():
+            self._release()
+        return data
+
+    def getheader(self, name, default=None):
+        return self.res.getheader(name, default)
+
+    def getheaders(self):
+        return self.res.getheaders()
+
+    def isclosed(self):
+        return self.conn is None
+
+    def close(self):
+        # content not read, the connection cannot be reused
+        self._release(False)
+
+    def __del__(self):
+        self._release(False)
+
+    def _release(self, reusable=True):
+        if self.conn is None:
+            return
+        (conn, self.conn) = (self.conn, None)
+        if reusable and not self.res.will_close:
+            self.pool.put(conn)
+        else:
+            self.pool.discard(conn)
@@ -25,13 +25,13 @@ class User:
                 self.access_id, self.secret_access_key)
 
 
-def _format_header(headers = {}):
+def _format_header(headers=None):
     '''
     format the headers that self define
     convert the self define headers to lower.
     '''
     tmp_headers = {}
-    for k in headers.keys():
+    for k in (headers or {}).keys():
         if k.lower().startswith(self_define_header_prefix):
             k_lower = k.lower()
             tmp_headers[k_lower] = headers[k]
@@ -39,7 +39,7 @@ def _format_header(headers = {}):
             tmp_headers[k] = headers[k]
     return tmp_headers
 
-def get_assign(secret_access_key, method, headers = {}, resource="/", result = []):
+def get_assign(secret_access_key, method, headers=None, resource="/", result=None):
     '''
     Create the authorization for OSS based on header input.
     You should put it into "Authorization" parameter of header.
@@ -50,6 +50,7 @@ def get_assign(secret_access_key, method, headers = {}, resource="/", result = [
     canonicalized_oss_headers = ""
     if DEBUG:
         print "secret_access_key", secret_access_key
+    headers = headers or {}
     content_md5 = safe_get_element('Content-Md5', headers)
     content_type = safe_get_element('Content-Type', headers)
     date = safe_get_element('Date', headers)
@@ -63,7 +64,8 @@ def get_assign(secret_access_key, method, headers = {}, resource="/", result = [
                 canonicalized_oss_headers += k + ":" + tmp_headers[k] + "\n"
     
     string_to_sign = method + "\n" + content_md5 + "\n" + content_type + "\n" + date + "\n" + canonicalized_oss_headers + canonicalized_resource;
-    result.append(string_to_sign)
+    if result is not None:
+        result.append(string_to_sign)
     if DEBUG:
         print "string_to_sign", string_to_sign, "string_to_sign_size", len(string_to_sign)
     
@@ -5,6 +5,9 @@ import os
 import dateutil.parser
 import hashlib
 import StringIO
+import httplib
+import socket
+import traceback
 
 # extended modules
 import oss.oss_api
@@ -12,19 +15,28 @@ import oss.oss_xml_handler
 
 import filesystem
 import bakfilesystem
+import scheduler
 import meta.snapshot
 import meta.tag
 
 class OSSErrorCode:
     REQUEST_OK     = 200
+    NOT_MODIFIED   = 304
     NO_SUCH_BUCKET = 404
     INVALID_BUCKET = 400
+    NO_SUCH_KEY    = 404
+    CONFLICT       = 409
+    PRECONDITION_FAILED = 412
 
 class OSSFS(bakfilesystem.BackupFileSystem):
     ID = "oss"
     SERVICE_URL = "oss.aliyuncs.com"
     SEPERATOR   = "/"
     TRIALS      = 3
+    # keys per listing page, at most 1000
+    MAX_KEYS    = 1000
+    # versions of the head object kept
+    HEAD_VERSIONS = 4
     
     # constructor
     def __init__(self, configure, decorator, DEBUG=False):
@@ -52,7 +64,13 @@ class OSSFS(bakfilesystem.BackupFileSystem):
             # bucket not specified
             sys.exit(-2)
 
-        msg = self.oss.get_bucket_acl(OSSFS.BUCKET)
+        try:
+            msg = self.oss.get_bucket_acl(OSSFS.BUCKET)
+        except (socket.error, httplib.HTTPException) as e:
+            # the bucket is checked when reachable again, writes are
+            # queued meanwhile
+            print "Cannot reach oss storage (%s), work offline." % e
+            return
         # bucket exists? if not create it
         if not msg.status == OSSErrorCode.REQUEST_OK:
             if OSSFS.DEBUG:
@@ -78,26 +96,36 @@ class OSSFS(bakfilesystem.BackupFileSystem):
 
     def list_snapshots(self):
         """Get all named snapshots"""
-        # the result id time mapping
-        ss_list = []
-        res = self.oss.get_bucket(OSSFS.BUCKET, self.ss_folder)
-        if (res.status / 100) == 2:
-            body = res.read()
-            (ss_meta, ignore) = oss.oss_xml_handler.GetBucketXml(body).list()
+        return self.list_snapshot_etags().keys()
 
+    def list_snapshot_etags(self):
+        etags = {}
+        for (key, etag) in self._list_keys(self.ss_folder):
             # extract snapshot id
-            for sse in ss_meta:
-                if not sse[0] == self.ss_folder:
-                    ss_list.append(sse[0][len(self.ss_folder):])
+            if not key == self.ss_folder:
+                etags[key[len(self.ss_folder):]] = etag
 
-            return ss_list
+        return etags
+
+    def list_snapshots_since(self, marker):
+        journal = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER
+        ss_list = []
+        # keys are listed in order, starting after the given one
+        for (key, etag) in self._list_keys(journal, \
+                journal + self._journal_start(marker)):
+            key = key[len(journal):]
+            ss_list.append(self._journal_id(key))
+            marker = max(marker, key)
+
+        return (ss_list, marker)
 
     def get_snapshot(self, ss_id):
         """Get snapshot content."""
         obj_id = self._join(self.ss_folder, ss_id)
         if OSSFS.DEBUG:
             print "[DEBUG] Get snapshot:", obj_id
-        res = self.oss.get_object(OSSFS.BUCKET, obj_id)
+        res = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+            self._get_object, obj_id)
         if res.status == OSSErrorCode.REQUEST_OK:
             data = self.decorator.undecorate(res.read())
             return meta.snapshot.SnapShot(data)
@@ -131,11 +159,13 @@ class OSSFS(bakfilesystem.BackupFileSystem):
         # decorate data after object id done
         data = self.decorator.decorate(data)
         # a snapshot cannot be empty, put data directly
-        msg = self.oss.put_object_from_string(OSSFS.BUCKET, obj_id, \
-            data, content_type = 'application/octet-stream')
+        msg = self._transfer(scheduler.TransferScheduler.LANE_META, \
+            len(data), self.oss.put_object_from_string, OSSFS.BUCKET, \
+            obj_id, data, content_type = 'application/octet-stream')
         # return md5 checksum if put successfully
         if not msg.status == OSSErrorCode.REQUEST_OK:
            raise IOError(obj_id)
+        self._append_journal(ss_id)
 
         return ss_id
 
@@ -199,19 +229,21 @@ class OSSFS(bakfilesystem.BackupFileSystem):
         if OSSFS.DEBUG:
             print "[DEBUG] Get object:", obj_id, "to", path
 
+        self._save_chunks(self.open_read(obj_id), path)
+
+    def open_read(self, obj_id):
         if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            # empty file, touch and truncate it
-            file(path, 'w')
-        else:
-            tmp_path = self.configure["SYS_DIR"] + "/tmp/" + obj_id
-            msg = self.oss.get_object_to_file(OSSFS.BUCKET, obj_id, \
-                tmp_path)
-            if not msg.status == OSSErrorCode.REQUEST_OK:
-                raise IOError(obj_id)
-            else:
-                self.decorator.undecorate_file(tmp_path, path)
-                # remove temporary file
-                os.unlink(tmp_path)
+            return
+
+        # only the request is scheduled, the content is read as the
+        # consumer takes it
+        msg = self._transfer(scheduler.TransferScheduler.LANE_SMALL, 0, \
+            self.oss.get_object, OSSFS.BUCKET, obj_id)
+        if not msg.status == OSSErrorCode.REQUEST_OK:
+            raise IOError(obj_id)
+        chunks = self._transfer_chunks(self._read_chunks(msg))
+        for data in self.decorator.undecorate_stream(chunks):
+            yield data
         
     # store data
     def store_from_file(self, path, id=""):
@@ -219,23 +251,22 @@ class OSSFS(bakfilesystem.BackupFileSystem):
         obj_id = \
             bakfilesystem.BackupFileSystem.store_from_file(self, path, id)
 
-        tmp_path = self.configure["SYS_DIR"] + "/tmp/" + obj_id
-        self.decorator.decorate_file(path, tmp_path)
-
         if OSSFS.DEBUG:
             print "[DEBUG] Store file:", path, "as", obj_id
 
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
-            # file not empty
-            msg = self.oss.put_object_from_file(OSSFS.BUCKET, obj_id, \
-                tmp_path, content_type = 'application/octet-stream')
+            # file not empty, decorated data is sent chunked as it is
+            # produced, thus the file is read once and nothing written;
+            # the size sent is unknown ahead, the file size stands for it
+            fsize = os.path.getsize(path)
+            msg = self._transfer(self._file_lane(fsize), fsize, \
+                self.oss.put_object_from_chunks, OSSFS.BUCKET, obj_id, \
+                lambda: self.decorator.decorate_stream(path), \
+                content_type = 'application/octet-stream')
             # return md5 checksum if put successfully
             if not msg.status == OSSErrorCode.REQUEST_OK:
                 raise IOError(obj_id)
 
-        # remove temporary file
-        os.unlink(tmp_path)
-
         return obj_id
 
     def store(self, data, id=""):
@@ -246,8 +277,9 @@ class OSSFS(bakfilesystem.BackupFileSystem):
         if not obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
             # file not empty
             data = self.decorator.decorate(data)
-            msg  = self.oss.put_object_with_data(OSSFS.BUCKET, obj_id, \
-                data, content_type = 'application/octet-stream')
+            msg  = self._transfer(scheduler.TransferScheduler.LANE_META, \
+                len(data), self.oss.put_object_with_data, OSSFS.BUCKET, \
+                obj_id, data, content_type = 'application/octet-stream')
             # return md5 checksum if put successfully
             if not msg.status == OSSErrorCode.REQUEST_OK:
                 raise IOError(obj_id)
@@ -262,7 +294,8 @@ class OSSFS(bakfilesystem.BackupFileSystem):
             # empty object
             data = ""
         else:
-            msg = self.oss.get_object(OSSFS.BUCKET, obj_id)
+            msg = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self._get_object, obj_id)
             if msg.status == OSSErrorCode.REQUEST_OK:
                 data = msg.read()
                 data = self.decorator.undecorate(data)
@@ -276,6 +309,164 @@ class OSSFS(bakfilesystem.BackupFileSystem):
             print "[DEBUG] Remove object:", obj_id
         msg = self.oss.delete_object(OSSFS.BUCKET, obj_id)
 
+    # PutObject ignores If-Match, thus each version of the head object is
+    # a key of its own, written with overwrite forbidden. A version taken
+    # by a concurrent writer fails the write. The version key is the etag.
+
+    def get_head(self, etag=None):
+        for trial in range(OSSFS.TRIALS):
+            key = self._head_version()
+            if key is None:
+                raise IOError("Head")
+            if key == etag:
+                return (None, etag)
+
+            res = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self._get_object, key)
+            if res.status == OSSErrorCode.REQUEST_OK:
+                return (self._parse_head(res.read()), key)
+            elif not res.status == OSSErrorCode.NO_SUCH_KEY:
+                break
+            # pruned by a writer meanwhile
+
+        raise IOError("Head")
+
+    def put_head(self, heads, etag):
+        prefix  = bakfilesystem.BackupFileSystem.HEAD_OBJECT + OSSFS.SEPERATOR
+        version = 0
+        if etag:
+            version = int(etag[len(prefix):]) + 1
+        key  = prefix + "%020d" % version
+        data = self._head_data(heads)
+        msg  = self._transfer(scheduler.TransferScheduler.LANE_META, \
+            len(data), self.oss.put_object_from_string, OSSFS.BUCKET, key, \
+            data, content_type = 'text/plain', \
+            headers = {"x-oss-forbid-overwrite": "true"})
+        if msg.status == OSSErrorCode.CONFLICT:
+            return None
+        elif not msg.status == OSSErrorCode.REQUEST_OK:
+            raise IOError("Head")
+
+        if not self._head_version() == key:
+            # the etag was older than the versions pruned, a later version
+            # exists already
+            self._delete_head(key)
+            return None
+
+        if version >= OSSFS.HEAD_VERSIONS:
+            self._delete_head(prefix + "%020d" % \
+                (version - OSSFS.HEAD_VERSIONS))
+
+        return key
+
+    # latest version key of the head object, None if there is none
+    def _head_version(self):
+        prefix = bakfilesystem.BackupFileSystem.HEAD_OBJECT + OSSFS.SEPERATOR
+        keys   = [key for (key, etag) in self._list_keys(prefix)]
+        if not len(keys):
+            return None
+
+        return max(keys)
+
+    def _delete_head(self, key):
+        # an old version left behind is only listed, never read
+        try:
+            self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.oss.delete_object, OSSFS.BUCKET, key)
+        except Exception:
+            traceback.print_exc()
+
+    def list_raw(self, kind):
+        prefix = self._raw_key(kind, "")
+        # objects lie at top level, folders are not descended
+        return [key[len(prefix):] for (key, etag) in \
+            self._list_keys(prefix, delimiter=OSSFS.SEPERATOR) \
+            if len(key) > len(prefix) and \
+                not key == bakfilesystem.BackupFileSystem.HEAD_OBJECT]
+
+    def get_raw(self, kind, name, path):
+        key = self._raw_key(kind, name)
+        if OSSFS.DEBUG:
+            print "[DEBUG] Get raw:", key
+        msg = self._transfer(scheduler.TransferScheduler.LANE_SMALL, 0, \
+            self.oss.get_object_to_file, OSSFS.BUCKET, key, path)
+        if not msg.status == OSSErrorCode.REQUEST_OK:
+            raise IOError(key)
+
+    def put_raw(self, kind, name, path):
+        key = self._raw_key(kind, name)
+        if OSSFS.DEBUG:
+            print "[DEBUG] Put raw:", key
+        fsize = os.path.getsize(path)
+        if kind == bakfilesystem.BackupFileSystem.RAW_OBJECT:
+            lane = self._file_lane(fsize)
+        else:
+            lane = scheduler.TransferScheduler.LANE_META
+        msg = self._transfer(lane, fsize, self.oss.put_object_from_file, \
+            OSSFS.BUCKET, key, path, \
+            content_type = 'application/octet-stream')
+        if not msg.status == OSSErrorCode.REQUEST_OK:
+            raise IOError(key)
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            self._append_journal(name)
+
+    # record the append of a snapshot in journal
+    def _append_journal(self, ss_id):
+        key = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER + \
+            self._journal_key(ss_id)
+        msg = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+            self.oss.put_object_from_string, OSSFS.BUCKET, key, "")
+        if not msg.status == OSSErrorCode.REQUEST_OK:
+           raise IOError(key)
+
+    def _journal_keys(self):
+        journal = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER
+        return [key[len(journal):] for (key, etag) in self._list_keys(journal)]
+
+    def _remove_journal(self, key):
+        key = bakfilesystem.BackupFileSystem.JOURNAL_FOLDER + key
+        msg = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+            self.oss.delete_object, OSSFS.BUCKET, key)
+        if not (msg.status / 100) == 2 and \
+                not msg.status == OSSErrorCode.NO_SUCH_KEY:
+            raise IOError(key)
+
+    def _raw_key(self, kind, name):
+        if kind == bakfilesystem.BackupFileSystem.RAW_SNAPSHOT:
+            return self._join(self.ss_folder, name)
+        elif kind == bakfilesystem.BackupFileSystem.RAW_TAG:
+            return self._join(self.tag_folder, name)
+        else:
+            return name
+
+    # list (key, etag) of all objects with given prefix after marker
+    # results come in pages of at most MAX_KEYS
+    def _list_keys(self, prefix, marker="", delimiter=""):
+        keys = []
+        while True:
+            res = self._transfer(scheduler.TransferScheduler.LANE_META, 0, \
+                self.oss.get_bucket, OSSFS.BUCKET, prefix, marker, \
+                delimiter, maxkeys=str(OSSFS.MAX_KEYS), headers={})
+            if not (res.status / 100) == 2:
+                raise IOError("List: " + prefix)
+            page = oss.oss_xml_handler.GetBucketXml(res.read())
+            (contents, ignore) = page.list()
+            keys.extend([(c[0], c[2]) for c in contents])
+
+            if not page.is_truncated == "true" or not len(contents):
+                break
+            marker = page.nextmarker or contents[-1][0]
+
+        return keys
+
+    # get object with its body read within the transfer
+    def _get_object(self, obj_id, headers=None):
+        res = self.oss.get_object(OSSFS.BUCKET, obj_id, headers or {})
+        body = res.read()
+        res.read = lambda: body
+
+        return res
+
     def _join(self, base, rel):
         if not base[-1] == OSSFS.SEPERATOR:
             base = base + OSSFS.SEPERATOR
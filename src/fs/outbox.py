@@ -0,0 +1,408 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module queues writes to a cloud while it cannot be reached.
+#
+# Writes pass through to the cloud as long as it answers. Once a write
+# raises CouldNotConnectServerException, it and all writes after it are
+# appended to an outbound queue kept under SYS_DIR, content included, so
+# local commits go on and survive a restart. Writes to the same key are
+# coalesced as they are queued: an object queued already is not queued
+# again, a snapshot removed before being sent is dropped, and successive
+# head updates are merged into one.
+#
+# A worker probes the cloud, waiting from OUTBOX_PROBE_INTERVAL seconds
+# doubled after each failure up to OUTBOX_MAX_BACKOFF, and drains the
+# queue in order by batches of OUTBOX_BATCH writes once it answers.
+# Writes go to the cloud directly again when the queue is empty. Reads of
+# keys still queued are served from the queue.
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+import bakfilesystem
+import couldnotconnectserverexception
+import filesystem
+import meta.snapshot
+
+BackupFileSystem = bakfilesystem.BackupFileSystem
+CouldNotConnectServerException = \
+    couldnotconnectserverexception.CouldNotConnectServerException
+
+class Record:
+    """A write waiting in the queue."""
+    def __init__(self, kind, key, extra=""):
+        self.kind  = kind
+        self.key   = key
+        # arguments not held by the key, see OutboxFS.HEAD
+        self.extra = extra
+
+class OutboxFS(bakfilesystem.BackupFileSystem):
+    """Write to a cloud, queue writes while it is unreachable."""
+    ID = "outbox"
+    # kinds of writes queued
+    FILE     = "file"               # file object, content queued
+    DIR      = "dir"                # directory object, content queued
+    SNAPSHOT = "snapshot"           # snapshot, content queued
+    HEAD     = "head"               # head update, extra is parents, removed
+    UNSNAP   = "unsnap"             # snapshot removal
+    RECORD_DELIM = ' '
+    LIST_DELIM   = ','
+    # default tunables, overridden by global configuration
+    PROBE_INTERVAL = 5              # seconds before first probe
+    MAX_BACKOFF    = 300            # seconds between probes at most
+    BATCH          = 64             # writes sent between queue saves
+    BACKOFF        = 2.0
+    JITTER         = 0.1
+
+    def __init__(self, target, configure, DEBUG=False):
+        """Params:
+    target: BackupFileSystem written to;
+    configure: system-wise configuration."""
+        bakfilesystem.BackupFileSystem.__init__(self, DEBUG)
+
+        OutboxFS.DEBUG = DEBUG
+        self.target    = target
+        self.scheduler = target.scheduler
+        self.interval  = float(configure.get("OUTBOX_PROBE_INTERVAL", \
+            OutboxFS.PROBE_INTERVAL))
+        self.max_backoff = float(configure.get("OUTBOX_MAX_BACKOFF", \
+            OutboxFS.MAX_BACKOFF))
+        self.batch     = int(configure.get("OUTBOX_BATCH", OutboxFS.BATCH))
+        # queued content and the queue itself
+        self.path      = os.path.join(configure["SYS_DIR"], "outbox")
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+
+        self.lock   = threading.Condition()
+        # records in order of writes
+        self.queue  = []
+        # records being sent, not coalesced any more
+        self.sending = []
+
+        self._load()
+        worker = threading.Thread(target=self._drain)
+        worker.daemon = True
+        worker.start()
+
+    # writes go to the target, or to the queue
+
+    def store_from_file(self, path, id=""):
+        obj_id = BackupFileSystem.store_from_file(self, path, id)
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return obj_id
+
+        return self._write(Record(OutboxFS.FILE, obj_id), obj_id, \
+            lambda dst: self._copy(path, obj_id, dst), \
+            "store_from_file", path, obj_id)
+
+    def store(self, data, id=""):
+        obj_id = BackupFileSystem.store(self, data, id)
+        return self._write(Record(OutboxFS.DIR, obj_id), obj_id, \
+            lambda dst: self._save_data(str(data), dst), \
+            "store", data, obj_id)
+
+    def append_snapshot(self, ss, ss_id=""):
+        if not len(ss_id):
+            ss_id = BackupFileSystem.store(self, str(ss))
+        return self._write(Record(OutboxFS.SNAPSHOT, ss_id), ss_id, \
+            lambda dst: self._save_data(str(ss), dst), \
+            "append_snapshot", ss, ss_id)
+
+    def advance_head(self, ss_id, parents, removed=None):
+        extra = OutboxFS.LIST_DELIM.join([p for p in parents if p]) + \
+            OutboxFS.RECORD_DELIM + (removed or "")
+        return self._write(Record(OutboxFS.HEAD, ss_id, extra), None, \
+            None, "advance_head", ss_id, parents, removed)
+
+    def remove_snapshot(self, ss_id):
+        return self._write(Record(OutboxFS.UNSNAP, ss_id), None, None, \
+            "remove_snapshot", ss_id)
+
+    # reads of queued keys are served locally, others by the target
+
+    def retrieve(self, obj_id):
+        path = self._queued(OutboxFS.FILE, obj_id) or \
+            self._queued(OutboxFS.DIR, obj_id)
+        if not path:
+            return self.target.retrieve(obj_id)
+
+        return self._read(path)
+
+    def retrieve_to_file(self, obj_id, path):
+        src = self._queued(OutboxFS.FILE, obj_id) or \
+            self._queued(OutboxFS.DIR, obj_id)
+        if not src:
+            return self.target.retrieve_to_file(obj_id, path)
+
+        shutil.copyfile(src, path)
+
+    def open_read(self, obj_id):
+        path = self._queued(OutboxFS.FILE, obj_id) or \
+            self._queued(OutboxFS.DIR, obj_id)
+        if not path:
+            return self.target.open_read(obj_id)
+
+        return self._read_chunks(open(path, 'rb'))
+
+    def get_snapshot(self, ss_id):
+        path = self._queued(OutboxFS.SNAPSHOT, ss_id)
+        if not path:
+            return self.target.get_snapshot(ss_id)
+
+        return meta.snapshot.SnapShot(self._read(path))
+
+    def list_snapshots(self):
+        return self.target.list_snapshots()
+
+    def get_snapshot_timestamp(self, ss_id):
+        return self.target.get_snapshot_timestamp(ss_id)
+
+    def list_objects(self):
+        return self.target.list_objects()
+
+    def get_head(self, etag=None):
+        return self.target.get_head(etag)
+
+    def get_empty_data_md5(self):
+        return self.target.get_empty_data_md5()
+
+    def probe(self):
+        return self.target.probe()
+
+    def pending(self):
+        """Number of writes waiting to be sent."""
+        self.lock.acquire()
+        count = len(self.queue)
+        self.lock.release()
+
+        return count
+
+    # send a write to the target, queue it if the target is unreachable
+    # or writes are queued already, save(path) keeps content of a write
+    def _write(self, record, result, save, method, *args):
+        if not self.pending():
+            try:
+                return getattr(self.target, method)(*args)
+            except CouldNotConnectServerException as e:
+                print "Cloud unreachable (%s), queue writes." % e.reason
+
+        if save:
+            if self._queued(record.kind, record.key):
+                # content addressed, queued already
+                return result
+            (fd, tmp_path) = tempfile.mkstemp(dir=self.path)
+            os.close(fd)
+            if not save(tmp_path):
+                # content changed since hashed, nothing to send
+                os.unlink(tmp_path)
+                return result
+            os.rename(tmp_path, self._payload(record))
+
+        self.lock.acquire()
+        merged = self._coalesce(record)
+        if not merged:
+            self.queue.append(record)
+        self._save()
+        self.lock.notify()
+        self.lock.release()
+        if OutboxFS.DEBUG:
+            print "[DEBUG]", merged and "Coalesced:" or "Queued:", \
+                record.kind, record.key
+
+        return result
+
+    # merge a write into those queued and not being sent, True if nothing
+    # is left to queue, called with lock held
+    def _coalesce(self, record):
+        queued = [r for r in self.queue if not r in self.sending]
+        if record.kind in [OutboxFS.FILE, OutboxFS.DIR, OutboxFS.SNAPSHOT]:
+            return len([r for r in self.queue if r.key == record.key \
+                        and r.kind == record.kind]) > 0
+
+        if record.kind == OutboxFS.UNSNAP:
+            appended = [r for r in queued if r.key == record.key \
+                        and r.kind == OutboxFS.SNAPSHOT]
+            for r in appended:
+                # never sent, nothing to remove
+                self.queue.remove(r)
+                os.unlink(self._payload(r))
+            return len(appended) > 0
+
+        # a head update replacing the head queued last is merged into it
+        (parents, removed) = self._head_args(record)
+        for r in reversed(queued):
+            if not r.kind == OutboxFS.HEAD:
+                continue
+            if r.key in parents or r.key == removed:
+                (old_parents, old_removed) = self._head_args(r)
+                merged = [p for p in old_parents + [old_removed] + parents \
+                          if p and not p == r.key]
+                record.extra = OutboxFS.LIST_DELIM.join( \
+                    sorted(set(merged))) + OutboxFS.RECORD_DELIM + \
+                    (removed or "")
+                self.queue.remove(r)
+            break
+
+        return False
+
+    def _head_args(self, record):
+        (parents, removed) = record.extra.split(OutboxFS.RECORD_DELIM, 1)
+        return ([p for p in parents.split(OutboxFS.LIST_DELIM) if len(p)], \
+            removed or None)
+
+    # probe the target with backoff, drain the queue once it answers
+    def _drain(self):
+        backoff = self.interval
+        while True:
+            self.lock.acquire()
+            while not len(self.queue):
+                backoff = self.interval
+                self.lock.wait()
+            self.lock.release()
+
+            time.sleep(backoff * (1 + random.uniform(-OutboxFS.JITTER, \
+                OutboxFS.JITTER)))
+            try:
+                self.target.probe()
+                while self._send_batch():
+                    pass
+            except CouldNotConnectServerException:
+                backoff = min(backoff * OutboxFS.BACKOFF, self.max_backoff)
+                if OutboxFS.DEBUG:
+                    print "[DEBUG] Cloud still unreachable, retry in", \
+                        backoff, "seconds"
+            except Exception:
+                # kept queued, retried later
+                traceback.print_exc()
+                backoff = min(backoff * OutboxFS.BACKOFF, self.max_backoff)
+
+    # send the oldest writes queued, False if none
+    def _send_batch(self):
+        self.lock.acquire()
+        batch = self.queue[:self.batch]
+        self.sending = list(batch)
+        self.lock.release()
+        if not len(batch):
+            return False
+
+        if OutboxFS.DEBUG:
+            print "[DEBUG] Send", len(batch), "queued writes"
+        sent = []
+        try:
+            for record in batch:
+                self._send(record)
+                sent.append(record)
+        finally:
+            self.lock.acquire()
+            for record in sent:
+                self.queue.remove(record)
+            self.sending = []
+            self._save()
+            self.lock.release()
+            for record in sent:
+                if record.kind in [OutboxFS.FILE, OutboxFS.DIR, \
+                                   OutboxFS.SNAPSHOT]:
+                    os.unlink(self._payload(record))
+
+        return True
+
+    def _send(self, record):
+        path = self._payload(record)
+        if record.kind == OutboxFS.FILE:
+            self.target.store_from_file(path, record.key)
+        elif record.kind == OutboxFS.DIR:
+            self.target.store(self._read(path), record.key)
+        elif record.kind == OutboxFS.SNAPSHOT:
+            self.target.append_snapshot(self._read(path), record.key)
+        elif record.kind == OutboxFS.HEAD:
+            (parents, removed) = self._head_args(record)
+            self.target.advance_head(record.key, parents, removed)
+        else:
+            self.target.remove_snapshot(record.key)
+
+    # path of queued content of a key, None if not queued
+    def _queued(self, kind, key):
+        self.lock.acquire()
+        queued = len([r for r in self.queue \
+                      if r.kind == kind and r.key == key]) > 0
+        self.lock.release()
+        if not queued:
+            return None
+
+        return self._payload(Record(kind, key))
+
+    def _payload(self, record):
+        return os.path.join(self.path, record.kind + "-" + record.key)
+
+    def _read(self, path):
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+
+        return data
+
+    def _save_data(self, data, dst):
+        f = open(dst, "wb")
+        f.write(data)
+        f.close()
+
+        return True
+
+    # copy a file, False if its content is not the object any more
+    def _copy(self, path, obj_id, dst):
+        md5 = hashlib.md5()
+        src = open(path, "rb")
+        f = open(dst, "wb")
+        cont = src.read(filesystem.FileSystem.BUFFER_SIZE)
+        while len(cont):
+            md5.update(cont)
+            f.write(cont)
+            cont = src.read(filesystem.FileSystem.BUFFER_SIZE)
+        f.close()
+        src.close()
+
+        return md5.hexdigest() == obj_id
+
+    def _load(self):
+        try:
+            f = open(os.path.join(self.path, "queue"))
+        except IOError:
+            return
+        for line in f:
+            (kind, key, extra) = line.rstrip(os.linesep).split( \
+                OutboxFS.RECORD_DELIM, 2)
+            self.queue.append(Record(kind, key, extra))
+        f.close()
+        if len(self.queue):
+            print len(self.queue), "writes queued while offline, send them."
+
+    def _save(self):
+        path = os.path.join(self.path, "queue")
+        f = open(path + ".tmp", "w")
+        for record in self.queue:
+            f.write(OutboxFS.RECORD_DELIM.join([record.kind, record.key, \
+                record.extra]) + os.linesep)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(path + ".tmp", path)
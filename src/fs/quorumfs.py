@@ -0,0 +1,362 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module commits to several clouds at once with a W-of-N quorum.
+#
+# Every write is sent to all clouds, each cloud has its own worker thread
+# performing its writes in order of submission. A write returns as soon
+# as COMMIT_QUORUM clouds acknowledged it, the others complete it in
+# background, so commit latency follows the fastest clouds. A file is
+# copied first then, the clouds left behind read the copy rather than a
+# path the caller may release or change once the write returned.
+#
+# A write failed on a cloud is recorded in a repair log kept under
+# SYS_DIR and retried by copying the key as stored from a cloud holding
+# it. A cloud with repairs pending may lack objects of snapshots written
+# after the failure, thus it does not count in the quorum of snapshots
+# until repaired. Reads are served by the first cloud.
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import traceback
+
+import bakfilesystem
+import couldnotconnectserverexception
+
+BackupFileSystem = bakfilesystem.BackupFileSystem
+CouldNotConnectServerException = \
+    couldnotconnectserverexception.CouldNotConnectServerException
+
+class Write:
+    """A write sent to all clouds, waited on until quorum."""
+    def __init__(self, kind, key, extra=""):
+        self.kind   = kind
+        self.key    = key
+        # repair arguments not held by the key, see QuorumFS.RAW_HEAD
+        self.extra  = extra
+        self.cond   = threading.Condition()
+        # indexes of clouds acknowledged and counted in the quorum
+        self.acks   = []
+        self.failed = 0
+        # failures of clouds not reached
+        self.unreachable = 0
+        self.result = None
+        # clouds still performing it
+        self.left   = 0
+        # copy of the content owned by the write, removed once all clouds
+        # performed it
+        self.tmp_path = None
+
+class QuorumFS(bakfilesystem.BackupFileSystem):
+    """Write to all clouds, return once a quorum acknowledged."""
+    ID = "quorum"
+    # kind of repair advancing head snapshots, not a raw key
+    RAW_HEAD     = "head"
+    RECORD_DELIM = ' '
+    LIST_DELIM   = ','
+    # default seconds between repair rounds
+    REPAIR_INTERVAL = 60
+
+    def __init__(self, clouds, names, configure, DEBUG=False):
+        """Params:
+    clouds: BackupFileSystem objects written, the first one serves reads;
+    names: names of the clouds in CLOUDS, keys of the repair log;
+    configure: system-wise configuration."""
+        bakfilesystem.BackupFileSystem.__init__(self, DEBUG)
+
+        QuorumFS.DEBUG = DEBUG
+        self.clouds  = clouds
+        self.names   = names
+        # transfers are still throttled by the shared scheduler
+        self.scheduler = clouds[0].scheduler
+        self.quorum  = max(1, min(len(clouds), \
+            int(configure.get("COMMIT_QUORUM", len(clouds)))))
+        self.interval = float(configure.get("QUORUM_REPAIR_INTERVAL", \
+            QuorumFS.REPAIR_INTERVAL))
+        self.path    = os.path.join(configure["SYS_DIR"], "quorum-repair")
+        self.tmpdir  = configure["SYS_TMP"]
+
+        self.lock    = threading.Condition()
+        # [cloud index, kind, key, extra] in order of failure
+        self.repairs = []
+        self.jobs    = [Queue.Queue() for cloud in clouds]
+
+        self._load()
+        for index in range(len(clouds)):
+            worker = threading.Thread(target=self._work, args=(index,))
+            worker.daemon = True
+            worker.start()
+        worker = threading.Thread(target=self._repair)
+        worker.daemon = True
+        worker.start()
+
+    # writes go to all clouds
+
+    def store_from_file(self, path, id=""):
+        write = Write(BackupFileSystem.RAW_OBJECT, id)
+        if self.quorum < len(self.clouds):
+            # clouds outside the quorum read after the caller got the
+            # result and may have released or changed path, all clouds
+            # read a copy instead
+            (fd, write.tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+            os.close(fd)
+            try:
+                shutil.copyfile(path, write.tmp_path)
+            except:
+                os.unlink(write.tmp_path)
+                raise
+            path = write.tmp_path
+
+        # hashed once for all clouds
+        try:
+            write.key = BackupFileSystem.store_from_file(self, path, id)
+        except:
+            if write.tmp_path:
+                os.unlink(write.tmp_path)
+            raise
+        return self._write(write, "store_from_file", path, write.key)
+
+    def store(self, data, id=""):
+        obj_id = BackupFileSystem.store(self, data, id)
+        return self._write(Write(BackupFileSystem.RAW_OBJECT, obj_id), \
+            "store", data, obj_id)
+
+    def append_snapshot(self, ss, ss_id=""):
+        if not len(ss_id):
+            ss_id = BackupFileSystem.store(self, str(ss))
+        return self._write(Write(BackupFileSystem.RAW_SNAPSHOT, ss_id), \
+            "append_snapshot", ss, ss_id)
+
+    def advance_head(self, ss_id, parents, removed=None):
+        extra = QuorumFS.LIST_DELIM.join([p for p in parents if p]) + \
+            QuorumFS.RECORD_DELIM + (removed or "")
+        return self._write(Write(QuorumFS.RAW_HEAD, ss_id, extra), \
+            "advance_head", ss_id, parents, removed)
+
+    def remove_snapshot(self, ss_id):
+        # a snapshot left behind is pruned by the next fsck
+        for queue in self.jobs:
+            queue.put((None, "remove_snapshot", (ss_id,)))
+
+    def prune_journal(self, removed=[]):
+        # queued after the removals, an entry is not pruned before its
+        # snapshot is gone
+        for queue in self.jobs:
+            queue.put((None, "prune_journal", (removed,)))
+
+    # reads are served by the first cloud
+
+    def list_snapshots(self):
+        return self.clouds[0].list_snapshots()
+
+    def get_snapshot(self, ss_id):
+        return self.clouds[0].get_snapshot(ss_id)
+
+    def get_snapshot_timestamp(self, ss_id):
+        return self.clouds[0].get_snapshot_timestamp(ss_id)
+
+    def list_snapshot_etags(self):
+        return self.clouds[0].list_snapshot_etags()
+
+    def list_snapshots_since(self, marker):
+        return self.clouds[0].list_snapshots_since(marker)
+
+    def journal_marker(self):
+        return self.clouds[0].journal_marker()
+
+    def list_objects(self):
+        return self.clouds[0].list_objects()
+
+    def retrieve_to_file(self, obj_id, path):
+        return self.clouds[0].retrieve_to_file(obj_id, path)
+
+    def retrieve(self, obj_id):
+        return self.clouds[0].retrieve(obj_id)
+
+    def open_read(self, obj_id):
+        return self.clouds[0].open_read(obj_id)
+
+    def get_head(self, etag=None):
+        return self.clouds[0].get_head(etag)
+
+    def get_empty_data_md5(self):
+        return self.clouds[0].get_empty_data_md5()
+
+    # send a write to all clouds and wait for the quorum
+    def _write(self, write, method, *args):
+        write.left = len(self.clouds)
+        for queue in self.jobs:
+            queue.put((write, method, args))
+
+        write.cond.acquire()
+        try:
+            while len(write.acks) < self.quorum and \
+                    len(self.clouds) - write.failed >= self.quorum:
+                write.cond.wait()
+            if len(write.acks) < self.quorum and write.unreachable:
+                # completed by the repair log, queued meanwhile
+                raise CouldNotConnectServerException( \
+                    "Quorum not reached: %s %s" % (write.kind, write.key))
+            if len(write.acks) < self.quorum:
+                raise IOError("Quorum not reached: %s %s" % \
+                    (write.kind, write.key))
+            return write.result
+        finally:
+            write.cond.release()
+
+    def _work(self, index):
+        while True:
+            (write, method, args) = self.jobs[index].get()
+            try:
+                self._perform(index, write, method, args)
+            finally:
+                if write:
+                    self._done(write)
+
+    def _perform(self, index, write, method, args):
+        try:
+            result = getattr(self.clouds[index], method)(*args)
+        except Exception as e:
+            traceback.print_exc()
+            if write:
+                self._failed(index, write, e)
+            return
+        if not write:
+            return
+
+        # snapshots count on clouds holding all earlier objects
+        counted = not write.kind == BackupFileSystem.RAW_SNAPSHOT or \
+            not self._dirty(index)
+        write.cond.acquire()
+        if counted:
+            write.acks.append(index)
+            if write.result is None:
+                write.result = result
+        else:
+            write.failed = write.failed + 1
+        write.cond.notify_all()
+        write.cond.release()
+
+    # a cloud finished a write, successfully or not
+    def _done(self, write):
+        write.cond.acquire()
+        write.left = write.left - 1
+        last = not write.left
+        write.cond.release()
+        if last and write.tmp_path:
+            os.unlink(write.tmp_path)
+
+    def _failed(self, index, write, error):
+        if QuorumFS.DEBUG:
+            print "[DEBUG] Write failed on", self.names[index], ":", \
+                write.kind, write.key
+        self.lock.acquire()
+        self.repairs.append([index, write.kind, write.key, write.extra])
+        self._save()
+        self.lock.notify()
+        self.lock.release()
+
+        write.cond.acquire()
+        write.failed = write.failed + 1
+        if isinstance(error, CouldNotConnectServerException):
+            write.unreachable = write.unreachable + 1
+        write.cond.notify_all()
+        write.cond.release()
+
+    def _dirty(self, index):
+        self.lock.acquire()
+        dirty = len([r for r in self.repairs if r[0] == index]) > 0
+        self.lock.release()
+
+        return dirty
+
+    # retry failed writes in order, a cloud stops at its first failure
+    def _repair(self):
+        while True:
+            self.lock.acquire()
+            self.lock.wait(self.interval)
+            todo = list(self.repairs)
+            self.lock.release()
+
+            stuck = set()
+            for repair in todo:
+                if repair[0] in stuck:
+                    continue
+                try:
+                    self._repair_one(*repair)
+                except Exception:
+                    traceback.print_exc()
+                    stuck.add(repair[0])
+                    continue
+
+                self.lock.acquire()
+                self.repairs.remove(repair)
+                self._save()
+                self.lock.release()
+
+    def _repair_one(self, index, kind, key, extra):
+        cloud = self.clouds[index]
+        if QuorumFS.DEBUG:
+            print "[DEBUG] Repair on", self.names[index], ":", kind, key
+        if kind == QuorumFS.RAW_HEAD:
+            (parents, removed) = extra.split(QuorumFS.RECORD_DELIM, 1)
+            cloud.advance_head(key, \
+                [p for p in parents.split(QuorumFS.LIST_DELIM) if len(p)], \
+                removed or None)
+            return
+
+        # copied as stored from any cloud holding it
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+        os.close(fd)
+        try:
+            for source in self.clouds:
+                if source is cloud:
+                    continue
+                try:
+                    source.get_raw(kind, key, tmp_path)
+                except IOError:
+                    continue
+                cloud.put_raw(kind, key, tmp_path)
+                return
+        finally:
+            os.unlink(tmp_path)
+
+        raise IOError("No cloud holds %s %s" % (kind, key))
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        for line in f:
+            (name, kind, key, extra) = line.rstrip(os.linesep).split( \
+                QuorumFS.RECORD_DELIM, 3)
+            if name in self.names:
+                self.repairs.append([self.names.index(name), kind, key, \
+                    extra])
+        f.close()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        f = open(tmp_path, "w")
+        for (index, kind, key, extra) in self.repairs:
+            f.write(QuorumFS.RECORD_DELIM.join([self.names[index], kind, \
+                key, extra]) + os.linesep)
+        f.close()
+        os.rename(tmp_path, self.path)
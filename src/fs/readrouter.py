@@ -0,0 +1,316 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module routes object reads to the fastest of several clouds.
+#
+# Objects are keyed on their content, so any cloud holding an object
+# serves the same data. For each cloud the router keeps moving averages
+# of the latency of object reads and of the throughput of file reads,
+# and sends every read to the cloud expected to finish first. Clouds
+# never read from go first, so every cloud gets measured.
+#
+# Each read records how long it took relative to the expected time. A
+# read running longer than the HEDGE_PERCENTILE of these ratios on its
+# cloud is hedged: the same read is sent to the next best cloud and the
+# first result is taken. A read failing on a cloud is retried on the
+# others. Clouds are ranked by expected time per successful read, thus a
+# cloud often missing objects is asked late, other errors count as slow
+# reads. Streamed reads go to the best cloud, and to the next one if no
+# chunk arrived before an error.
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import bakfilesystem
+import filesystem
+
+class CloudStats:
+    """Moving averages of reads on one cloud."""
+    def __init__(self):
+        self.latency    = None          # seconds of an object read
+        self.throughput = None          # bytes per second of file reads
+        self.misses     = 0.0           # share of reads missing the object
+        # recent ratios of read durations to expected, oldest first
+        self.ratios     = []
+
+class Attempts:
+    """Reads of one object sent to several clouds."""
+    def __init__(self):
+        self.cond    = threading.Condition()
+        self.running = 0
+        # (cloud, value) of the first read done
+        self.result  = None
+        self.error   = None
+
+class ReadRouter(bakfilesystem.BackupFileSystem):
+    """Read objects from the cloud expected to serve them first."""
+    ID = "router"
+    # default tunables, overridden by global configuration
+    ALPHA            = 0.2          # weight of a new sample in averages
+    HEDGE_PERCENTILE = 95           # percentile of durations hedged after
+    # ratios kept per cloud, hedging starts with HEDGE_SAMPLES of them
+    SAMPLES          = 100
+    HEDGE_SAMPLES    = 10
+    # an error other than a missing object slows the cloud down so much
+    ERROR_PENALTY    = 2.0
+    MAX_MISSES       = 0.99
+
+    def __init__(self, clouds, configure, DEBUG=False):
+        """Params:
+    clouds: BackupFileSystem objects holding the same objects, the first
+            one serves calls other than object reads;
+    configure: system-wise configuration."""
+        bakfilesystem.BackupFileSystem.__init__(self, DEBUG)
+
+        ReadRouter.DEBUG = DEBUG
+        self.clouds    = clouds
+        self.scheduler = clouds[0].scheduler
+        self.tmpdir    = configure["SYS_TMP"]
+        self.alpha     = float(configure.get("READ_EWMA_ALPHA", \
+            ReadRouter.ALPHA))
+        self.percentile = float(configure.get("HEDGE_PERCENTILE", \
+            ReadRouter.HEDGE_PERCENTILE))
+
+        self.lock  = threading.Lock()
+        self.stats = [CloudStats() for cloud in clouds]
+        # moving average of sizes of files read
+        self.fsize = None
+
+    def retrieve(self, obj_id):
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return ""
+
+        return self._read(lambda cloud: cloud.retrieve(obj_id), \
+            lambda data: None, 0, None)
+
+    def retrieve_to_file(self, obj_id, path):
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            file(path, 'w').close()
+            return
+
+        # each read writes its own file, the first one done is taken
+        def read(cloud):
+            (fd, tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+            os.close(fd)
+            try:
+                cloud.retrieve_to_file(obj_id, tmp_path)
+            except:
+                os.unlink(tmp_path)
+                raise
+            return tmp_path
+
+        tmp_path = self._read(read, os.unlink, self.fsize or 0, \
+            os.path.getsize)
+        fsize = os.path.getsize(tmp_path)
+        self.lock.acquire()
+        self.fsize = self._average(self.fsize, fsize)
+        self.lock.release()
+        os.rename(tmp_path, path)
+
+    # streamed from the best cloud delivering a first chunk, not hedged,
+    # the chunks already handed out could not be taken back
+    def open_read(self, obj_id):
+        if obj_id == filesystem.FileSystem.EMPTY_FILE_MD5:
+            return
+
+        error = None
+        for index in self._rank(self.fsize or 0):
+            start  = time.time()
+            chunks = iter(self.clouds[index].open_read(obj_id))
+            try:
+                first = chunks.next()
+            except StopIteration:
+                first = ""
+            except Exception as e:
+                # nothing handed out yet, try the next cloud
+                if isinstance(e, IOError):
+                    self._sample(index, time.time() - start, None, None, \
+                        True)
+                else:
+                    traceback.print_exc()
+                    self._penalize(index)
+                error = e
+                continue
+
+            # time to first chunk is the latency of the cloud
+            self._sample(index, time.time() - start, None, None, False)
+            yield first
+            for data in chunks:
+                yield data
+            return
+
+        raise error
+
+    # calls other than object reads go to the first cloud
+
+    def list_snapshots(self):
+        return self.clouds[0].list_snapshots()
+
+    def get_snapshot(self, ss_id):
+        return self.clouds[0].get_snapshot(ss_id)
+
+    def list_objects(self):
+        return self.clouds[0].list_objects()
+
+    def get_empty_data_md5(self):
+        return self.clouds[0].get_empty_data_md5()
+
+    # send read(cloud) to the best cloud, hedge and retry on others
+    # discard(value) drops the results of reads finished too late,
+    # sizeof(value) tells bytes transferred by file reads, None otherwise
+    def _read(self, read, discard, nbytes, sizeof):
+        order = self._rank(nbytes)
+        attempts = Attempts()
+        attempts.cond.acquire()
+        try:
+            index = 0
+            while attempts.result is None:
+                if not attempts.running:
+                    if index == len(order):
+                        # failed on every cloud
+                        raise attempts.error
+                    # first read, or retry after errors
+                    self._start(attempts, order[index], read, discard, \
+                        nbytes, sizeof)
+                    (hedge, index) = (self._hedge_delay(order[index], \
+                        nbytes), index + 1)
+                    continue
+
+                if hedge is None or index == len(order):
+                    attempts.cond.wait()
+                    continue
+                started = time.time()
+                attempts.cond.wait(hedge)
+                if attempts.result is None and attempts.running and \
+                        time.time() - started >= hedge:
+                    if ReadRouter.DEBUG:
+                        print "[DEBUG] Hedge read on", \
+                            self.clouds[order[index]].ID
+                    self._start(attempts, order[index], read, discard, \
+                        nbytes, sizeof)
+                    (hedge, index) = (self._hedge_delay(order[index], \
+                        nbytes), index + 1)
+                else:
+                    hedge = max(hedge - (time.time() - started), 0)
+
+            return attempts.result[1]
+        finally:
+            attempts.cond.release()
+
+    def _start(self, attempts, index, read, discard, nbytes, sizeof):
+        attempts.running = attempts.running + 1
+        worker = threading.Thread(target=self._attempt, \
+            args=(attempts, index, read, discard, nbytes, sizeof))
+        worker.daemon = True
+        worker.start()
+
+    def _attempt(self, attempts, index, read, discard, nbytes, sizeof):
+        cloud = self.clouds[index]
+        expected = self._expected(index, nbytes)
+        start = time.time()
+        try:
+            value = read(cloud)
+        except Exception as e:
+            if isinstance(e, IOError):
+                # object missing, the round trip still tells latency
+                self._sample(index, time.time() - start, None, None, True)
+            else:
+                # unreachable rather than missing the object
+                traceback.print_exc()
+                self._penalize(index)
+            attempts.cond.acquire()
+            attempts.running = attempts.running - 1
+            attempts.error   = e
+            attempts.cond.notify_all()
+            attempts.cond.release()
+            return
+
+        self._sample(index, time.time() - start, expected, \
+            sizeof and sizeof(value), False)
+        attempts.cond.acquire()
+        attempts.running = attempts.running - 1
+        late = attempts.result is not None
+        if not late:
+            attempts.result = (cloud, value)
+        attempts.cond.notify_all()
+        attempts.cond.release()
+        if late:
+            discard(value)
+
+    # cloud indexes, best first, clouds never measured before all
+    def _rank(self, nbytes):
+        self.lock.acquire()
+        costs = [((self._expected(i, nbytes) or 0) / \
+                  (1 - min(self.stats[i].misses, ReadRouter.MAX_MISSES)), i) \
+                 for i in range(len(self.clouds))]
+        self.lock.release()
+
+        return [i for (cost, i) in sorted(costs)]
+
+    # seconds a read is expected to take, None if never measured
+    def _expected(self, index, nbytes):
+        stats = self.stats[index]
+        if stats.latency is None:
+            return None
+        if nbytes and stats.throughput:
+            return stats.latency + nbytes / stats.throughput
+
+        return stats.latency
+
+    # seconds to wait before hedging a read, None not to hedge
+    def _hedge_delay(self, index, nbytes):
+        self.lock.acquire()
+        try:
+            ratios   = sorted(self.stats[index].ratios)
+            expected = self._expected(index, nbytes)
+        finally:
+            self.lock.release()
+        if expected is None or len(ratios) < ReadRouter.HEDGE_SAMPLES:
+            return None
+
+        rank = int(len(ratios) * self.percentile / 100)
+        return expected * ratios[min(rank, len(ratios) - 1)]
+
+    def _sample(self, index, duration, expected, nbytes, missed):
+        self.lock.acquire()
+        stats = self.stats[index]
+        stats.misses = self._average(stats.misses, missed and 1 or 0)
+        if expected:
+            stats.ratios.append(duration / expected)
+            del stats.ratios[:-ReadRouter.SAMPLES]
+        if nbytes is None or stats.latency is None:
+            # object read, or no latency to tell transfer time from
+            stats.latency = self._average(stats.latency, duration)
+        else:
+            # time beyond the latency is spent transferring
+            stats.throughput = self._average(stats.throughput, \
+                nbytes / max(duration - stats.latency, stats.latency))
+        self.lock.release()
+
+    def _penalize(self, index):
+        self.lock.acquire()
+        stats = self.stats[index]
+        stats.latency = (stats.latency or 1.0) * ReadRouter.ERROR_PENALTY
+        self.lock.release()
+
+    def _average(self, average, sample):
+        if average is None:
+            return float(sample)
+
+        return (1 - self.alpha) * average + self.alpha * sample
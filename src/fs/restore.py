@@ -0,0 +1,238 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module applies remote changes to the local file system.
+#
+# Directories are created as soon as they are met, so that every file
+# has its parent when it is written. Files are queued and downloaded by a
+# bounded pool of workers once all directories exist, the transfer
+# scheduler still decides how many downloads actually run at a time.
+#
+# Files sharing an object id are fetched once, the others are copied
+# from the first one locally. A file is skipped if its content already
+# matches, known from the stat cache or, failing that, by checksum when
+# the size agrees. Content is written to a hidden temporary file in the
+# destination directory and renamed into place, thus a file is never
+# seen half written and an interrupted restore leaves the old version.
+# Content is streamed from the cloud and checked against its object id
+# before the rename, a corrupted download leaves the old version too.
+# If the target has a hydrator, placeholders are written instead of
+# content, see eventhandlers/hydrator.py.
+import collections
+import hashlib
+import os
+import random
+import shutil
+import stat
+import threading
+import traceback
+
+import filesystem
+
+class RestoreExecutor:
+    """Restore files of a snapshot onto a local file system."""
+    THREADS    = 8                  # default number of workers
+    TMP_PREFIX = ".rosycloud-"      # prefix of temporary files
+
+    def __init__(self, target, repo_fs, DEBUG=False):
+        """Params:
+    target: HDDFS to write to;
+    repo_fs: BackupFileSystem to download from."""
+        RestoreExecutor.DEBUG = DEBUG
+        self.target  = target
+        self.repo_fs = repo_fs
+        self.threads = int(target.configure.get("RESTORE_THREADS", \
+            RestoreExecutor.THREADS))
+
+        # obj_id -> list of (entry, abspath), in order of queueing
+        self.pending = {}
+        self.order   = collections.deque()
+        self.lock    = threading.Lock()
+        self.errors  = []
+
+        # mode of new files, umask is only read by setting it
+        self.umask   = os.umask(0)
+        os.umask(self.umask)
+
+    def mkdir(self, abspath):
+        """Create a directory now."""
+        if os.path.isdir(abspath):
+            # kept locally while not subscribed
+            return
+        # inotify event of it is not a local change
+        self.target.expect_write(abspath, 0)
+        self.target.mkdir(abspath)
+        self.target.settle_write(abspath)
+
+    def restore(self, entry, abspath):
+        """Queue a file to be restored by run().
+Params:
+    entry: DirEntry of the file;
+    abspath: absolute local path of the file."""
+        if not entry.obj_id in self.pending:
+            self.pending[entry.obj_id] = []
+            self.order.append(entry.obj_id)
+        self.pending[entry.obj_id].append((entry, abspath))
+
+    def start(self, loop, callback, *args):
+        """Restore queued files in background, the calling thread is not
+blocked.
+Params:
+    loop: event loop the callback is posted to;
+    callback: called as callback(error, *args) on the loop once all
+              workers finished, error is the first one raised or None."""
+        def wait():
+            try:
+                self.run()
+                error = None
+            except Exception as e:
+                error = e
+            loop.post(callback, error, *args)
+
+        waiter = threading.Thread(target=wait)
+        waiter.daemon = True
+        waiter.start()
+
+    def run(self):
+        """Restore queued files, raise the first error after all workers
+finished."""
+        workers = []
+        for i in range(min(self.threads, len(self.order))):
+            worker = threading.Thread(target=self._work)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        if len(self.errors):
+            raise self.errors[0]
+
+    def _work(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if not len(self.order) or len(self.errors):
+                    return
+                obj_id = self.order.popleft()
+            finally:
+                self.lock.release()
+
+            try:
+                self._restore_object(obj_id, self.pending.pop(obj_id))
+            except Exception as e:
+                traceback.print_exc()
+                self.lock.acquire()
+                self.errors.append(e)
+                self.lock.release()
+
+    # restore all files holding an object
+    def _restore_object(self, obj_id, files):
+        source = None
+        todo   = []
+        hydrator = self.target.hydrator
+        for (entry, abspath) in files:
+            if not self._is_current(entry, abspath):
+                todo.append((entry, abspath))
+            elif not hydrator or not hydrator.placeholder_id(abspath):
+                source = source or abspath
+
+        if RestoreExecutor.DEBUG:
+            print "[DEBUG] Restore object:", obj_id, len(todo), "of", \
+                len(files), "files"
+
+        for (entry, abspath) in todo:
+            (dirname, fname) = os.path.split(abspath)
+            tmp_path = os.path.join(dirname, RestoreExecutor.TMP_PREFIX + \
+                "%016x-" % random.getrandbits(64) + fname)
+            try:
+                # an existing file keeps its permissions
+                mode = stat.S_IMODE(os.stat(abspath).st_mode)
+            except OSError:
+                mode = 0666 & ~self.umask
+            # inotify events of both names are not local changes
+            self.target.expect_write(tmp_path, entry.fsize)
+            self.target.expect_write(abspath, entry.fsize)
+            placed = False
+            try:
+                if source:
+                    shutil.copyfile(source, tmp_path)
+                elif hydrator and entry.fsize:
+                    # content fetched on first open
+                    placed = hydrator.place(entry, tmp_path)
+                if not source and not placed:
+                    self._download(obj_id, tmp_path)
+                os.chmod(tmp_path, mode)
+                os.rename(tmp_path, abspath)
+            finally:
+                if os.path.lexists(tmp_path):
+                    os.unlink(tmp_path)
+                # events of both names wait for the writes to settle
+                self.target.settle_write(tmp_path)
+                self.target.settle_write(abspath)
+            if placed:
+                hydrator.watch(abspath, obj_id, entry.fsize, False)
+                continue
+            # downloaded content needs no upload on next startup
+            self.target.cache_stat(os.stat(abspath), entry.fname, obj_id, \
+                entry.fsize)
+            source = source or abspath
+
+    # stream an object into a file, its content is checked on the way
+    def _download(self, obj_id, path):
+        md5 = hashlib.md5()
+        f = open(path, "wb")
+        try:
+            for data in self.repo_fs.open_read(obj_id):
+                md5.update(data)
+                f.write(data)
+        finally:
+            f.close()
+        if not md5.hexdigest() == obj_id:
+            raise IOError("Object %s downloaded corrupted" % obj_id)
+
+    # local file holds the content of entry already
+    def _is_current(self, entry, abspath):
+        try:
+            st = os.lstat(abspath)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or not st.st_size == entry.fsize:
+            return False
+
+        if self.target.hydrator:
+            obj_id = self.target.hydrator.placeholder_id(abspath)
+            if obj_id:
+                # reading a placeholder would hydrate it
+                return obj_id == entry.obj_id
+
+        if self.target.stat_cache:
+            cached = self.target.stat_cache.lookup(st)
+            if cached:
+                return cached.obj_id == entry.obj_id
+
+        md5 = hashlib.md5()
+        f = open(abspath, "rb")
+        cont = f.read(filesystem.FileSystem.BUFFER_SIZE)
+        while len(cont):
+            md5.update(cont)
+            cont = f.read(filesystem.FileSystem.BUFFER_SIZE)
+        f.close()
+        if not md5.hexdigest() == entry.obj_id:
+            return False
+
+        self.target.cache_stat(st, entry.fname, entry.obj_id, entry.fsize)
+        return True
@@ -0,0 +1,202 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module implements the transfer scheduler shared by all backup
+# file systems.
+#
+# Transfers are put into three lanes: metadata (snapshots and directory
+# objects), small files and bulk files. Each lane owns one reserved slot
+# and all lanes share the remaining ones, a shared slot is only given to
+# a lane when no lane of higher priority is waiting. Thus a large upload
+# never delays the objects that make other changes visible.
+#
+# Bandwidth is divided among active lanes by configurable shares and
+# capped by an optional rate, which may vary by time of day. Drivers
+# upload whole objects, so bytes are charged once a transfer completes
+# and the lane waits until its debt is paid off before the next one.
+import Queue
+import threading
+import time
+import traceback
+
+class TransferScheduler:
+    """Prioritize and pace transfers of backup file systems."""
+    # lanes, in priority order
+    LANE_META  = 0
+    LANE_SMALL = 1
+    LANE_BULK  = 2
+    LANES = (LANE_META, LANE_SMALL, LANE_BULK)
+
+    # default tunables, overridden by global configuration
+    SLOTS  = 4                      # concurrent transfers
+    SHARES = "6:3:1"                # bandwidth shares of lanes
+    SMALL_FILE_LIMIT = 4194304      # larger files go to bulk lane
+
+    def __init__(self, configure, DEBUG=False):
+        """Params:
+    configure: system-wise configuration."""
+        TransferScheduler.DEBUG = DEBUG
+        self.slots  = max(int(configure.get("TRANSFER_SLOTS", \
+            TransferScheduler.SLOTS)), len(TransferScheduler.LANES))
+        self.shares = [float(s) for s in configure.get("TRANSFER_SHARES", \
+            TransferScheduler.SHARES).split(":")]
+        self.small_limit = int(configure.get("SMALL_FILE_LIMIT", \
+            TransferScheduler.SMALL_FILE_LIMIT))
+        # bytes per second, 0 for unlimited
+        self.rate = int(configure.get("RATE_LIMIT", 0))
+        self.rate_schedule = \
+            parse_rate_schedule(configure.get("RATE_SCHEDULE", ""))
+
+        self.cond    = threading.Condition()
+        self.running = [0] * len(TransferScheduler.LANES)
+        self.waiting = [0] * len(TransferScheduler.LANES)
+        # time until which a lane pays off bandwidth debt
+        self.paid_until = [0.0] * len(TransferScheduler.LANES)
+
+        # background transfers
+        self.jobs    = Queue.Queue()
+        self.workers = []
+
+        # per lane statistics: transfers and bytes
+        self.stats = [[0, 0] for lane in TransferScheduler.LANES]
+
+    def lane_of(self, nbytes):
+        """Lane for a file transfer of given size."""
+        if nbytes > self.small_limit:
+            return TransferScheduler.LANE_BULK
+        else:
+            return TransferScheduler.LANE_SMALL
+
+    def transfer(self, lane, nbytes, func, *args, **kwargs):
+        """Run a transfer when its lane is admitted.
+Params:
+    lane: one of LANE_META, LANE_SMALL and LANE_BULK;
+    nbytes: bytes to transfer, charged against the rate limit;
+    func: callable performing the transfer.
+
+Return:
+    Result of func(*args, **kwargs)."""
+        self._admit(lane)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._release(lane, nbytes)
+
+    def submit(self, func, args, loop, callback, cbargs=()):
+        """Run func(*args) on a background worker, then post
+callback(result, *cbargs) to the event loop. Errors are reported and the
+callback is skipped."""
+        if not len(self.workers):
+            for i in range(self.slots):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+        self.jobs.put((func, args, loop, callback, cbargs))
+
+    def current_rate(self):
+        """Rate limit in effect now, 0 for unlimited."""
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for (begin, end, rate) in self.rate_schedule:
+            if (begin <= minute < end) or \
+                    (end < begin and (minute >= begin or minute < end)):
+                return rate
+
+        return self.rate
+
+    def _admit(self, lane):
+        self.cond.acquire()
+        try:
+            self.waiting[lane] = self.waiting[lane] + 1
+            while not self._may_start(lane):
+                delay = self.paid_until[lane] - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                else:
+                    self.cond.wait()
+            self.waiting[lane] = self.waiting[lane] - 1
+            self.running[lane] = self.running[lane] + 1
+        finally:
+            self.cond.release()
+
+    def _may_start(self, lane):
+        if self.paid_until[lane] > time.time():
+            return False
+        # the reserved slot of this lane
+        if self.running[lane] == 0:
+            return True
+        # shared slots, occupied by extra transfers of all lanes
+        extra = sum([max(r - 1, 0) for r in self.running])
+        if extra >= self.slots - len(TransferScheduler.LANES):
+            return False
+        for higher in range(lane):
+            if self.waiting[higher]:
+                return False
+
+        return True
+
+    def _release(self, lane, nbytes):
+        self.cond.acquire()
+        try:
+            self.running[lane] = self.running[lane] - 1
+            self.stats[lane][0] = self.stats[lane][0] + 1
+            self.stats[lane][1] = self.stats[lane][1] + nbytes
+
+            rate = self.current_rate()
+            if rate and nbytes:
+                # share of the lane among active lanes
+                active = [l for l in TransferScheduler.LANES \
+                          if l == lane or self.running[l] or self.waiting[l]]
+                share  = self.shares[lane] / \
+                         sum([self.shares[l] for l in active])
+                start  = max(self.paid_until[lane], time.time())
+                self.paid_until[lane] = start + nbytes / (rate * share)
+
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _work(self):
+        while True:
+            (func, args, loop, callback, cbargs) = self.jobs.get()
+            try:
+                result = func(*args)
+            except Exception:
+                traceback.print_exc()
+                continue
+            loop.post(callback, result, *cbargs)
+
+# parse time of day rate caps
+# format: HH:MM-HH:MM@bytes_per_second, seperated by `,'
+def parse_rate_schedule(text):
+    schedule = []
+    for item in text.split(","):
+        item = item.strip()
+        if not len(item):
+            continue
+        (window, rate) = item.split("@")
+        (begin, end)   = window.split("-")
+        schedule.append((_minutes(begin), _minutes(end), int(rate)))
+
+    return schedule
+
+def _minutes(hhmm):
+    (hour, minute) = hhmm.split(":")
+
+    return int(hour) * 60 + int(minute)
@@ -0,0 +1,297 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module implements the staging area for uploads.
+#
+# A local file is staged before upload so that the object uploaded is
+# the content observed when the file was closed. By default the file is
+# hard linked into the staging area, or uploaded in place if the staging
+# area is on another device, and the upload is verified against the stat
+# taken when staged. Nothing is copied for a file left alone meanwhile.
+#
+# Files found rewritten during an upload are frozen on their next stage,
+# by a reflink clone where the file system supports it and by a plain
+# copy for small files. Staged files are keyed on (device, inode) plus
+# the stat signature of the content, thus staging the same content twice
+# shares one staged file.
+import collections
+import errno
+import fcntl
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+# ioctl request codes, see linux/fs.h
+FS_IOC_GETVERSION = 0x80087601
+FICLONE = 0x40049409
+
+class StagedFile:
+    """A staged copy of a local file."""
+    def __init__(self, key, path, st, frozen, owned=True):
+        self.key    = key
+        # path of the staged content
+        self.path   = path
+        # stat of the source when staged
+        self.st     = st
+        # True if later writes to the source do not affect staged content
+        self.frozen = frozen
+        # False if path is the source itself, uploaded in place
+        self.owned  = owned
+        self.refs   = 1
+
+class StagingArea:
+    """Stage local files keyed on (dev, inode)."""
+    PREFIX = "stage-"
+    # rewritten files larger than this are hard linked if they cannot be
+    # reflinked
+    COPY_LIMIT = 64 * 1024 * 1024
+    # retries if a file is modified while being staged
+    TRIALS = 3
+    # rewritten files remembered, least recently found first dropped
+    REWRITTEN_LIMIT = 4096
+
+    def __init__(self, tmpdir, copy_limit=COPY_LIMIT, DEBUG=False):
+        """Params:
+    tmpdir: directory holding staged files;
+    copy_limit: largest rewritten file copied when reflink is not
+                supported."""
+        StagingArea.DEBUG = DEBUG
+        self.tmpdir     = tmpdir
+        self.copy_limit = copy_limit
+        # key -> StagedFile
+        self.staged = {}
+        # (dev, inode) of files rewritten during an upload, frozen when
+        # staged again
+        self.rewritten = collections.OrderedDict()
+        self.lock   = threading.Lock()
+
+        self.cleanup()
+
+    def stage(self, abspath):
+        """Stage a local file.
+Params:
+    abspath: absolute path of the file to stage.
+
+Return:
+    A StagedFile object, which should be released after use.
+    Throws OSError if the file vanished."""
+        for trial in range(StagingArea.TRIALS):
+            st = os.stat(abspath)
+            self.lock.acquire()
+            try:
+                rewritten = (st.st_dev, st.st_ino) in self.rewritten
+            finally:
+                self.lock.release()
+
+            if rewritten:
+                staged = self._stage_frozen(abspath)
+            else:
+                staged = self._stage_linked(abspath, st)
+            if staged is None:
+                # modified or replaced while staging, try again
+                continue
+
+            if StagingArea.DEBUG:
+                print "[DEBUG] Staged", abspath, "as", staged.path, \
+                    "frozen" if staged.frozen else "linked"
+
+            return staged
+
+        # keep modifying, upload in place, verified after upload
+        st = os.stat(abspath)
+        return StagedFile(None, abspath, st, False, False)
+
+    def intact(self, staged):
+        """Check staged content is still what the source had when staged.
+A source found rewritten is frozen when staged next time.
+Params:
+    staged: a StagedFile returned by stage.
+
+Return:
+    True if the staged content can be trusted."""
+        if staged.frozen:
+            return True
+
+        try:
+            st = os.stat(staged.path)
+            intact = (st.st_ino, st.st_size, st.st_mtime) == \
+                (staged.st.st_ino, staged.st.st_size, staged.st.st_mtime)
+        except OSError:
+            intact = False
+
+        if not intact:
+            self.lock.acquire()
+            try:
+                self.rewritten[(staged.st.st_dev, staged.st.st_ino)] = True
+                if len(self.rewritten) > StagingArea.REWRITTEN_LIMIT:
+                    self.rewritten.popitem(last=False)
+            finally:
+                self.lock.release()
+
+        return intact
+
+    def release(self, staged):
+        """Drop a reference to a staged file, remove it if unreferenced."""
+        self.lock.acquire()
+        try:
+            staged.refs = staged.refs - 1
+            if staged.refs > 0:
+                return
+            if staged.key:
+                del self.staged[staged.key]
+        finally:
+            self.lock.release()
+
+        if not staged.owned:
+            return
+        try:
+            os.unlink(staged.path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Remove staged files left by a previous run."""
+        for f in os.listdir(self.tmpdir):
+            if f.startswith(StagingArea.PREFIX):
+                try:
+                    os.unlink(os.path.join(self.tmpdir, f))
+                except OSError:
+                    pass
+
+    # share a staged file of the same key, or register a new one
+    # return the StagedFile to use
+    def _share(self, staged):
+        self.lock.acquire()
+        try:
+            shared = self.staged.get(staged.key)
+            if shared:
+                shared.refs = shared.refs + 1
+            else:
+                self.staged[staged.key] = staged
+        finally:
+            self.lock.release()
+
+        if not shared:
+            return staged
+        # staged concurrently by another thread
+        if staged.owned:
+            os.unlink(staged.path)
+        return shared
+
+    # lookup a staged file of a key, taking a reference
+    def _lookup(self, key):
+        self.lock.acquire()
+        try:
+            staged = self.staged.get(key)
+            if staged:
+                staged.refs = staged.refs + 1
+            return staged
+        finally:
+            self.lock.release()
+
+    # hard link a file into the staging area, in place if on another
+    # device; None if replaced meanwhile
+    # the link keeps the inode, its number is not reused while staged
+    def _stage_linked(self, abspath, st):
+        key = "%x-%x-%x-%d" % (st.st_dev, st.st_ino, st.st_size, \
+            int(round(st.st_mtime * 1000000000)))
+        staged = self._lookup(key)
+        if staged:
+            return staged
+
+        # the name is unique, concurrent stages of the file never share it
+        (fd, path) = tempfile.mkstemp(dir=self.tmpdir, \
+            prefix=StagingArea.PREFIX + key + "-")
+        os.close(fd)
+        os.unlink(path)
+        try:
+            os.link(abspath, path)
+        except OSError as e:
+            if not e.errno == errno.EXDEV:
+                raise
+            # different device, upload in place
+            return self._share(StagedFile(key, abspath, st, False, False))
+
+        if not os.stat(path).st_ino == st.st_ino:
+            # replaced between stat and link
+            os.unlink(path)
+            return None
+
+        return self._share(StagedFile(key, path, st, False))
+
+    # freeze content of a rewritten file, None if modified while copying
+    # the file is opened once, for its generation and its content
+    def _stage_frozen(self, abspath):
+        src = open(abspath, 'rb')
+        try:
+            st  = os.fstat(src.fileno())
+            key = "%x-%x-%x-%x-%d" % (st.st_dev, st.st_ino, \
+                _generation(src.fileno()), st.st_size, \
+                int(round(st.st_mtime * 1000000000)))
+            staged = self._lookup(key)
+            if staged:
+                return staged
+
+            (fd, path) = tempfile.mkstemp(dir=self.tmpdir, \
+                prefix=StagingArea.PREFIX + key + "-")
+            os.close(fd)
+            if _reflink(src.fileno(), path):
+                pass
+            elif st.st_size <= self.copy_limit:
+                dest = open(path, 'wb')
+                try:
+                    shutil.copyfileobj(src, dest)
+                finally:
+                    dest.close()
+            else:
+                # too large to copy, linked and verified after upload
+                os.unlink(path)
+                return self._stage_linked(abspath, st)
+
+            after = os.fstat(src.fileno())
+        finally:
+            src.close()
+
+        if not (after.st_size, after.st_mtime) == (st.st_size, st.st_mtime):
+            os.unlink(path)
+            return None
+
+        return self._share(StagedFile(key, path, st, True))
+
+# generation number of an inode, distinguishes reused inode numbers
+def _generation(fd):
+    try:
+        buf = fcntl.ioctl(fd, FS_IOC_GETVERSION, struct.pack('l', 0))
+        return struct.unpack('l', buf)[0]
+    except IOError:
+        # not supported by the file system
+        return 0
+
+# clone file descriptor src to dest sharing data blocks, return False if
+# not supported
+def _reflink(src, dest):
+    try:
+        d = open(dest, 'wb')
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, src)
+            return True
+        finally:
+            d.close()
+    except IOError:
+        return False
@@ -0,0 +1,100 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module decides which part of the backed up tree a device keeps.
+#
+# SUBSCRIBE lists the subtrees materialized on this device and
+# UNSUBSCRIBE the subtrees left out of them, both as paths relative to
+# SRC_DIR seperated by `:'. A subscribed path is covered: its files are
+# restored and its changes committed. The directories leading to a
+# subscribed path are visited but not covered, only their subscribed
+# children are. Everything else is neither fetched nor scanned, its
+# entries are carried into new snapshots as they are.
+import os
+
+class Subscription:
+    """Subtrees of the backed up file system kept by this device."""
+    SEPERATOR    = ':'
+    RECORD_DELIM = '|'              # between includes and excludes
+    ROOT         = '/'
+
+    def __init__(self, configure):
+        """Params:
+    configure: system-wise configuration."""
+        self.includes = Subscription._paths(configure.get("SUBSCRIBE", ""))
+        self.excludes = Subscription._paths(configure.get("UNSUBSCRIBE", ""))
+        if not len(self.includes):
+            self.includes = [Subscription.ROOT]
+
+    def __str__(self):
+        return Subscription.SEPERATOR.join(self.includes) + \
+            Subscription.RECORD_DELIM + \
+            Subscription.SEPERATOR.join(self.excludes)
+
+    def everything(self):
+        """True if the whole tree is subscribed."""
+        return self.includes == [Subscription.ROOT] and \
+            not len(self.excludes)
+
+    def covers(self, path):
+        """Check whether a path is subscribed.
+Params:
+    path: path relative to SRC_DIR, starting with `/'.
+
+Return:
+    True if files at path are kept on this device."""
+        return self._match(path, self.includes) and \
+            not self._match(path, self.excludes)
+
+    def visits(self, path):
+        """Check whether a directory is kept, maybe partially.
+Params:
+    path: path of the directory relative to SRC_DIR, starting with `/'.
+
+Return:
+    True if the directory is subscribed or leads to a subscribed path."""
+        if self.covers(path):
+            return True
+        prefix = path.rstrip(os.path.sep) + os.path.sep
+        return not self._match(path, self.excludes) and \
+            len([p for p in self.includes if p.startswith(prefix)]) > 0
+
+    def child(self, path, name, isdir):
+        """Check an entry of a directory, see covers() and visits()."""
+        path = os.path.join(path, name)
+        if isdir:
+            return self.visits(path)
+        else:
+            return self.covers(path)
+
+    # path equals a prefix or lies below it
+    def _match(self, path, prefixes):
+        for prefix in prefixes:
+            if prefix == Subscription.ROOT or path == prefix or \
+                    path.startswith(prefix + os.path.sep):
+                return True
+        return False
+
+    @staticmethod
+    def _paths(value):
+        paths = []
+        for path in value.split(Subscription.SEPERATOR):
+            path = path.strip()
+            if len(path):
+                paths.append(os.path.normpath(os.path.join( \
+                    Subscription.ROOT, path)))
+        return paths
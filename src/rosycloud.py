@@ -21,6 +21,7 @@
 import argparse
 import hashlib
 import os
+import socket
 import sys
 import time
 import threading
@@ -37,9 +38,18 @@ import fs.ossfs
 import fs.azurefs
 import fs.gdfs
 import fs.localfs
+import fs.scheduler
+import fs.listing
+import fs.restore
+import fs.quorumfs
+import fs.erasurefs
+import fs.outbox
+import fs.couldnotconnectserverexception
+import fs.readrouter
 
 import decorators.gpgbz2decorator
 import util.util
+import util.statcache
 
 import fs.meta.dir
 
@@ -47,8 +57,15 @@ import tools.fsck
 import tools.ls
 import tools.xtr
 import tools.tag
+import tools.replicate
 
+import eventhandlers.eventloop
 import eventhandlers.inotifier
+import eventhandlers.fanotifier
+import eventhandlers.hotfiles
+import eventhandlers.hydrator
+import eventhandlers.hybridwatcher
+import eventhandlers.syncscheduler
 
 import util.bsddbconn
 
@@ -62,6 +79,25 @@ SYS_UREC_CMD_PARM = -5            # unrecognizable command line parameter
 SYS_ASSERT_FAIL   = -6            # cloud storage in a consistent state
 SYS_FILE_NOT_EXISTS = -7          # file does not exist
 
+# default seconds between flushes of local state
+FLUSH_INTERVAL = 30
+# syncs between full snapshot listings of a cloud
+HEAD_REPAIR_INTERVAL = 96
+
+# syncs since last full snapshot listing, per cloud
+syncs_since_listing = {}
+# snapshot listing kept between syncs, per cloud
+snapshot_listings = {}
+# reads objects from the fastest cloud, or from fragments on all clouds,
+# if several are configured
+read_router = None
+# writes objects to several clouds at once if configured
+committer = None
+# if set, syncs restore files in background and commit on the loop, the
+# event handler holds local changes meanwhile
+event_loop    = None
+event_handler = None
+
 # sync update on snapshot
 # root_ss_lock = threading.Lock()
 # sync file system hierachy update
@@ -103,6 +139,17 @@ def find_lowest_common_ancestor(forked_ss_root, forked_ss_tree):
 
     return lca
 
+# root entry of the merged tree if a branch has no changes since the
+# common ancestor, None if both changed and a merge is required
+def fast_forward(branch1_ss, branch2_ss, base_ss):
+    if branch1_ss.root.obj_id == base_ss.root.obj_id or \
+            branch1_ss.root.obj_id == branch2_ss.root.obj_id:
+        return branch2_ss.root
+    elif branch2_ss.root.obj_id == base_ss.root.obj_id:
+        return branch1_ss.root
+    else:
+        return None
+
 # create a list of new dir objects
 def three_way_merge(branch1_ss, branch2_ss, base_ss, cloud_fs, local_fs):
     base_hierachy    = fs.filesystem.hierachy(base_ss.root, cloud_fs, local_fs)
@@ -114,13 +161,25 @@ def three_way_merge(branch1_ss, branch2_ss, base_ss, cloud_fs, local_fs):
             base_hierachy[base_ss.root.obj_id], base_hierachy)
 
 # will modify target file system directly
-def update(target, repo_fs, new_version, root_ss):
+# only subscribed parts are applied, previous is the subscription the
+# local tree was materialized with if it changed
+def update(target, repo_fs, new_version, root_ss, previous=None):
+    plan_update(target, repo_fs, new_version, root_ss, previous).run()
+
+# directories are made and removals done now, returns the executor with
+# files queued, which restores them once run or started
+def plan_update(target, repo_fs, new_version, root_ss, previous=None):
+    subscription = target.subscription
+    if not previous:
+        previous = subscription
     # pre-order traversal new file system hierachy
     # stack stores object id's
     pre_ord_stk = [root_ss.root.obj_id]
 
     # path to the file relatively
     bases = ["/"]
+    # directories are made during traversal, files restored afterwards
+    executor = fs.restore.RestoreExecutor(target, repo_fs, DEBUG)
 
     # set up update lists
     while len(pre_ord_stk):
@@ -134,7 +193,9 @@ def update(target, repo_fs, new_version, root_ss):
         sub_dir = [currnod.dir_entries[f].obj_id for f \
                                           in currnod.dir_entries \
                                           if currnod.dir_entries[f].isdir()\
-                                          and not f == fs.meta.dir.Dir.SELF_REF]
+                                          and not f == fs.meta.dir.Dir.SELF_REF\
+                                          and subscription.visits( \
+                                              os.path.join(path, f))]
         # directory has extra content
         # add for pre-order traversal
         pre_ord_stk = pre_ord_stk + sub_dir
@@ -143,9 +204,21 @@ def update(target, repo_fs, new_version, root_ss):
         # dated storage
         dated = target.find(path, target.fs_hierachy)
 
-        if path == '/' or len(dated) == len(path.split(os.path.sep)):
+        if path == '/' or (len(dated) == len(path.split(os.path.sep)) and \
+                previous.visits(path)):
             # path find, the extra 1 is for root dir
             (created, updated, removed) = currnod.diff(dated.pop())
+            if not previous is subscription:
+                # entries not kept before are not local, fetch them all
+                kept = lambda e: previous.child(path, e.fname, e.isdir())
+                changed = [e.fname for e in created + updated]
+                created = created + [e for e in updated if not kept(e)] + \
+                    [currnod.dir_entries[f] for f in currnod.dir_entries \
+                     if not f == fs.meta.dir.Dir.SELF_REF and \
+                        not f in changed and \
+                        not kept(currnod.dir_entries[f])]
+                updated = [e for e in updated if kept(e)]
+                removed = [e for e in removed if kept(e)]
         else:
             # a new directory
             created = [currnod.dir_entries[f] for f in currnod.dir_entries \
@@ -157,44 +230,116 @@ def update(target, repo_fs, new_version, root_ss):
         ###################################################################
         # sync remote updates to local storage
         ###################################################################
+        # leave out entries not subscribed
+        (created, updated, removed) = [[e for e in l \
+            if subscription.child(path, e.fname, e.isdir())] \
+            for l in (created, updated, removed)]
+
         # create new items
         for e in created:
             relpath = os.path.join(path, e.fname)
             abspath = myabspath(target.configure["SRC_DIR"], relpath)
             if e.isdir():
-                target.mkdir(abspath)
+                executor.mkdir(abspath)
             else:
-                data = repo_fs.retrieve_to_file(e.obj_id, abspath)
+                executor.restore(e, abspath)
     
         # update modified items
         for e in updated:
             relpath = os.path.join(path, e.fname)
             abspath = myabspath(target.configure["SRC_DIR"], relpath)
-            data = repo_fs.retrieve_to_file(e.obj_id, abspath)
+            executor.restore(e, abspath)
     
         # remove obsoleted items
         for e in removed:
             relpath = os.path.join(path, e.fname)
             abspath = myabspath(target.configure["SRC_DIR"], relpath)
+            target.expect_remove(abspath)
             target.remove(abspath)
 
+    return executor
+
 # synchronize file or directory specified by path
-# if interval is 0, do not sync periodically
-def sync(remotefs, localfs, interval = 0):
-    # The inotify event generated sequentially is ignored.
-    localfs.source = False
-    # deprecated snapshot tree
-    (local_root, local_snapshots) = fs.filesystem.tree_snapshot(localfs)
-
-    local_ss  = localfs.list_snapshots()
-    remote_ss = remotefs.list_snapshots()
-
-    # those snapshots have not been cached locally
-    diff_ss = list(set(remote_ss) - set(local_ss))
-    # cache them
-    for ss in diff_ss:
-        snapshot = remotefs.get_snapshot(ss)
-        localfs.append_snapshot(snapshot, ss)
+# local writes are registered by update() and filtered out from inotify
+# events, changes made by user meanwhile are still committed
+def sync(remotefs, localfs):
+    polled = poll(remotefs, *poll_args(remotefs, localfs))
+    return apply_sync(remotefs, localfs, polled)
+
+# arguments of poll() taken from local state, on the loop
+def poll_args(remotefs, localfs):
+    return (localfs.get_head_etag(remotefs.ID), localfs.list_snapshots())
+
+# fetch snapshots committed on a cloud since last sync
+# only reads the cloud, thus it may run on a worker thread
+# returns (head etag, {ss_id: snapshot}, head missing, listed snapshots),
+# None if nothing changed
+def poll(remotefs, known, local_ss):
+    count    = syncs_since_listing.get(remotefs.ID, 0) + 1
+    # list all snapshots now and then, repairs lost head updates
+    full     = count >= HEAD_REPAIR_INTERVAL
+    listing  = full
+    missing  = False
+    fetched  = {}
+    remote_ss = None
+    try:
+        if listing:
+            (heads, etag) = remotefs.get_head()
+        else:
+            (heads, etag) = remotefs.get_head(known)
+    except IOError:
+        # no head object on the cloud yet
+        (heads, etag) = (None, None)
+        (listing, missing) = (True, True)
+    except NotImplementedError:
+        (heads, etag) = (None, None)
+        listing = True
+
+    if heads is None and not listing:
+        # nothing committed on the cloud since last sync
+        syncs_since_listing[remotefs.ID] = count
+        return None
+
+    if not listing:
+        try:
+            fetched = fetch_snapshots(remotefs, heads, local_ss)
+        except IOError:
+            # head refers to a snapshot gone, e.g. by garbage collection
+            listing = True
+
+    if listing:
+        ss_listing = get_listing(remotefs)
+        remote_ss  = ss_listing.refresh(full)
+
+        # those snapshots have not been cached locally
+        diff_ss = list(set(remote_ss) - set(local_ss) - set(fetched))
+        # cache them
+        for ss in diff_ss:
+            try:
+                fetched[ss] = remotefs.get_snapshot(ss)
+            except IOError:
+                # removed since listed, e.g. by garbage collection
+                ss_listing.forget(ss)
+        if full:
+            count = 0
+    syncs_since_listing[remotefs.ID] = count
+
+    return (etag, fetched, missing, remote_ss)
+
+# apply snapshots fetched by poll() to local file system, on the loop
+# returns True if the cloud had new snapshots
+def apply_sync(remotefs, localfs, polled):
+    if polled is None:
+        return False
+    if event_handler and event_handler.held is not None:
+        # a restore is still running, a later poll applies this one
+        return True
+    (etag, fetched, missing, remote_ss) = polled
+
+    local_ss = set(localfs.list_snapshots())
+    for (ss_id, snapshot) in fetched.items():
+        if not ss_id in local_ss:
+            localfs.append_snapshot(snapshot, ss_id)
 
     # get latest snapshot tree
     (remote_root, remote_snapshots) = fs.filesystem.tree_snapshot(localfs)
@@ -216,14 +361,22 @@ def sync(remotefs, localfs, interval = 0):
                 # get snapshot object from snapshot id
                 common_ance = remote_snapshots[common_ance]
             # currently active snapshot tree
-            (new_base_root_dir, new_dir_list) = \
-                three_way_merge(remote_snapshots[remote_root[0]], \
-                    remote_snapshots[remote_root[1]], common_ance, \
-                    remotefs, localfs)
+            new_base_root_dir = fast_forward( \
+                remote_snapshots[remote_root[0]], \
+                remote_snapshots[remote_root[1]], common_ance)
+            if new_base_root_dir:
+                # one branch is just behind, nothing to merge
+                new_dir_list = []
+            else:
+                (new_base_root_dir, new_dir_list) = \
+                    three_way_merge(remote_snapshots[remote_root[0]], \
+                        remote_snapshots[remote_root[1]], common_ance, \
+                        read_router or remotefs, localfs)
     
             for d in new_dir_list:
                 data = str(d)
-                obj_id = remotefs.store(data)
+                # striped objects are not readable from one cloud
+                obj_id = (committer or remotefs).store(data)
                 localfs.store_cache(obj_id, data)
     
             snapshot = fs.meta.snapshot.SnapShot()
@@ -233,6 +386,7 @@ def sync(remotefs, localfs, interval = 0):
     
             root_snapshot = remotefs.append_snapshot(snapshot);
             localfs.append_snapshot(snapshot, root_snapshot)
+            remotefs.advance_head(root_snapshot, snapshot.parents)
         else:
             root_snapshot = remote_root[0]
             snapshot = remote_snapshots[root_snapshot]
@@ -241,25 +395,102 @@ def sync(remotefs, localfs, interval = 0):
         # need update pointer to root directory entry
         # also need to diff different hierachies to reflex
         # changes on file system
-        new_hier = fs.filesystem.hierachy(new_base_root_dir, remotefs, \
-            localfs)
+        # objects are content addressed, any cloud holding them serves
+        reader = read_router or remotefs
+        new_hier = fs.filesystem.hierachy(new_base_root_dir, reader, \
+            localfs, localfs.subscription)
         pre_root_snapshot = localfs.get_root_snapshot_id()
         if pre_root_snapshot:
             localfs.fs_hierachy = fs.filesystem.hierachy( \
                 localfs.get_snapshot(pre_root_snapshot).root, \
-                remotefs, localfs)
-
-        update(localfs, remotefs, new_hier, snapshot)
-        localfs.fs_hierachy   = new_hier
+                reader, localfs, localfs.subscription)
+
+        executor = plan_update(localfs, reader, new_hier, snapshot)
+        args = (etag, new_hier, root_snapshot, \
+            missing and root_snapshot in remote_ss)
+        if event_loop:
+            # files are restored off the loop, local changes are held
+            # until the tree is switched to the new snapshot
+            event_handler.hold()
+            executor.start(event_loop, restored, remotefs, localfs, *args)
+        else:
+            executor.run()
+            commit_sync(remotefs, localfs, *args)
+    else:
+        commit_sync(remotefs, localfs, etag)
+
+    return len(fetched) > 0
+
+# switch the local tree to a restored snapshot, reset is True if the
+# head object should be rewritten
+def commit_sync(remotefs, localfs, etag, new_hier=None, root_snapshot=None, \
+        reset=False):
+    if new_hier is not None:
+        localfs.fs_hierachy = new_hier
         localfs.set_root_snapshot_id(root_snapshot)
+        if reset:
+            # clouds synced before head objects existed
+            etag = remotefs.reset_head([root_snapshot])
 
-    # End sync-ing
-    localfs.source = True
+    # remember the version applied, unchanged heads end next sync early
+    if etag:
+        localfs.set_head_etag(remotefs.ID, etag)
 
-    if interval:
-        # re-sync after interval
-        threading.Timer(interval, sync, \
-            [remotefs, localfs, interval]).start()
+# a background restore finished, on the loop
+def restored(error, remotefs, localfs, *args):
+    try:
+        if error:
+            # tree and version are kept, the next sync restores again
+            print "Cannot restore from", remotefs.ID, "(%s)." % error
+        else:
+            commit_sync(remotefs, localfs, *args)
+    finally:
+        event_handler.release()
+
+# snapshot listing of a cloud, loaded on first use
+def get_listing(remotefs):
+    if not remotefs.ID in snapshot_listings:
+        snapshot_listings[remotefs.ID] = fs.listing.SnapshotListing( \
+            remotefs, configure["SYS_LISTING"] + remotefs.ID, DEBUG)
+    return snapshot_listings[remotefs.ID]
+
+# fetch snapshots reachable from heads but not cached locally
+# throws IOError if any of them is missing on the cloud
+def fetch_snapshots(remotefs, heads, local_ss):
+    cached  = set(local_ss)
+    fetched = {}
+    pending = [h for h in heads if h not in cached]
+    while len(pending):
+        ss_id = pending.pop()
+        if ss_id in cached:
+            continue
+        snapshot = remotefs.get_snapshot(ss_id)
+        fetched[ss_id] = snapshot
+        cached.add(ss_id)
+        pending.extend([p for p in snapshot.parents if p not in cached])
+
+    return fetched
+
+# call func(*args) on the event loop every interval seconds, also after
+# a call failed
+def every(loop, interval, func, *args):
+    try:
+        func(*args)
+    finally:
+        loop.call_later(interval, every, loop, interval, func, *args)
+
+# read and dispatch pending events, of inotify or fanotify
+def process_inotify(notifier):
+    notifier.read_events()
+    notifier.process_events()
+
+# write buffered local state to disk
+def flush(localfs, handler):
+    if localfs.stat_cache:
+        localfs.stat_cache.flush()
+    if handler.hotfiles:
+        handler.hotfiles.dump(configure["SYS_STATS"])
+    handler.UPDATE_LOG.flush()
 
 # compute md5 given data
 def _md5(data):
@@ -302,6 +533,11 @@ def init():
         configure["SYS_DIR_CACHE"] = os.path.join(configure["SYS_DIR"], "cache")
         configure["SYS_DB"] = os.path.join(configure["SYS_DIR"], "local.db")
         configure["SYS_TMP"] = os.path.join(configure["SYS_DIR"], "tmp")
+        configure["SYS_STAT_CACHE"] = \
+            os.path.join(configure["SYS_DIR"], "stat.db")
+        configure["SYS_STATS"] = os.path.join(configure["SYS_DIR"], "stats")
+        configure["SYS_LISTING"] = \
+            os.path.join(configure["SYS_DIR"], "listing-")
     except IOError as e:
         print "Cannot file system configuration file. Program exits."
         sys.exit(SYS_GLB_CONF_NOT_FOUND)
@@ -320,7 +556,10 @@ def init_clouds(clouds, sys_dir):
                  "local":("fs.localfs", "LocalFS")}
 
     decorator = decorators.gpgbz2decorator.GPGBZ2Decorator( \
-        configure["GPG_HOME"], configure["GPG_FILE"], DEBUG=DEBUG)
+        configure["GPG_HOME"], configure["GPG_FILE"], \
+        tmpdir=configure["SYS_TMP"], DEBUG=DEBUG)
+    # transfers of all clouds share slots and bandwidth
+    scheduler = fs.scheduler.TransferScheduler(configure, DEBUG)
 
     cloud_fses = []
     for cloud in clouds:
@@ -328,8 +567,10 @@ def init_clouds(clouds, sys_dir):
         cloud_conf["SYS_DIR"] = configure["SYS_DIR"]
         
         cloud_meta = cloud_map[cloud]
-        cloud_fses.append(util.util.get_class_by_name( \
-            cloud_meta[0], cloud_meta[1])(cloud_conf, decorator))
+        cloud_fs   = util.util.get_class_by_name( \
+            cloud_meta[0], cloud_meta[1])(cloud_conf, decorator)
+        cloud_fs.scheduler = scheduler
+        cloud_fses.append(cloud_fs)
 
     return cloud_fses;
 
@@ -365,6 +606,12 @@ if __name__ == "__main__":
     #       garbage collection.
     fsck_parser = subparsers.add_parser("fsck", help="collect garbage on clouds.")
     fsck_parser.add_argument('-o', '--one', action="store_true", dest="keep_one", help="set keep policy as KEEP_ONE, KEEP_HEUR instead.")
+    # replicate: copy objects, snapshots and tags missing on a cloud
+    #            from another one, as stored
+    rep_parser = subparsers.add_parser("replicate", help="copy backups from a cloud to another.")
+    rep_parser.add_argument('src', help="specify source cloud.")
+    rep_parser.add_argument('dst', help="specify destination cloud.")
+    rep_parser.add_argument('-r', '--restart', action="store_true", help="plan again instead of resuming an interrupted run.")
     # start: start sync
     start_parser = subparsers.add_parser("start", help="start synchronizing.")
 
@@ -390,6 +637,10 @@ if __name__ == "__main__":
         db = util.bsddbconn.BSDDBConnector(configure["SYS_DB"])
         clouds = configure["CLOUDS"].split(":")
         cloud_fses = init_clouds(clouds, configure["SYS_DIR"])
+        if len(configure.get("ERASURE", "")):
+            # objects are only readable from all clouds together
+            cloud_fses = [fs.erasurefs.ErasureFS(cloud_fses, configure, \
+                DEBUG)]
         # cloud_fs = fs.cloudemufs.CloudEmulator(configure, DEBUG)
         local_fs = fs.hddfs.HDDFS(configure, db, cloud_fses, DEBUG)
         # list all versioned files
@@ -397,10 +648,12 @@ if __name__ == "__main__":
     elif action == "xtract":
         # extract versioned file to current working directory
         db     = util.bsddbconn.BSDDBConnector(configure["SYS_DB"])
-        clouds = [args.cloud]
+        # other clouds may serve objects faster
+        clouds = [args.cloud] + [c for c in configure["CLOUDS"].split(":") \
+                                 if not c == args.cloud]
         cloud_fses = init_clouds(clouds, configure["SYS_DIR"])
         local_fs   = fs.hddfs.HDDFS(configure, db, cloud_fses, DEBUG)
-        ret = tools.xtr.main(args.cloud, local_fs, args.version, args.path)
+        ret = tools.xtr.main(cloud_fses, local_fs, args.version, args.path)
     elif action == "tag":
         db     = util.bsddbconn.BSDDBConnector(configure["SYS_DB"])
         clouds = configure["CLOUDS"].split(":")
@@ -424,6 +677,11 @@ if __name__ == "__main__":
         local_fs = fs.hddfs.HDDFS(configure, db, cloud_fses, DEBUG)
         # collect garbage and check backup integrities
         tools.fsck.main(configure, local_fs, args.keep_one, cloud_fses)
+    elif action == "replicate":
+        cloud_fses = init_clouds([args.src, args.dst], configure["SYS_DIR"])
+        ret = tools.replicate.main(configure, args.src, cloud_fses[0], \
+            args.dst, cloud_fses[1], args.restart)
+        sys.exit(ret)
     elif action == "start":
         # normal flow
         omits = [configure["SYS_DIR"] + os.path.sep + \
@@ -447,67 +705,189 @@ if __name__ == "__main__":
         db = util.bsddbconn.BSDDBConnector(configure["SYS_DB"])
         clouds = configure["CLOUDS"].split(":")
         cloud_fses = init_clouds(clouds, configure["SYS_DIR"])
-        local_fs = fs.hddfs.HDDFS(configure, db, omits, cloud_fses, DEBUG)
+        reader = cloud_fses[0]
+        if len(configure.get("ERASURE", "")):
+            # objects are striped across clouds, written and read by
+            # fragments, snapshots still go to every cloud
+            committer = fs.erasurefs.ErasureFS(cloud_fses, configure, DEBUG)
+            read_router = committer
+            reader = committer
+        elif len(cloud_fses) > 1 and \
+                configure.get("READ_ROUTING", "on") == "on":
+            # objects are read from the fastest cloud holding them
+            read_router = fs.readrouter.ReadRouter(cloud_fses, configure, \
+                DEBUG)
+            reader = read_router
+        # local commits are written to every cloud, durable on a quorum
+        if not committer and len(configure.get("COMMIT_QUORUM", "")):
+            committer = fs.quorumfs.QuorumFS(cloud_fses, clouds, \
+                configure, DEBUG)
+        # writes are queued while the cloud is unreachable
+        outbox = fs.outbox.OutboxFS(committer or cloud_fses[0], configure, \
+            DEBUG)
+        local_fs = fs.hddfs.HDDFS(configure, db, omits, [outbox], DEBUG)
     
         # the global system maintains a file hierachy
         # we seperate file system hierachy from a specific file system
         # thus, the file system itself is stateless and cost-less to maitain
+        if configure.get("HYDRATION", "off") == "on":
+            # restore placeholders, content is fetched on first open
+            try:
+                local_fs.hydrator = eventhandlers.hydrator.Hydrator( \
+                    local_fs, reader, configure, DEBUG)
+                local_fs.hydrator.start()
+            except OSError as e:
+                print "Cannot use hydration (%s), restore files in full." \
+                    % e.strerror
+
+        # files restored or unchanged are known by the stat cache
+        local_fs.stat_cache = \
+            util.statcache.StatCache(configure["SYS_STAT_CACHE"])
+
         snapshot = local_fs.get_root_snapshot_id()
+        # subscription the local tree was materialized with
+        previous = local_fs.get_subscription()
         if snapshot:
             root     = local_fs.get_snapshot(snapshot).root
             local_fs.fs_hierachy = fs.filesystem.hierachy(root, \
-                cloud_fses[0], local_fs)
+                reader, local_fs, previous)
+            if not str(previous) == str(local_fs.subscription):
+                # fetch subtrees newly subscribed before scanning, they
+                # would be committed as removed otherwise
+                new_hier = fs.filesystem.hierachy(root, reader, \
+                    local_fs, local_fs.subscription)
+                update(local_fs, reader, new_hier, \
+                    local_fs.get_snapshot(snapshot), previous)
+                local_fs.fs_hierachy = new_hier
         else:
             empty_dir = fs.meta.dir.empty_dir(fs.meta.dir.Dir.ROOT_DIR)
             local_fs.fs_hierachy = \
                 {empty_dir[fs.meta.dir.Dir.SELF_REF].obj_id:empty_dir}
 
+        local_fs.set_subscription(local_fs.subscription)
+
         if DEBUG:
             print "File ignored:", omits
             print "first sync-ing storage"
 
         # upload all files in root directory
+        # files unchanged since last run are found in stat cache
+        local_fs.stat_cache.begin_scan()
         rootdir, ignore = local_fs.backup_files(configure["SRC_DIR"], "")
+        local_fs.stat_cache.end_scan()
         data = str(rootdir)
         local_fs.store_cache(_md5(data), data)
-        new_ss = fs.meta.snapshot.SnapShot()
-        new_ss.chroot_dir(rootdir)
-        new_ss.add_parent(snapshot)
-        new_ss_id = local_fs.append_snapshot(new_ss)
-        local_fs.set_root_snapshot_id(new_ss_id)
-
+        if snapshot and \
+                local_fs.get_snapshot(snapshot).root.obj_id == rootdir:
+            # unchanged since last run, a new snapshot would only fork
+            # from updates made by other devices meanwhile
+            (new_ss, new_ss_id) = (None, snapshot)
+        else:
+            new_ss = fs.meta.snapshot.SnapShot()
+            new_ss.chroot_dir(rootdir)
+            new_ss.add_parent(snapshot)
+            new_ss_id = local_fs.append_snapshot(new_ss)
+            local_fs.set_root_snapshot_id(new_ss_id)
+
+        # every local commit and remote sync runs on this loop
+        loop = eventhandlers.eventloop.EventLoop(DEBUG)
+        # clouds are polled concurrently, changes applied on the loop
+        syncer = eventhandlers.syncscheduler.SyncScheduler(loop, \
+            configure, DEBUG)
+        syncer.prepare = lambda cloud: poll_args(cloud, local_fs)
+        syncer.poll    = poll
+        syncer.apply   = lambda cloud, polled: \
+            apply_sync(cloud, local_fs, polled)
+
+        if new_ss:
+            # append current state
+            outbox.append_snapshot(new_ss, new_ss_id)
+            outbox.advance_head(new_ss_id, new_ss.parents)
         # sync local and remote storage when startup
         for cloud_fs in cloud_fses:
-            # append current state
-            cloud_fs.append_snapshot(new_ss)
-            # first sync after startup
-            sync(cloud_fs, local_fs, int(configure["INTERVAL"]))
+            if new_ss and not committer and not cloud_fs is outbox.target:
+                # append current state
+                try:
+                    cloud_fs.append_snapshot(new_ss)
+                    cloud_fs.advance_head(new_ss_id, new_ss.parents)
+                except fs.couldnotconnectserverexception. \
+                        CouldNotConnectServerException as e:
+                    print "Cannot reach", cloud_fs.ID, "(%s)," % e.reason, \
+                        "current state is not appended to it."
+            syncer.add(cloud_fs)
+        # first sync after startup
+        try:
+            syncer.sync_all()
+        except (fs.couldnotconnectserverexception. \
+                CouldNotConnectServerException, socket.error) as e:
+            # work offline, polls are retried periodically
+            print "Cannot sync with all clouds (%s), go on offline." % e
 
         if DEBUG:
             print "first sync done"
     
-        # setup inotify-er
-        wm   = pyinotify.WatchManager()
-    
-        # monitor file create event in this simple test case
-        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
-               pyinotify.IN_CLOSE_WRITE | \
-               pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
-               pyinotify.IN_MOVE_SELF
-    
-        wdd = wm.add_watch(configure["SRC_DIR"], mask, auto_add=True, rec=True)
-        notifier = pyinotify.Notifier(wm, \
-            eventhandlers.inotifier.NetDiskEventHandler(local_fs, \
-                cloud_fs, omits, configure, DEBUG) \
-        )
-        # notifier.start()
-    
-        while True:
-            print "iterate"
+        handler = eventhandlers.inotifier.NetDiskEventHandler(local_fs, \
+            outbox, omits, configure, DEBUG)
+        # large files are uploaded in background, committed on the loop
+        handler.loop = loop
+        # later syncs restore in background, the handler holds local
+        # changes meanwhile
+        event_loop    = loop
+        event_handler = handler
+        # files rewritten frequently are uploaded after a quiet period
+        hotfiles = eventhandlers.hotfiles.HotFileTracker(loop, configure, \
+            DEBUG)
+        hotfiles.callback = handler.store_file
+        handler.hotfiles  = hotfiles
+
+        notifier = None
+        if configure.get("EVENT_SOURCE", "inotify") == "fanotify":
+            # one mark for the whole file system, needs CAP_SYS_ADMIN
             try:
-                notifier.process_events()
-                if notifier.check_events():
-                    notifier.read_events()
-            except KeyboardInterrupt:
-                notifier.stop()
-                break
+                notifier = eventhandlers.fanotifier.FanotifyNotifier( \
+                    configure["SRC_DIR"], handler, DEBUG)
+                loop.add_reader(notifier.fileno(), process_inotify, notifier)
+            except OSError as e:
+                print "Cannot use fanotify (%s), fall back to inotify." % \
+                    e.strerror
+
+        if notifier is None:
+            # setup inotify-er
+            wm   = pyinotify.WatchManager()
+
+            # monitor file create event in this simple test case
+            mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+                   pyinotify.IN_CLOSE_WRITE | \
+                   pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+                   pyinotify.IN_MOVE_SELF
+
+            # watched directories are checked after an event queue overflow
+            handler.wm = wm
+            if configure.get("WATCH_MODE", "full") == "hybrid":
+                # watch active directories only, scan the others
+                watcher = eventhandlers.hybridwatcher.HybridWatcher(wm, \
+                    configure["SRC_DIR"], mask, local_fs, configure, DEBUG)
+                watcher.callback = handler.rescan_dir
+                handler.watcher  = watcher
+                watcher.start()
+                # advance the cold scan regularly
+                loop.call_later(1, every, loop, 1, watcher.tick)
+            else:
+                wdd = wm.add_watch(configure["SRC_DIR"], mask, \
+                    auto_add=True, rec=True)
+            notifier = pyinotify.Notifier(wm, handler)
+            loop.add_reader(wm.get_fd(), process_inotify, notifier)
+
+        # periodic sync with each cloud
+        syncer.start()
+        # periodic flush of local state
+        flush_interval = int(configure.get("FLUSH_INTERVAL", \
+                                           FLUSH_INTERVAL))
+        loop.call_later(flush_interval, every, loop, flush_interval, \
+            flush, local_fs, handler)
+
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            flush(local_fs, handler)
+            notifier.stop()
@@ -68,10 +68,14 @@ Params:
         for cloud in self.clouds:
             # first synchronize the cloud to eliminate branches
             rosycloud.sync(cloud, self.localfs)
+            snapshots = cloud.list_snapshots()
             if self.policy == GarbageCollector.KEEP_ONE:
                 self.gc_latest(cloud)
             elif self.policy == GarbageCollector.KEEP_LANDMARK:
                 self.gc(cloud)
+            # journal entries of removed snapshots would list them again
+            cloud.prune_journal( \
+                set(snapshots) - set(cloud.list_snapshots()))
 
         # remove all local caches
         # self.empty_cache()
@@ -198,6 +202,8 @@ Params:
         else:
             parent = parent[0]
         self.localfs.set_root_snapshot_id(parent)
+        # snapshot chain rewritten, heads point to the new root only
+        cloud.reset_head([parent])
 
         # reclaim all the storage for non-referred objects
         for obj in objects:
@@ -0,0 +1,207 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# Replicate backed up data from one cloud to another.
+#
+# Objects, snapshots and tags are copied as stored. They are compressed
+# and encrypted by the decorator shared by all clouds already, thus they
+# are neither decrypted nor recompressed on the way. Only keys missing on
+# the destination are copied, so the same command fills a newly added
+# cloud and repairs a cloud that lost objects.
+#
+# Objects are copied before the snapshots referring to them, snapshots
+# before tags and head snapshots last, so the destination never refers to
+# data it does not hold. Keys to copy are planned once and logged as they
+# are copied, an interrupted run resumes from this checkpoint without
+# listing either cloud again.
+
+import collections
+import os
+import tempfile
+import threading
+import traceback
+
+import fs.bakfilesystem
+import util.error
+
+BackupFileSystem = fs.bakfilesystem.BackupFileSystem
+
+class Replicator:
+    """Copy keys missing on a cloud from another one."""
+    THREADS = 8                     # default number of concurrent copies
+    RECORD_DELIM = ' '
+    # kinds of keys in order of copy
+    PHASES  = [BackupFileSystem.RAW_OBJECT, BackupFileSystem.RAW_SNAPSHOT, \
+               BackupFileSystem.RAW_TAG]
+
+    def __init__(self, configure, src, dst, checkpoint):
+        """Params:
+    configure: system-wise configuration;
+    src: BackupFileSystem to copy from;
+    dst: BackupFileSystem to copy to;
+    checkpoint: file recording the keys planned, the keys copied are
+                logged next to it."""
+        self.src     = src
+        self.dst     = dst
+        self.tmpdir  = configure["SYS_TMP"]
+        self.threads = int(configure.get("REPLICATE_THREADS", \
+            Replicator.THREADS))
+        self.plan_path = checkpoint
+        self.done_path = checkpoint + ".done"
+
+        self.lock   = threading.Lock()
+        self.todo   = collections.deque()
+        self.errors = []
+        # log of keys copied, opened by run()
+        self.log    = None
+
+    def run(self, restart=False):
+        """Copy all keys missing on the destination.
+Params:
+    restart: plan again rather than resume an interrupted run.
+
+Return:
+    Number of keys that failed to copy, they are retried next run."""
+        if restart or not os.path.exists(self.plan_path):
+            plan = self._plan()
+            done = set()
+        else:
+            plan = self._read(self.plan_path)
+            done = set(self._read(self.done_path))
+            print "Resume replication,", len(done), "of", len(plan), \
+                "keys copied."
+
+        self.log = open(self.done_path, "a")
+        try:
+            for kind in Replicator.PHASES:
+                keys = [k for k in plan if k[0] == kind and not k in done]
+                print "Copy", len(keys), kind + "s."
+                self._copy_all(keys)
+                if len(self.errors):
+                    # later kinds would refer to missing keys
+                    print len(self.errors), "keys failed, run again to retry."
+                    return len(self.errors)
+        finally:
+            self.log.close()
+
+        self._merge_heads(plan)
+        os.unlink(self.plan_path)
+        os.unlink(self.done_path)
+
+        return 0
+
+    # keys on source but not on destination, saved as checkpoint
+    def _plan(self):
+        plan = []
+        for kind in Replicator.PHASES:
+            missing = set(self.src.list_raw(kind)) - \
+                set(self.dst.list_raw(kind))
+            plan.extend([(kind, name) for name in sorted(missing)])
+
+        tmp_path = self.plan_path + ".tmp"
+        f = open(tmp_path, "w")
+        for (kind, name) in plan:
+            f.write(kind + Replicator.RECORD_DELIM + name + os.linesep)
+        f.close()
+        os.rename(tmp_path, self.plan_path)
+        # nothing copied of the new plan
+        open(self.done_path, "w").close()
+
+        return plan
+
+    def _read(self, path):
+        keys = []
+        f = open(path)
+        for line in f:
+            line = line.rstrip(os.linesep)
+            if len(line):
+                keys.append(tuple(line.split(Replicator.RECORD_DELIM, 1)))
+        f.close()
+
+        return keys
+
+    def _copy_all(self, keys):
+        self.todo.extend(keys)
+        workers = []
+        for i in range(min(self.threads, len(keys))):
+            worker = threading.Thread(target=self._work)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if not len(self.todo):
+                    return
+                (kind, name) = self.todo.popleft()
+            finally:
+                self.lock.release()
+
+            try:
+                self._copy(kind, name)
+            except Exception as e:
+                # other keys are still copied
+                traceback.print_exc()
+                self.lock.acquire()
+                self.errors.append(e)
+                self.lock.release()
+                continue
+
+            self.lock.acquire()
+            self.log.write(kind + Replicator.RECORD_DELIM + name + os.linesep)
+            self.log.flush()
+            self.lock.release()
+
+    def _copy(self, kind, name):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.tmpdir)
+        os.close(fd)
+        try:
+            self.src.get_raw(kind, name, tmp_path)
+            self.dst.put_raw(kind, name, tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+    # heads of source copied become heads of destination, heads it held
+    # already are ancestors of its own heads
+    def _merge_heads(self, plan):
+        try:
+            (heads, etag) = self.src.get_head()
+        except (IOError, NotImplementedError):
+            # destination heads are repaired by its next full listing
+            return
+        copied = set([n for (k, n) in plan \
+                      if k == BackupFileSystem.RAW_SNAPSHOT])
+        heads  = [h for h in heads if h in copied]
+        if len(heads):
+            self.dst.merge_heads(heads)
+
+# entrance for replication module
+def main(configure, src_name, src, dst_name, dst, restart=False):
+    """Params:
+    configure: system-wise configuration;
+    src_name, dst_name: names of source and destination clouds;
+    src, dst: corresponding BackupFileSystem objects;
+    restart: ignore the checkpoint of an interrupted run."""
+    checkpoint = os.path.join(configure["SYS_DIR"], \
+        "replicate-%s-%s" % (src_name, dst_name))
+    if Replicator(configure, src, dst, checkpoint).run(restart):
+        return util.error.SYS_REPLICA_INCOMPLETE
+
+    return 0
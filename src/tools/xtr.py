@@ -23,34 +23,29 @@
 
 import os
 
-import rosycloud
 import fs.filesystem
 import fs.meta.dir
+import fs.readrouter
+import fs.erasurefs
 
-import util.util
+import util.error
 
 # entrance for historical version extraction module
-def main(cloudname, local, bak_id, filename="/"):
+def main(clouds, local, bak_id, filename="/"):
     """Params:
-    cloud:  name of cloud, which extract versioned file are specified on;
+    clouds: configured clouds, the one extracted from first;
     bak_id: tag or snapshot number to extract from, snapshot id preferred;
     filename: filename if exists, full path name should be specified."""
-    # cloud conf
-    conf = rosycloud.load_cloud_conf(cloudname)
-    print cloudname
-    print "here"
-    if not conf:
-        # error reading cloud specific configuration file
-        return rosycloud.SYS_CLD_CONF_NOT_FOUND
-
-    # the file system driver naming conversion
-    # fs.xxxfs
-    dv = cloudname + 'fs'
-    # module name is lower cased
-    # class name is upper cased
-    driver = util.util.get_class_by_name('fs.' + dv.lower(), dv.upper())
-    # instantiate an driver object with specified configuration
-    cloud = driver(conf)
+    cloud = clouds[0]
+    if len(local.configure.get("ERASURE", "")):
+        # objects are striped across all clouds
+        reader = fs.erasurefs.ErasureFS(clouds, local.configure)
+    elif len(clouds) > 1:
+        # snapshot is read from the cloud given, objects from the
+        # fastest cloud holding them
+        reader = fs.readrouter.ReadRouter(clouds, local.configure)
+    else:
+        reader = cloud
 
     try:
         snapshot = cloud.get_snapshot(bak_id)
@@ -63,7 +58,7 @@ def main(cloudname, local, bak_id, filename="/"):
 
     # snapshot refer to the required snapshot information
     # hierachy now store all the objects in a hierarchy
-    hierachy = fs.filesystem.hierachy(snapshot.root, cloud, local)
+    hierachy = fs.filesystem.hierachy(snapshot.root, reader, local)
     entries  = local.find_entry(filename, hierachy, snapshot.root.obj_id)
     if not filename == local.ROOT and len(entries) == 1:
         return util.error.SYS_FILE_NOT_EXISTS
@@ -93,4 +88,4 @@ def main(cloudname, local, bak_id, filename="/"):
                 return util.error.SYS_FILE_EXISTS
         else:
             # simple file
-            cloud.retrieve_to_file(entry.obj_id, relpath)
+            reader.retrieve_to_file(entry.obj_id, relpath)
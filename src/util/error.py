@@ -26,3 +26,4 @@ SYS_FILE_EXISTS   = -4            # file already exsists
 SYS_UREC_CMD_PARM = -5            # unrecognizable command line parameter
 SYS_ASSERT_FAIL   = -6            # cloud storage in a consistent state
 SYS_FILE_NOT_EXISTS = -7          # file does not exist
+SYS_REPLICA_INCOMPLETE = -8       # keys left to replicate
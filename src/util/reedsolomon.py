@@ -0,0 +1,143 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module implements a systematic Reed-Solomon code over GF(256).
+#
+# k data shards are the data itself, m parity shards are combinations
+# of them by a Cauchy matrix, so that any k of the k + m shards solve for
+# the data. Byte-wise products by a constant are done by str.translate()
+# with a table of the constant, sums of shards by xor of long integers,
+# thus no Python loop runs per byte.
+import binascii
+
+# primitive polynomial of the field, x^8 + x^4 + x^3 + x^2 + 1
+POLY = 0x11d
+
+# powers of the generator and their logarithms, doubled to skip modulo
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x = _x << 1
+    if _x & 0x100:
+        _x = _x ^ POLY
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+def mul(a, b):
+    if not a or not b:
+        return 0
+
+    return EXP[LOG[a] + LOG[b]]
+
+def inverse(a):
+    if not a:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+
+    return EXP[255 - LOG[a]]
+
+class ReedSolomon:
+    """Encode k shards into m parity shards, decode from any k shards."""
+    def __init__(self, k, m):
+        """Params:
+    k: number of data shards;
+    m: number of parity shards."""
+        if k < 1 or m < 0 or k + m > 256:
+            raise ValueError("Invalid code: %d data, %d parity" % (k, m))
+
+        self.k = k
+        self.m = m
+        # rows of the generator, shard i is rows[i] times the data shards
+        self.rows = [[int(i == j) for j in range(k)] for i in range(k)] + \
+            [[inverse((k + i) ^ j) for j in range(k)] for i in range(m)]
+        # constant -> translation table multiplying bytes by it
+        self.tables   = {}
+        # shard indexes decoded from -> rows solving for the data
+        self.inverses = {}
+
+    def encode(self, shards):
+        """Params:
+    shards: k data shards, strings of the same length.
+
+Return:
+    m parity shards."""
+        return [self._combine(row, shards) for row in self.rows[self.k:]]
+
+    def decode(self, shards):
+        """Params:
+    shards: dict mapping shard index to shard, at least k of them.
+
+Return:
+    k data shards."""
+        indexes = sorted(shards)[:self.k]
+        if len(indexes) < self.k:
+            raise ValueError("%d shards needed, %d got" % \
+                (self.k, len(indexes)))
+        if indexes == range(self.k):
+            return [shards[i] for i in indexes]
+
+        key = tuple(indexes)
+        if not key in self.inverses:
+            self.inverses[key] = self._invert([self.rows[i] \
+                for i in indexes])
+        return [self._combine(row, [shards[i] for i in indexes]) \
+                for row in self.inverses[key]]
+
+    # sum of shards multiplied by coefficients
+    def _combine(self, row, shards):
+        size = len(shards[0])
+        if not size:
+            return ""
+
+        acc = 0
+        for (c, shard) in zip(row, shards):
+            if not c:
+                continue
+            if not c == 1:
+                shard = shard.translate(self._table(c))
+            acc = acc ^ int(binascii.hexlify(shard), 16)
+
+        return binascii.unhexlify("%0*x" % (2 * size, acc))
+
+    def _table(self, c):
+        if not c in self.tables:
+            self.tables[c] = "".join([chr(mul(c, b)) for b in range(256)])
+
+        return self.tables[c]
+
+    # inverse of a square matrix by Gauss-Jordan elimination
+    def _invert(self, matrix):
+        n = len(matrix)
+        rows = [list(r) + [int(i == j) for j in range(n)] \
+                for (i, r) in enumerate(matrix)]
+        for col in range(n):
+            pivot = [r for r in range(col, n) if rows[r][col]]
+            if not len(pivot):
+                raise ValueError("Singular matrix")
+            (rows[col], rows[pivot[0]]) = (rows[pivot[0]], rows[col])
+            scale = inverse(rows[col][col])
+            rows[col] = [mul(scale, v) for v in rows[col]]
+            for r in range(n):
+                factor = rows[r][col]
+                if r == col or not factor:
+                    continue
+                rows[r] = [v ^ mul(factor, p) \
+                           for (v, p) in zip(rows[r], rows[col])]
+
+        return [r[n:] for r in rows]
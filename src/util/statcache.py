@@ -0,0 +1,176 @@
+# Copyright (c) 2012,2013 Shuang Qiu <qiush.summer@gmail.com>
+#
+# This file is part of RosyCloud.
+#
+# RosyCloud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RosyCloud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RosyCloud.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module implements a persistent stat cache.
+#
+# Each record is keyed on (device, inode) of a local file or directory
+# and remembers the stat signature (size, mtime, ctime) observed when the
+# file was last stored together with its directory entry. If the signature
+# of a file is unchanged, its content is known to be unchanged as well and
+# the object id can be reused without reading the file.
+import bsddb
+import threading
+
+import fs.meta.dir
+
+def _ns(timestamp):
+    # timestamps in nanosecond, floats are not compared directly
+    return int(round(timestamp * 1000000000))
+
+class StatCache:
+    """Map (dev, inode, size, mtime, ctime) of local files to dir entries."""
+    RECORD_DELIM  = '|'             # record delimiter
+    SYNC_INTERVAL = 1024            # number of updates between db syncs
+
+    def __init__(self, dbname):
+        """Open the cache, create a new one if not pre-exists.
+Params:
+    dbname: name of the database file."""
+        self.db    = bsddb.hashopen(dbname)
+        self.lock  = threading.Lock()
+        self.dirty = 0
+        # keys visited by a running full scan, None if no scan
+        self.seen  = None
+
+    def lookup(self, st):
+        """Get the directory entry stored for an unchanged file.
+Params:
+    st: result of os.stat on the file.
+
+Return:
+    A DirEntry if the file is cached with the same stat signature,
+    None otherwise."""
+        record = self._get(st)
+        if not record:
+            return None
+
+        (signature, entry) = record
+        if not signature == StatCache.signature(st):
+            return None
+
+        return entry
+
+    def lookup_inode(self, st):
+        """Get the directory entry stored for a renamed file or directory.
+Rename updates ctime, thus only size and mtime are compared.
+Params:
+    st: result of os.stat on the file.
+
+Return:
+    A DirEntry if the inode is cached with the same size and mtime,
+    None otherwise."""
+        record = self._get(st)
+        if not record:
+            return None
+
+        (signature, entry) = record
+        if not signature[:2] == StatCache.signature(st)[:2]:
+            return None
+
+        return entry
+
+    def put(self, st, entry):
+        """Remember the directory entry of a stored file.
+Params:
+    st: result of os.stat on the file, taken before it was read;
+    entry: DirEntry describing the stored object.
+
+Return:
+    None."""
+        value = StatCache.RECORD_DELIM.join( \
+            [str(f) for f in StatCache.signature(st)] + [str(entry)])
+
+        self.lock.acquire()
+        try:
+            self.db[StatCache.key(st)] = value
+            self._mark_seen(st)
+            self.dirty = self.dirty + 1
+            if self.dirty >= StatCache.SYNC_INTERVAL:
+                self._sync()
+        finally:
+            self.lock.release()
+
+    def remove(self, st):
+        """Forget a file.
+Params:
+    st: result of os.stat on the file."""
+        self.lock.acquire()
+        try:
+            try:
+                del self.db[StatCache.key(st)]
+                self.dirty = self.dirty + 1
+            except KeyError:
+                pass
+        finally:
+            self.lock.release()
+
+    def begin_scan(self):
+        """Start tracking files visited by a full scan of the tree."""
+        self.seen = set()
+
+    def end_scan(self):
+        """Drop records of all the files not visited since begin_scan."""
+        self.lock.acquire()
+        try:
+            stale = [k for k in self.db.keys() if k not in self.seen]
+            for key in stale:
+                del self.db[key]
+            self.seen = None
+            self._sync()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write pending updates to disk."""
+        self.lock.acquire()
+        try:
+            self._sync()
+        finally:
+            self.lock.release()
+
+    def _get(self, st):
+        self.lock.acquire()
+        try:
+            try:
+                value = self.db[StatCache.key(st)]
+            except KeyError:
+                return None
+            self._mark_seen(st)
+        finally:
+            self.lock.release()
+
+        fields = value.split(StatCache.RECORD_DELIM, 3)
+        signature = tuple([int(f) for f in fields[:3]])
+
+        return (signature, fs.meta.dir.DirEntry(fields[3]))
+
+    def _mark_seen(self, st):
+        if self.seen is not None:
+            self.seen.add(StatCache.key(st))
+
+    def _sync(self):
+        if self.dirty:
+            self.db.sync()
+            self.dirty = 0
+
+    @staticmethod
+    def key(st):
+        return "%x:%x" % (st.st_dev, st.st_ino)
+
+    @staticmethod
+    def signature(st):
+        return (st.st_size, _ns(st.st_mtime), _ns(st.st_ctime))